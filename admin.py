@@ -0,0 +1,821 @@
+#!/usr/bin/env python3
+"""
+Admin CLI for the Appointment Scheduler data files
+
+Every command streams records one at a time: JSON arrays are parsed
+incrementally and rewritten through a temp file that replaces the original
+atomically, so memory use is bounded by the largest single record (plus a
+set of ids for duplicate and reference checks), not by the file size.
+Snapshot stores (``STORE_FORMAT=snapshot``) and appointment segments
+(``APPOINTMENT_SHARDS``) are read where the app keeps them; they are
+written whole, so rewriting them holds the store in memory.
+
+Usage:
+    python admin.py export appointments --format csv -o appointments.csv
+    python admin.py import appointments bookings.jsonl --dry-run
+    python admin.py reset-password andrej
+    python admin.py check
+    python admin.py compact all --drop-dangling
+    python admin.py thumbnails
+    python admin.py deletions
+
+Commands that change data hold the same write locks as the app while they
+rewrite a store, so they can run while it serves requests: workers wait for
+the rewrite and then load it. New ids come from the app's id sequences
+(``ids.json``), so an import never reuses an id the app already handed out.
+"""
+
+import argparse
+import csv
+import getpass
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+
+import ids
+import shards
+import snapshot
+from locks import FileLock
+
+STORES = {
+    'users': 'users.json',
+    'appointments': 'appointments.json',
+    'reviews': 'reviews.json',
+}
+
+ROLES = ('consumer', 'provider')
+STATUSES = ('pending', 'confirmed', 'declined', 'completed', 'expired')
+
+# Display-only fields that page handlers attach to records; never needed on disk
+DERIVED_FIELDS = {
+    'users': (),
+    'appointments': ('customer_name', 'customer_phone', 'customer_email'),
+    'reviews': ('reviewer_name', 'reviewed_name', 'appointment_type'),
+}
+
+# Default CSV columns, in order
+CSV_FIELDS = {
+    'users': ['id', 'username', 'email', 'phone', 'name', 'role', 'created_at', 'business_name',
+              'business_description', 'service_category', 'services_offered', 'address', 'availability'],
+    'appointments': ['id', 'type', 'datetime', 'duration', 'notes', 'created_at', 'user_id',
+                     'provider_id', 'status', 'completed_at'],
+    'reviews': ['id', 'appointment_id', 'reviewer_id', 'reviewed_id', 'rating', 'comment', 'created_at'],
+}
+
+# Columns that hold integers (or nothing) when read back from CSV
+INT_FIELDS = {
+    'users': ('id',),
+    'appointments': ('id', 'duration', 'user_id', 'provider_id'),
+    'reviews': ('id', 'appointment_id', 'reviewer_id', 'reviewed_id', 'rating'),
+}
+
+SECRET_FIELDS = ('password',)
+
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def hash_password(password):
+    """Hash a password using SHA-256"""
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+# Streaming JSON
+
+def iter_json_array(path, chunk_size=CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array without loading the whole file"""
+    if not os.path.exists(path):
+        return
+    decoder = json.JSONDecoder()
+    skip = WHITESPACE.match
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer:
+            return
+        if buffer[0] != '[':
+            raise ValueError(f'{path}: expected a JSON array')
+        # Records are decoded in place from position; the consumed text is only
+        # dropped when more is read, not copied away after every record
+        position = 1
+        eof = False
+        want = chunk_size
+        while True:
+            position = skip(buffer, position).end()
+            if buffer.startswith(',', position):
+                position = skip(buffer, position + 1).end()
+            if buffer.startswith(']', position):
+                return
+            try:
+                if position == len(buffer):
+                    raise json.JSONDecodeError('need more data', buffer, position)
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError(f'{path}: truncated or malformed JSON')
+                # Grow reads geometrically so a very large record is not re-parsed per chunk
+                chunk = f.read(want)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                want = max(want, len(buffer))
+                continue
+            want = chunk_size
+            yield record
+
+
+def iter_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_csv(path, store):
+    int_fields = INT_FIELDS[store]
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            record = {}
+            for key, value in row.items():
+                if key in int_fields:
+                    record[key] = int(value) if value not in ('', None) else None
+                elif value and value[0] in '[{':
+                    # Nested values (e.g. availability) are exported as JSON
+                    record[key] = json.loads(value)
+                else:
+                    record[key] = value
+            yield record
+
+
+class StoreWriter:
+    """Commits on a clean exit from a with block, aborts on an exception"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class JsonArrayWriter(StoreWriter):
+    """Write records as a JSON array to a temp file that replaces path on commit()
+
+    The default layout matches json.dump(records, f, indent=2), which is what
+    the app itself writes.
+    """
+
+    def __init__(self, path, indent=2):
+        self.path = path
+        self.indent = indent
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.',
+                                             suffix='.tmp')
+        self.file = os.fdopen(fd, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, record):
+        if self.indent is None:
+            text = json.dumps(record, separators=(',', ':'), default=str)
+            self.file.write(('[' if not self.count else ',') + text)
+        else:
+            pad = ' ' * self.indent
+            text = json.dumps(record, indent=self.indent, default=str).replace('\n', '\n' + pad)
+            self.file.write(('[\n' if not self.count else ',\n') + pad + text)
+        self.count += 1
+
+    def commit(self):
+        if not self.count:
+            self.file.write('[]')
+        elif self.indent is None:
+            self.file.write(']')
+        else:
+            self.file.write('\n]')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.tmp_path)
+
+    def size(self):
+        """Bytes written so far"""
+        self.file.flush()
+        return os.path.getsize(self.tmp_path)
+
+
+class SnapshotWriter(StoreWriter):
+    """Collect records and write them as one snapshot on commit() (snapshots cannot be appended to)"""
+
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self.records = []
+        self.count = 0
+
+    def write(self, record):
+        self.records.append(snapshot_record(self.store, record))
+        self.count += 1
+
+    def commit(self):
+        snapshot.write_snapshot(self.path, self.store, self.records)
+
+    def abort(self):
+        self.records = []
+
+    def size(self):
+        """Bytes the snapshot would take"""
+        return measured_size(self.path, lambda path: snapshot.write_snapshot(path, self.store, self.records))
+
+
+class SegmentWriter(StoreWriter):
+    """Sort appointments into their providers' segments and rewrite every segment on commit()"""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.records = {shard: [] for shard in range(segments.count)}
+        self.count = 0
+
+    def write(self, record):
+        if self.segments.extension == snapshot.EXTENSION:
+            record = snapshot_record('appointments', record)
+        self.records[self.segments.shard_of(record.get('provider_id'))].append(record)
+        self.count += 1
+
+    def commit(self):
+        # Every segment is written, so records dropped from a segment are gone from it
+        self.segments.save(self.records)
+
+    def abort(self):
+        self.records = {}
+
+    def size(self):
+        """Bytes the segments would take"""
+        return sum(measured_size(self.segments.segment_file(shard),
+                                 lambda path, segment=segment: write_store_file(path, 'appointments', segment))
+                   for shard, segment in self.records.items())
+
+
+def snapshot_record(store, record):
+    """record with its datetime fields parsed, as snapshot timestamp columns expect"""
+    for field in snapshot.DATETIME_FIELDS[store]:
+        if isinstance(record.get(field), str):
+            record[field] = datetime.fromisoformat(record[field])
+    return record
+
+
+def write_store_file(path, store, records):
+    if snapshot.is_snapshot(path):
+        snapshot.write_snapshot(path, store, records)
+    else:
+        snapshot.write_json(path, records)
+
+
+def measured_size(path, write):
+    """Bytes write(path) produces, found by writing a throwaway copy"""
+    with tempfile.TemporaryDirectory() as scratch:
+        target = os.path.join(scratch, os.path.basename(path))
+        write(target)
+        return os.path.getsize(target)
+
+
+# Store layouts
+
+class StoreFiles:
+    """Where the app keeps one store (JSON or snapshot file, or appointment segments) and its write locks"""
+
+    def __init__(self, args, store):
+        self.store = store
+        path = os.path.join(args.data_dir, STORES[store])
+        self.path = snapshot.snapshot_path(path) if args.store_format == 'snapshot' else path
+        self.segments = None
+        if store == 'appointments' and args.shards:
+            segments = shards.ShardedFiles(self.path, args.shards)
+            manifest = segments.read_manifest()
+            if manifest is not None:
+                # Keep the layout on disk; the app lays the segments out again itself
+                # when APPOINTMENT_SHARDS no longer matches it
+                segments = shards.ShardedFiles(self.path, manifest['shards'])
+            self.segments = segments
+
+    @property
+    def sharded(self):
+        return self.segments is not None and self.segments.exists()
+
+    @property
+    def source(self):
+        """The single file records are read from: before the first snapshot is written, the app reads JSON"""
+        if snapshot.is_snapshot(self.path) and not os.path.exists(self.path):
+            return snapshot.json_path(self.path)
+        return self.path
+
+    def files(self):
+        if not self.sharded:
+            return [self.source]
+        manifest = self.segments.read_manifest()
+        return [os.path.join(self.segments.directory, segment['file'])
+                for segment in manifest['segments'].values()]
+
+    def exists(self):
+        return any(os.path.exists(path) for path in self.files())
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.files() if os.path.exists(path))
+
+    def __iter__(self):
+        for path in self.files():
+            if not snapshot.is_snapshot(path):
+                yield from iter_json_array(path)
+            elif os.path.exists(path):
+                yield from snapshot.load_snapshot(path, self.store, defer_blobs=False)
+
+    @contextmanager
+    def locked(self):
+        """Hold the write locks the app takes for this store, so no worker saves over a rewrite
+
+        Those are the store file's lock and, for sharded appointments
+        (including before their first segments are written), every segment's.
+        """
+        with ExitStack() as stack:
+            stack.enter_context(FileLock(self.path + '.lock'))
+            if self.segments is not None:
+                for shard in range(self.segments.count):
+                    stack.enter_context(self.segments.lock(shard))
+            yield
+
+    def writer(self, indent=2):
+        """A writer that replaces the store with the records written to it"""
+        if self.sharded:
+            return SegmentWriter(self.segments)
+        if snapshot.is_snapshot(self.path):
+            return SnapshotWriter(self.path, self.store)
+        return JsonArrayWriter(self.path, indent=indent)
+
+
+# Validation
+
+def _require_int(record, field, allow_none=False):
+    value = record.get(field)
+    if value is None and allow_none:
+        return
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise InvalidRecord(f'{field} must be an integer')
+
+
+def _require_datetime(record, field, required=True):
+    value = record.get(field)
+    if value in (None, '') and not required:
+        return
+    try:
+        datetime.fromisoformat(str(value))
+    except ValueError:
+        raise InvalidRecord(f'{field} must be an ISO date and time')
+
+
+def validate_user(record, refs):
+    _require_int(record, 'id')
+    if not isinstance(record.get('username'), str) or not record['username'].strip():
+        raise InvalidRecord('username is required')
+    if 'plain_password' in record:
+        record['password'] = hash_password(str(record.pop('plain_password')))
+    password = record.get('password')
+    if not isinstance(password, str) or len(password) != 64:
+        raise InvalidRecord('password must be a SHA-256 hex digest (or give plain_password)')
+    if record.get('role', 'consumer') not in ROLES:
+        raise InvalidRecord(f"role must be one of: {', '.join(ROLES)}")
+    _require_datetime(record, 'created_at', required=False)
+    username = record['username'].lower()
+    if username in refs['usernames']:
+        raise InvalidRecord(f"username '{record['username']}' is already taken")
+    refs['usernames'].add(username)
+
+
+def validate_appointment(record, refs):
+    _require_int(record, 'id')
+    _require_datetime(record, 'datetime')
+    _require_datetime(record, 'created_at')
+    _require_int(record, 'duration')
+    if record['duration'] <= 0:
+        raise InvalidRecord('duration must be positive')
+    if record.get('status', 'pending') not in STATUSES:
+        raise InvalidRecord(f"status must be one of: {', '.join(STATUSES)}")
+    _require_int(record, 'user_id', allow_none=True)
+    _require_int(record, 'provider_id', allow_none=True)
+    if record.get('user_id') is not None and record['user_id'] not in refs['users']:
+        raise InvalidRecord(f"user_id {record['user_id']} does not exist")
+    if record.get('provider_id') is not None and record['provider_id'] not in refs['providers']:
+        raise InvalidRecord(f"provider_id {record['provider_id']} is not a provider")
+
+
+def validate_review(record, refs):
+    _require_int(record, 'id')
+    for field in ('appointment_id', 'reviewer_id', 'reviewed_id', 'rating'):
+        _require_int(record, field)
+    if not 1 <= record['rating'] <= 5:
+        raise InvalidRecord('rating must be between 1 and 5')
+    _require_datetime(record, 'created_at')
+    for field in ('reviewer_id', 'reviewed_id'):
+        if record[field] not in refs['users']:
+            raise InvalidRecord(f'{field} {record[field]} does not exist')
+
+
+VALIDATORS = {
+    'users': validate_user,
+    'appointments': validate_appointment,
+    'reviews': validate_review,
+}
+
+
+# Commands
+
+def load_user_refs(args):
+    """Ids of all users and of providers, streamed from the users store"""
+    users, providers = set(), set()
+    for user in StoreFiles(args, 'users'):
+        users.add(user.get('id'))
+        if user.get('role') == 'provider':
+            providers.add(user.get('id'))
+    return users, providers
+
+
+def deleted_user_ids(args):
+    """Ids of deleted accounts the app has not removed yet; their usernames are free again"""
+    import tombstones
+    return tombstones.Tombstones(os.path.join(args.data_dir, args.tombstone_file)).user_ids()
+
+
+def open_output(path):
+    if path in (None, '-'):
+        return sys.stdout
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def cmd_export(args):
+    records = iter(StoreFiles(args, args.store))
+    out = open_output(args.output)
+    secrets = () if args.include_secrets else SECRET_FIELDS
+    fields = args.fields.split(',') if args.fields else None
+    count = 0
+    try:
+        if args.format == 'csv':
+            columns = fields or CSV_FIELDS[args.store]
+            writer = csv.DictWriter(out, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            for record in records:
+                writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list))
+                                 else ('' if value is None else value)
+                                 for key, value in record.items() if key not in secrets})
+                count += 1
+        else:
+            for record in records:
+                if fields:
+                    record = {key: record.get(key) for key in fields}
+                for key in secrets:
+                    record.pop(key, None)
+                out.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f'Exported {count} {args.store}', file=sys.stderr)
+    return 0
+
+
+def cmd_import(args):
+    files = StoreFiles(args, args.store)
+    fmt = args.format
+    if fmt == 'auto':
+        fmt = 'csv' if args.file.lower().endswith('.csv') else 'jsonl'
+
+    def read_incoming():
+        return iter_csv(args.file, args.store) if fmt == 'csv' else iter_jsonl(args.file)
+
+    users, providers = load_user_refs(args)
+    refs = {'users': users, 'providers': providers, 'usernames': set()}
+    deleted = deleted_user_ids(args) if args.store == 'users' else frozenset()
+    validate = VALIDATORS[args.store]
+    allocator = ids.IdAllocator(os.path.join(args.data_dir, args.id_file))
+
+    with files.locked():
+        writer = files.writer()
+        seen_ids = set()
+        kept = imported = rejected = 0
+        try:
+            highest = 0
+            for record in files:
+                if isinstance(record.get('id'), int):
+                    highest = max(highest, record['id'])
+                if args.replace:
+                    # Replaced records' ids are still never handed out again
+                    continue
+                seen_ids.add(record.get('id'))
+                if args.store == 'users' and record.get('id') not in deleted:
+                    refs['usernames'].add(str(record.get('username', '')).lower())
+                writer.write(record)
+                kept += 1
+
+            # Records without an id get theirs from the app's sequence, reserved in one block
+            missing = sum(1 for record in read_incoming() if isinstance(record, dict) and record.get('id') is None)
+            if args.dry_run or not missing:
+                next_id = highest + 1
+            else:
+                allocator.advance(args.store, highest)
+                next_id = allocator.allocate(args.store, missing)
+
+            for line, record in enumerate(read_incoming(), 1):
+                try:
+                    if not isinstance(record, dict):
+                        raise InvalidRecord('expected an object')
+                    if record.get('id') is None:
+                        record['id'] = next_id
+                        next_id += 1
+                    validate(record, refs)
+                    if record['id'] in seen_ids:
+                        raise InvalidRecord(f"duplicate id {record['id']}")
+                except InvalidRecord as e:
+                    rejected += 1
+                    print(f'{args.file}:{line}: {e}', file=sys.stderr)
+                    if not args.skip_invalid:
+                        raise
+                    continue
+                seen_ids.add(record['id'])
+                highest = max(highest, record['id'])
+                if args.store == 'users':
+                    users.add(record['id'])
+                    if record.get('role') == 'provider':
+                        providers.add(record['id'])
+                writer.write(record)
+                imported += 1
+        except (InvalidRecord, ValueError) as e:
+            writer.abort()
+            if not isinstance(e, InvalidRecord):
+                print(f'Error: {e}', file=sys.stderr)
+            print('Import aborted, nothing was changed', file=sys.stderr)
+            return 1
+
+        if args.dry_run:
+            writer.abort()
+            print(f'Dry run: would import {imported} {args.store} ({rejected} rejected, {kept} kept)')
+        else:
+            writer.commit()
+            # Ids given in the file are taken too: the app continues after them
+            allocator.advance(args.store, highest)
+            print(f'Imported {imported} {args.store} ({rejected} rejected, {kept} kept)')
+    return 0
+
+
+def cmd_reset_password(args):
+    files = StoreFiles(args, 'users')
+    if not files.exists():
+        print(f'Error: {files.path} not found', file=sys.stderr)
+        return 1
+
+    if args.password_stdin:
+        password = sys.stdin.readline().rstrip('\n')
+    else:
+        password = getpass.getpass('New password: ')
+        if getpass.getpass('Repeat password: ') != password:
+            print('Passwords do not match', file=sys.stderr)
+            return 1
+    if not password:
+        print('Password must not be empty', file=sys.stderr)
+        return 1
+
+    deleted = deleted_user_ids(args)
+    found = False
+    with files.locked(), files.writer() as writer:
+        for user in files:
+            if user.get('username', '').lower() == args.username.lower() and user.get('id') not in deleted:
+                user['password'] = hash_password(password)
+                found = True
+            writer.write(user)
+        if not found:
+            raise LookupError(args.username)
+    print(f"Password reset for user '{args.username}'")
+    return 0
+
+
+def iter_problems(args, stores):
+    """(store, record id, problem) for duplicate ids and references to missing users"""
+    users, providers = load_user_refs(args) if set(stores) & {'appointments', 'reviews'} else (set(), set())
+    deleted = deleted_user_ids(args) if 'users' in stores else frozenset()
+    for store in stores:
+        seen = set()
+        usernames = set()
+        for record in StoreFiles(args, store):
+            record_id = record.get('id')
+            if record_id in seen:
+                yield store, record_id, f'duplicate id {record_id}'
+            seen.add(record_id)
+            if store == 'users':
+                if record_id in deleted:
+                    continue
+                username = str(record.get('username', '')).lower()
+                if username in usernames:
+                    yield store, record_id, f"duplicate username '{record.get('username')}'"
+                usernames.add(username)
+            elif store == 'appointments':
+                if record.get('user_id') is not None and record['user_id'] not in users:
+                    yield store, record_id, f"dangling user_id {record['user_id']}"
+                if record.get('provider_id') is not None and record['provider_id'] not in providers:
+                    yield store, record_id, f"dangling provider_id {record['provider_id']}"
+            elif store == 'reviews':
+                for field in ('reviewer_id', 'reviewed_id'):
+                    if record.get(field) not in users:
+                        yield store, record_id, f'dangling {field} {record.get(field)}'
+
+
+def cmd_check(args):
+    stores = list(STORES) if args.store == 'all' else [args.store]
+    problems = 0
+    for store, record_id, problem in iter_problems(args, stores):
+        print(f'{store} #{record_id}: {problem}')
+        problems += 1
+    print(f'{problems} problem(s) found' if problems else 'No problems found', file=sys.stderr)
+    return 1 if problems else 0
+
+
+def cmd_compact(args):
+    """Rewrite stores without derived fields, duplicate ids and (optionally) dangling records"""
+    stores = list(STORES) if args.store == 'all' else [args.store]
+    users, providers = load_user_refs(args)
+    for store in stores:
+        files = StoreFiles(args, store)
+        if not files.exists():
+            continue
+        with files.locked():
+            before = files.size()
+            writer = files.writer(indent=None if args.minify else 2)
+            seen = set()
+            dropped = 0
+            for record in files:
+                if record.get('id') in seen:
+                    dropped += 1
+                    continue
+                seen.add(record.get('id'))
+                if args.drop_dangling and (
+                        (store == 'appointments' and (
+                            (record.get('user_id') is not None and record['user_id'] not in users)
+                            or (record.get('provider_id') is not None and record['provider_id'] not in providers)))
+                        or (store == 'reviews' and (
+                            record.get('reviewer_id') not in users or record.get('reviewed_id') not in users))):
+                    dropped += 1
+                    continue
+                for field in DERIVED_FIELDS[store]:
+                    record.pop(field, None)
+                writer.write(record)
+            if args.dry_run:
+                after = writer.size()
+                writer.abort()
+            else:
+                writer.commit()
+                after = files.size()
+        print(f"{store}: {writer.count} kept, {dropped} dropped, {before} -> {after} bytes"
+              f"{' (dry run)' if args.dry_run else ''}")
+    return 0
+
+
+def cmd_thumbnails(args):
+    """Render variants for profile and gallery images uploaded before variants existed"""
+    import images
+    media = images.ImageVariants(args.media_dir)
+    if not media.enabled:
+        print('Pillow is not installed (pip install Pillow)', file=sys.stderr)
+        return 1
+    
+    def variants_of(data_uri):
+        data, extension = images.decode_data_uri(data_uri)
+        if data is None:
+            return None
+        if args.dry_run:
+            return 'dry-run'
+        digest = media.store(data, extension, background=False)
+        return digest if media.render(digest) else None
+    
+    files = StoreFiles(args, 'users')
+    rendered = 0
+    with files.locked():
+        writer = files.writer()
+        for user in files:
+            if user.get('profile_picture') and not user.get('profile_picture_media'):
+                user['profile_picture_media'] = variants_of(user['profile_picture']) or ''
+                rendered += bool(user['profile_picture_media'])
+            for image in user.get('gallery') or []:
+                if image.get('data') and not image.get('media'):
+                    image['media'] = variants_of(image['data'])
+                    rendered += bool(image['media'])
+                    if not image['media']:
+                        del image['media']
+            writer.write(user)
+        if args.dry_run:
+            writer.abort()
+        else:
+            writer.commit()
+    print(f"{rendered} image(s) given variants in {args.media_dir}{' (dry run)' if args.dry_run else ''}")
+    return 0
+
+
+def cmd_deletions(args):
+    """Report deleted accounts whose data the app's compactor has not finished removing"""
+    import tombstones
+    pending = tombstones.Tombstones(os.path.join(args.data_dir, args.tombstone_file)).status()
+    if not pending:
+        print('No account deletions in progress')
+        return 0
+    for user_id, state in sorted(pending.items()):
+        removed = ', '.join(f'{count} {kind}' for kind, count in state['removed'].items()) or 'nothing yet'
+        print(f"user {user_id}: deleted {state['at']}, removed so far: {removed}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Maintain the Appointment Scheduler data files')
+    parser.add_argument('--data-dir', default=os.environ.get('DATA_DIR', '.'),
+                        help='directory containing users.json, appointments.json and reviews.json')
+    parser.add_argument('--store-format', choices=('json', 'snapshot'),
+                        default=os.environ.get('STORE_FORMAT', 'json'),
+                        help="the app's STORE_FORMAT: JSON or .snap store files")
+    parser.add_argument('--shards', type=int, default=int(os.environ.get('APPOINTMENT_SHARDS', '0')),
+                        help="the app's APPOINTMENT_SHARDS (appointments in appointments.shards/)")
+    parser.add_argument('--id-file', default=os.environ.get('ID_FILE', 'ids.json'),
+                        help='the id sequences shared with the app, relative to --data-dir')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='stream a store to JSON Lines or CSV')
+    export.add_argument('store', choices=STORES)
+    export.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+    export.add_argument('-o', '--output', help='output file (default: stdout)')
+    export.add_argument('--fields', help='comma-separated fields to export')
+    export.add_argument('--include-secrets', action='store_true', help='include password hashes')
+    export.set_defaults(func=cmd_export)
+
+    importer = commands.add_parser('import', help='validate and append records from JSON Lines or CSV')
+    importer.add_argument('store', choices=STORES)
+    importer.add_argument('file')
+    importer.add_argument('--format', choices=('auto', 'jsonl', 'csv'), default='auto')
+    importer.add_argument('--replace', action='store_true', help='replace the store instead of appending')
+    importer.add_argument('--skip-invalid', action='store_true', help='skip invalid records instead of aborting')
+    importer.add_argument('--dry-run', action='store_true', help='validate only, change nothing')
+    importer.set_defaults(func=cmd_import)
+
+    reset = commands.add_parser('reset-password', help="set a user's password")
+    reset.add_argument('username')
+    reset.add_argument('--password-stdin', action='store_true', help='read the new password from stdin')
+    reset.set_defaults(func=cmd_reset_password)
+
+    check = commands.add_parser('check', help='report duplicate ids and dangling references')
+    check.add_argument('store', nargs='?', choices=list(STORES) + ['all'], default='all')
+    check.set_defaults(func=cmd_check)
+
+    compact = commands.add_parser('compact', help='drop derived fields and duplicate records')
+    compact.add_argument('store', nargs='?', choices=list(STORES) + ['all'], default='all')
+    compact.add_argument('--drop-dangling', action='store_true',
+                         help='also drop appointments and reviews that reference missing users')
+    compact.add_argument('--minify', action='store_true', help='write without indentation')
+    compact.add_argument('--dry-run', action='store_true', help='report only, change nothing')
+    compact.set_defaults(func=cmd_compact)
+
+    thumbnails = commands.add_parser('thumbnails', help='render downscaled variants of existing uploaded images')
+    thumbnails.add_argument('--media-dir', default=os.environ.get('MEDIA_DIR', 'media'),
+                            help='where the app keeps image variants')
+    thumbnails.add_argument('--dry-run', action='store_true', help='report only, change nothing')
+    thumbnails.set_defaults(func=cmd_thumbnails)
+
+    deletions = commands.add_parser('deletions', help='show account deletions still being removed')
+    deletions.set_defaults(func=cmd_deletions)
+
+    # Deleted accounts awaiting removal no longer hold their usernames
+    for command in (importer, reset, check, deletions):
+        command.add_argument('--tombstone-file', default=os.environ.get('TOMBSTONE_FILE', 'tombstones.jsonl'),
+                             help='the deletion log, relative to --data-dir')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except LookupError as e:
+        print(f"User '{e.args[0]}' not found", file=sys.stderr)
+        return 1
+    except (OSError, ValueError) as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
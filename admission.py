@@ -0,0 +1,159 @@
+"""
+Admission control: per-client rate limits and a concurrency cap
+
+Every request falls into a route class (``auth`` for login and sign-up
+posts, ``write`` for other state-changing requests, ``read`` for the rest),
+and each class has a token bucket per client IP and per logged-in user.
+A client over its budget gets 429 with Retry-After straight away, before
+any store is touched. Expensive routes share a global cap on concurrent
+requests, and anything over it is shed with 503 rather than queued.
+
+Buckets live in a bounded LRU table per worker process.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+ROUTE_CLASSES = ('auth', 'write', 'read')
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def parse_limit(value):
+    """'30/60' -> (30 requests, per 60 seconds); None when the limit is off ('', '0' or 'off')"""
+    if not value or value in ('0', 'off'):
+        return None
+    count, _, period = str(value).partition('/')
+    count, period = int(count), float(period or 1)
+    if count <= 0 or period <= 0:
+        return None
+    return count, period
+
+
+class TokenBuckets:
+    """Token buckets by key, least recently used dropped beyond max_keys
+
+    A dropped bucket comes back full, which only ever errs on the client's side.
+    """
+
+    def __init__(self, max_keys=10000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()  # key -> [tokens, last refill time]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, burst, period):
+        """Spend one token; returns 0 if allowed, else seconds until a token is available"""
+        rate = burst / period
+        with self._lock:
+            now = self.clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+
+class ConcurrencyLimit:
+    """Non-blocking cap on requests in flight"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+class AdmissionControl:
+    """Decides, per request, whether to serve it or shed it"""
+
+    def __init__(self, limits, max_concurrent=0, max_clients=10000, clock=time.monotonic):
+        self.limits = {name: parse_limit(value) for name, value in limits.items()}
+        self.buckets = TokenBuckets(max_clients, clock)
+        self.expensive = ConcurrencyLimit(max_concurrent) if max_concurrent > 0 else None
+
+    def check_rate(self, route_class, ip, user_id=None):
+        """0 when admitted, else the Retry-After in seconds (both the IP and the user must have budget)"""
+        limit = self.limits.get(route_class)
+        if limit is None:
+            return 0
+        wait = self.buckets.take(('ip', route_class, ip), *limit)
+        if not wait and user_id is not None:
+            wait = self.buckets.take(('user', route_class, user_id), *limit)
+        return wait
+
+
+def configure(app):
+    """(Re)build the app's admission control from its current RATE_LIMIT_* settings"""
+    control = AdmissionControl(
+        {name: app.config.get(f'RATE_LIMIT_{name.upper()}') for name in ROUTE_CLASSES},
+        max_concurrent=app.config.get('MAX_EXPENSIVE_REQUESTS', 0),
+        max_clients=app.config.get('RATE_LIMIT_MAX_CLIENTS', 10000))
+    app.extensions['admission'] = control
+    return control
+
+
+def init_app(app, auth_endpoints=(), expensive_endpoints=(), exempt_endpoints=('static',)):
+    """Install admission control on a Flask app from its RATE_LIMIT_* settings"""
+    from flask import g, jsonify, request, session
+
+    auth_endpoints = frozenset(auth_endpoints)
+    expensive_endpoints = frozenset(expensive_endpoints)
+    exempt_endpoints = frozenset(exempt_endpoints)
+
+    def shed(status, message, retry_after):
+        response = jsonify({'success': False, 'error': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    @app.before_request
+    def _admit_request():
+        if not app.config.get('RATE_LIMITS_ENABLED', True) or request.endpoint in exempt_endpoints:
+            return None
+        if request.method in SAFE_METHODS:
+            route_class = 'read'
+        elif request.endpoint in auth_endpoints:
+            route_class = 'auth'
+        else:
+            route_class = 'write'
+        control = app.extensions['admission']
+        retry_after = control.check_rate(route_class, request.remote_addr, session.get('user_id'))
+        if retry_after:
+            return shed(429, 'Too many requests, please slow down', retry_after)
+        if control.expensive is not None and request.endpoint in expensive_endpoints:
+            if not control.expensive.try_acquire():
+                return shed(503, 'Server is busy, please try again shortly', 1)
+            # Released to the same limiter even if the settings change meanwhile
+            g._admission_slot = control.expensive
+        return None
+
+    @app.teardown_request
+    def _release_slot(exc=None):
+        slot = g.pop('_admission_slot', None)
+        if slot is not None:
+            slot.release()
+
+    return configure(app)
@@ -0,0 +1,281 @@
+"""
+Provider utilization analytics
+
+A provider's bookings are turned into three NumPy columns (start in epoch
+seconds, duration in minutes, status code) once, and every figure on the
+analytics page is computed from those columns with vectorized operations:
+
+- a weekday x hour heatmap of booked hours against the hours the provider is
+  open (from their weekly availability),
+- confirmation / decline / expiry rates of decided requests,
+- no-shows: confirmed appointments that ended without being marked completed
+  (not tracked when the transition engine completes them automatically),
+- a week-by-week trend of bookings, booked hours and utilization.
+
+Columns and reports are cached per provider. The cache is dropped for a
+provider when the scheduler reports a change to one of their appointments,
+and the report key includes their availability and recurring series, so a
+100k-booking history is converted once and then only re-aggregated.
+"""
+
+import json
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import recurrence
+from records import STATUSES, appointment_columns, to_epoch
+
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+SECONDS_PER_WEEK = MINUTES_PER_WEEK * 60
+# 1970-01-01 was a Thursday: minute offset of the epoch within its Monday-based week
+EPOCH_WEEK_OFFSET = 3 * MINUTES_PER_DAY
+
+BOOKED_STATUSES = ('pending', 'confirmed', 'completed')
+APPROVED_STATUSES = ('confirmed', 'completed')
+DECIDED_STATUSES = ('confirmed', 'completed', 'declined', 'expired')
+
+
+def _codes(statuses):
+    return np.array([STATUSES.code(status) for status in statuses], dtype=np.int16)
+
+
+def _parse_minutes(value):
+    hours, minutes = str(value).split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def availability_minutes(availability):
+    """Open minutes per (weekday, hour) in one week, as a 7 x 24 array"""
+    minute = np.arange(MINUTES_PER_DAY)
+    open_minutes = np.zeros((7, MINUTES_PER_DAY), dtype=bool)
+    for day, name in enumerate(DAYS):
+        hours = (availability or {}).get(name) or {}
+        if not hours.get('enabled'):
+            continue
+        try:
+            start, end = _parse_minutes(hours.get('start')), _parse_minutes(hours.get('end'))
+        except (TypeError, ValueError):
+            continue
+        open_minutes[day] = (minute >= start) & (minute < end)
+    return open_minutes.reshape(7, 24, 60).sum(axis=2)
+
+
+def booked_minutes(starts, durations):
+    """Booked minutes per (weekday, hour) for bookings starting at epoch seconds, as a 7 x 24 array
+
+    Each booking adds +1 at its first minute of the week and -1 after its
+    last one; a cumulative sum then gives the number of bookings running in
+    every minute of the week. Bookings that run past Sunday midnight spill
+    into a second week, which is folded back onto the first.
+    """
+    first = (starts // 60 + EPOCH_WEEK_OFFSET) % MINUTES_PER_WEEK
+    last = first + np.clip(durations, 0, MINUTES_PER_WEEK)
+    size = 2 * MINUTES_PER_WEEK + 1
+    running = np.cumsum(np.bincount(first, minlength=size) - np.bincount(last, minlength=size))
+    running = running[:MINUTES_PER_WEEK] + running[MINUTES_PER_WEEK:2 * MINUTES_PER_WEEK]
+    return running.reshape(7, 24, 60).sum(axis=2)
+
+
+def _ratio(numerator, denominator, digits=3):
+    """numerator / denominator rounded (elementwise for arrays), None where the denominator is zero"""
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.where(denominator > 0, np.round(numerator / denominator, digits), np.nan)
+    return _none_for_nan(values.tolist())
+
+
+def _none_for_nan(value):
+    if isinstance(value, list):
+        return [_none_for_nan(item) for item in value]
+    return None if value != value else value
+
+
+def week_start(moment):
+    """Monday 00:00 of the week containing moment"""
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday())
+
+
+class ProviderColumns:
+    """One provider's bookings as start-ordered NumPy columns"""
+
+    def __init__(self, appointments):
+        starts, durations, statuses = appointment_columns(appointments)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.durations = np.array(durations, dtype=np.int64)
+        self.statuses = np.array(statuses, dtype=np.int16)
+        if np.any(self.starts[1:] < self.starts[:-1]):
+            order = np.argsort(self.starts, kind='stable')
+            self.starts, self.durations, self.statuses = \
+                self.starts[order], self.durations[order], self.statuses[order]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def window(self, start, end):
+        """Slice of the columns for bookings starting in [start, end) epoch seconds"""
+        lo, hi = np.searchsorted(self.starts, [start, end])
+        return self.starts[lo:hi], self.durations[lo:hi], self.statuses[lo:hi]
+
+
+class ProviderAnalytics:
+    """Cached utilization reports; register as a scheduler listener to keep the cache current"""
+
+    def __init__(self, scheduler, get_user, auto_complete=False):
+        self.scheduler = scheduler
+        self.get_user = get_user
+        # Past confirmed appointments are completed automatically, so a no-show cannot be told apart
+        self.auto_complete = auto_complete
+        self._columns = {}  # provider id -> ProviderColumns
+        self._reports = {}  # provider id -> {report key: report}
+        self._lock = threading.Lock()
+        self._generation = 0  # bumped on every invalidation, so in-flight builds are not cached
+        self.builds = 0
+
+    def __call__(self, event, appointment, previous_status=None):
+        if event == 'reloaded':
+            self.clear()
+        elif appointment is not None:
+            self.invalidate(appointment.get('provider_id'))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._columns.clear()
+            self._reports.clear()
+
+    def invalidate(self, provider_id):
+        with self._lock:
+            self._generation += 1
+            self._columns.pop(provider_id, None)
+            self._reports.pop(provider_id, None)
+
+    def columns(self, provider_id):
+        with self._lock:
+            columns = self._columns.get(provider_id)
+            generation = self._generation
+        if columns is None:
+            columns = ProviderColumns(self.scheduler.get_provider_appointments(provider_id))
+            with self._lock:
+                self.builds += 1
+                if generation == self._generation:
+                    self._columns[provider_id] = columns
+        return columns
+
+    def report(self, provider_id, weeks=12, now=None):
+        """Analytics for the `weeks` whole weeks ending with the current one
+
+        Figures are as of the start of the current hour, so a report can be
+        served from the cache for up to an hour when nothing changes.
+        """
+        as_of = (now or datetime.now()).replace(minute=0, second=0, microsecond=0)
+        provider = self.get_user(provider_id) or {}
+        availability = provider.get('availability') or {}
+        series = [s for s in self.scheduler.get_provider_series(provider_id)
+                  if s['status'] in recurrence.ACTIVE_STATUSES]
+        key = (weeks, as_of, json.dumps(availability, sort_keys=True),
+               tuple((s['id'], s['status'], len(s.get('exceptions', []))) for s in series))
+        with self._lock:
+            cached = self._reports.get(provider_id, {}).get(key)
+            generation = self._generation
+        if cached is not None:
+            return cached
+
+        report = self._build_report(provider_id, weeks, as_of, availability, series)
+        with self._lock:
+            if generation == self._generation:
+                # Older keys (previous hour, old availability) are never asked for again
+                self._reports[provider_id] = {key: report}
+        return report
+
+    def _build_report(self, provider_id, weeks, as_of, availability, series):
+        window_end = week_start(as_of) + timedelta(weeks=1)
+        window_start = window_end - timedelta(weeks=weeks)
+        start_s, end_s, as_of_s = to_epoch(window_start), to_epoch(window_end), to_epoch(as_of)
+        starts, durations, statuses = self.columns(provider_id).window(start_s, end_s)
+
+        # Recurring bookings occupy time but are not individual requests
+        occurrences = np.array([(to_epoch(start), s['duration']) for s in series
+                                for start in recurrence.iter_occurrence_starts(s, window_start, window_end)],
+                               dtype=np.int64).reshape(-1, 2)
+        # An occurrence that starts before the window and runs into it only counts from the window start
+        clipped = np.maximum(occurrences[:, 0], start_s)
+        occurrences[:, 1] -= (clipped - occurrences[:, 0]) // 60
+        occurrences[:, 0] = clipped
+
+        booked = np.isin(statuses, _codes(BOOKED_STATUSES))
+        busy_starts = np.concatenate([starts[booked], occurrences[:, 0]])
+        busy_durations = np.concatenate([durations[booked], occurrences[:, 1]])
+
+        # Heatmap: booked vs open minutes per weekday and hour over the whole window
+        booked_grid = booked_minutes(busy_starts, busy_durations)
+        open_grid = availability_minutes(availability) * weeks
+        open_week = int(open_grid.sum()) // weeks
+
+        # Request outcomes
+        counts = np.bincount(statuses, minlength=len(STATUSES.values))
+        count = {status: int(counts[STATUSES.code(status)]) for status in STATUSES.values}
+        decided = sum(count[status] for status in DECIDED_STATUSES)
+        approved = sum(count[status] for status in APPROVED_STATUSES)
+
+        # No-shows: confirmed appointments that ended before as_of without being marked completed
+        no_show = (statuses == STATUSES.code('confirmed')) & (starts + durations * 60 <= as_of_s)
+        if self.auto_complete:
+            no_show[:] = False
+        no_shows = int(no_show.sum())
+
+        # Week-by-week trend (bookings are attributed to the week they start in)
+        week = (starts - start_s) // SECONDS_PER_WEEK
+        busy_week = (busy_starts - start_s) // SECONDS_PER_WEEK
+        requests = np.bincount(week, minlength=weeks)
+        approved_week = np.bincount(week, weights=np.isin(statuses, _codes(APPROVED_STATUSES)), minlength=weeks)
+        decided_week = np.bincount(week, weights=np.isin(statuses, _codes(DECIDED_STATUSES)), minlength=weeks)
+        booked_week = np.bincount(busy_week, weights=busy_durations, minlength=weeks)
+        trend = [{
+            'week_start': (window_start + timedelta(weeks=index)).strftime('%Y-%m-%d'),
+            'requests': int(requests[index]),
+            'booked_hours': round(float(booked_week[index]) / 60, 1),
+            'utilization': _ratio(booked_week[index], open_week),
+            'confirm_rate': _ratio(approved_week[index], decided_week[index]),
+        } for index in range(weeks)]
+
+        return {
+            'provider_id': provider_id,
+            'weeks': weeks,
+            'as_of': as_of.isoformat(),
+            'window': {'start': window_start.isoformat(), 'end': window_end.isoformat()},
+            'totals': {
+                'requests': int(len(starts)),
+                'recurring_occurrences': len(occurrences),
+                'booked_hours': round(float(booked_grid.sum()) / 60, 1),
+                'open_hours': round(float(open_grid.sum()) / 60, 1),
+                'utilization': _ratio(booked_grid.sum(), open_grid.sum()),
+            },
+            'heatmap': {
+                'days': list(DAYS),
+                'hours': list(range(24)),
+                'booked_hours': np.round(booked_grid / 60, 2).tolist(),
+                'open_hours': np.round(open_grid / 60, 2).tolist(),
+                'utilization': _ratio(booked_grid, open_grid),
+            },
+            'rates': {
+                'status_counts': count,
+                'decided': decided,
+                'confirm_rate': _ratio(approved, decided),
+                'decline_rate': _ratio(count['declined'], decided),
+                'expiry_rate': _ratio(count['expired'], decided),
+            },
+            'no_shows': {
+                'tracked': not self.auto_complete,
+                'count': None if self.auto_complete else no_shows,
+                'hours': round(float(durations[no_show].sum()) / 60, 1),
+                'rate': None if self.auto_complete else _ratio(no_shows, no_shows + count['completed']),
+            },
+            'trend': trend,
+        }
@@ -1,12 +1,60 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, make_response, Response, send_file
+from flask.json.provider import DefaultJSONProvider
+from markupsafe import Markup
 import json
 import os
 import hashlib
+import heapq
+import hmac
+import itertools
 import base64
+import secrets
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
 
+import admission
+import analytics
+import bulk
+import changes
+import facets
+import ical
+import idempotency
+import images
+import ids
+import lazy
+import locks
+import metrics
+import notifications
+import profiler
+import records
+import recurrence
+import search
+import shards
+import snapshot
+import sse
+import tombstones
+import transitions
+import versions
+from records import Appointment, Review
+from timeline import Timeline, sort_key
+
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """jsonify/tojson support for the slotted appointment and review records"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, records.Record):
+            return dict(o)
+        return DefaultJSONProvider.default(o)
+
+
 app = Flask(__name__)
+app.json = RecordJSONProvider(app)
 # Use a consistent secret key to prevent session loss on app restart
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production-12345678')
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max file size
@@ -16,6 +64,124 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)  # Session lasts 7 days
 
+# Prometheus scrape token for /metrics (see metrics.py); the endpoint answers 404 until it is set
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+
+# Opt-in request profiling (see profiler.py); disabled unless a token or sample rate is set
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN', '')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', '50'))
+
+# Set by serve.py when several worker processes share the data files
+app.config['SHARED_STORES'] = False
+
+# 'json' (default) or 'snapshot': compact, checksummed binary store files whose images
+# load only when read (see snapshot.py)
+app.config['STORE_FORMAT'] = os.environ.get('STORE_FORMAT', 'json')
+
+# Appointment storage layout (see shards.py): 0 keeps every booking in APPOINTMENTS_FILE;
+# N splits them into N segments by provider, so a change rewrites only its provider's segment
+app.config['APPOINTMENT_SHARDS'] = int(os.environ.get('APPOINTMENT_SHARDS', '0'))
+
+# Data files, relative to DATA_DIR. Stores load on first use, so these can be
+# changed with create_app() until then
+app.config['DATA_DIR'] = os.environ.get('DATA_DIR', '.')
+app.config['USERS_FILE'] = os.environ.get('USERS_FILE', 'users.json')
+app.config['APPOINTMENTS_FILE'] = os.environ.get('APPOINTMENTS_FILE', 'appointments.json')
+app.config['REVIEWS_FILE'] = os.environ.get('REVIEWS_FILE', 'reviews.json')
+
+# Persisted id sequences shared by all stores (see ids.py)
+app.config['ID_FILE'] = os.environ.get('ID_FILE', 'ids.json')
+
+# Account deletion (see tombstones.py): the tombstone log under DATA_DIR, and how many
+# records the background compactor removes per batch
+app.config['TOMBSTONE_FILE'] = os.environ.get('TOMBSTONE_FILE', 'tombstones.jsonl')
+app.config['COMPACTION_ENABLED'] = os.environ.get('COMPACTION_ENABLED', '1') == '1'
+app.config['COMPACT_BATCH_SIZE'] = int(os.environ.get('COMPACT_BATCH_SIZE', '200'))
+
+# Change-data capture (see changes.py): every store change as a sequenced event in a bounded
+# log under DATA_DIR, read through the Python API or /api/changes (only with CHANGES_TOKEN set)
+app.config['CHANGES_ENABLED'] = os.environ.get('CHANGES_ENABLED', '1') == '1'
+app.config['CHANGES_FILE'] = os.environ.get('CHANGES_FILE', 'changes.jsonl')
+app.config['CHANGES_MAX_EVENTS'] = int(os.environ.get('CHANGES_MAX_EVENTS', '100000'))
+app.config['CHANGES_TOKEN'] = os.environ.get('CHANGES_TOKEN', '')
+app.config['CHANGES_MAX_BATCH'] = int(os.environ.get('CHANGES_MAX_BATCH', '1000'))
+app.config['CHANGES_MAX_WAIT_SECONDS'] = float(os.environ.get('CHANGES_MAX_WAIT_SECONDS', '25'))
+
+# Booking notifications and reminders (see notifications.py)
+app.config['NOTIFICATIONS_ENABLED'] = os.environ.get('NOTIFICATIONS_ENABLED', '1') == '1'
+app.config['NOTIFICATIONS_OUTBOX'] = os.environ.get('NOTIFICATIONS_OUTBOX', 'outbox.jsonl')
+app.config['NOTIFICATIONS_TRANSPORT'] = os.environ.get('NOTIFICATIONS_TRANSPORT', 'file')  # 'file' or 'smtp'
+app.config['NOTIFICATIONS_MAIL_DIR'] = os.environ.get('NOTIFICATIONS_MAIL_DIR', 'mail')
+app.config['REMINDER_LEAD_HOURS'] = float(os.environ.get('REMINDER_LEAD_HOURS', '24'))
+app.config['MAIL_SENDER'] = os.environ.get('MAIL_SENDER', 'no-reply@localhost')
+app.config['SMTP_HOST'] = os.environ.get('SMTP_HOST', 'localhost')
+app.config['SMTP_PORT'] = int(os.environ.get('SMTP_PORT', '25'))
+app.config['SMTP_USERNAME'] = os.environ.get('SMTP_USERNAME', '')
+app.config['SMTP_PASSWORD'] = os.environ.get('SMTP_PASSWORD', '')
+app.config['SMTP_USE_TLS'] = os.environ.get('SMTP_USE_TLS', '0') == '1'
+
+# Automatic status transitions (see transitions.py)
+app.config['TRANSITIONS_ENABLED'] = os.environ.get('TRANSITIONS_ENABLED', '1') == '1'
+app.config['PENDING_EXPIRY_GRACE_MINUTES'] = int(os.environ.get('PENDING_EXPIRY_GRACE_MINUTES', '0'))
+app.config['AUTO_COMPLETE_APPOINTMENTS'] = os.environ.get('AUTO_COMPLETE_APPOINTMENTS', '0') == '1'
+
+# How far ahead recurring bookings are expanded on listing pages
+app.config['SERIES_LISTING_WEEKS'] = int(os.environ.get('SERIES_LISTING_WEEKS', '8'))
+
+# Appointment listings (history, my appointments): page size, and the largest page a client may ask for
+app.config['APPOINTMENTS_PER_PAGE'] = int(os.environ.get('APPOINTMENTS_PER_PAGE', '25'))
+app.config['APPOINTMENTS_MAX_PER_PAGE'] = int(os.environ.get('APPOINTMENTS_MAX_PER_PAGE', '100'))
+
+# Calendar feeds (.ics): how far back and ahead of today they reach
+app.config['CALENDAR_PAST_DAYS'] = int(os.environ.get('CALENDAR_PAST_DAYS', '90'))
+app.config['CALENDAR_FUTURE_DAYS'] = int(os.environ.get('CALENDAR_FUTURE_DAYS', '365'))
+
+# Bulk appointment operations
+app.config['BULK_MAX_OPERATIONS'] = int(os.environ.get('BULK_MAX_OPERATIONS', '500'))
+
+# Provider listings: page size, and the largest page a client may ask for
+app.config['PROVIDERS_PER_PAGE'] = int(os.environ.get('PROVIDERS_PER_PAGE', '12'))
+app.config['PROVIDERS_MAX_PER_PAGE'] = int(os.environ.get('PROVIDERS_MAX_PER_PAGE', '48'))
+
+# Idempotency-Key replays: where outcomes are kept (under DATA_DIR, shared by worker
+# processes), how many keys are remembered, and for how long
+app.config['IDEMPOTENCY_DIR'] = os.environ.get('IDEMPOTENCY_DIR', 'idempotency')
+app.config['IDEMPOTENCY_MAX_KEYS'] = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', '10000'))
+app.config['IDEMPOTENCY_TTL_SECONDS'] = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+
+# Admission control: requests/seconds per client IP and per user for each route class
+# ('' or 'off' disables a class), plus a cap on concurrent expensive requests per worker
+app.config['RATE_LIMITS_ENABLED'] = os.environ.get('RATE_LIMITS_ENABLED', '1') == '1'
+app.config['RATE_LIMIT_AUTH'] = os.environ.get('RATE_LIMIT_AUTH', '10/60')
+app.config['RATE_LIMIT_WRITE'] = os.environ.get('RATE_LIMIT_WRITE', '60/60')
+app.config['RATE_LIMIT_READ'] = os.environ.get('RATE_LIMIT_READ', '600/60')
+app.config['RATE_LIMIT_MAX_CLIENTS'] = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', '10000'))
+app.config['MAX_EXPENSIVE_REQUESTS'] = int(os.environ.get('MAX_EXPENSIVE_REQUESTS', '16'))
+
+# Live provider dashboard (server-sent events): heartbeat interval, events kept per
+# provider for Last-Event-ID resume, and idle connections held per worker; with several
+# workers, events travel between them through a shared log (in DATA_DIR)
+app.config['SSE_HEARTBEAT_SECONDS'] = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+app.config['SSE_BUFFER_EVENTS'] = int(os.environ.get('SSE_BUFFER_EVENTS', '256'))
+app.config['SSE_MAX_CONNECTIONS'] = int(os.environ.get('SSE_MAX_CONNECTIONS', '1000'))
+app.config['SSE_EVENTS_FILE'] = os.environ.get('SSE_EVENTS_FILE', 'live_events.jsonl')
+app.config['SSE_LOG_EVENTS'] = int(os.environ.get('SSE_LOG_EVENTS', '10000'))
+
+# Uploaded images: originals and their downscaled variants (images.py), rendered by a
+# small background pool with a bounded queue
+app.config['MEDIA_DIR'] = os.environ.get('MEDIA_DIR', 'media')
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', '2'))
+app.config['IMAGE_QUEUE'] = int(os.environ.get('IMAGE_QUEUE', '64'))
+
+# Provider search: most results per /api/search request
+app.config['SEARCH_MAX_RESULTS'] = int(os.environ.get('SEARCH_MAX_RESULTS', '50'))
+
+# Provider analytics: default and maximum number of weeks in a report
+app.config['ANALYTICS_WEEKS'] = int(os.environ.get('ANALYTICS_WEEKS', '12'))
+app.config['ANALYTICS_MAX_WEEKS'] = int(os.environ.get('ANALYTICS_MAX_WEEKS', '104'))
+
 # Simple authentication decorator
 def login_required(f):
     @wraps(f)
@@ -26,35 +192,242 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+idempotency_cache = lazy.LazyStore('idempotency', lambda: idempotency.IdempotencyCache(
+    data_path(app.config['IDEMPOTENCY_DIR']),
+    app.config['IDEMPOTENCY_MAX_KEYS'], app.config['IDEMPOTENCY_TTL_SECONDS']))
+
+# Hidden form field value; a retried submission of the same rendered form sends the same key
+app.jinja_env.globals['new_idempotency_key'] = lambda: uuid.uuid4().hex
+
+image_variants = lazy.LazyStore('images', lambda: images.ImageVariants(
+    data_path(app.config['MEDIA_DIR']), workers=app.config['IMAGE_WORKERS'], max_pending=app.config['IMAGE_QUEUE']))
+
+def image_attrs(media, fallback='', variant='card', sizes='100vw'):
+    """src/srcset/sizes attributes for an uploaded image; a bare src for images without variants"""
+    if not media:
+        return Markup('src="%s"') % fallback
+    srcset = ', '.join(f"{url_for('media_file', digest=media, variant=name)} {width}w"
+                       for name, width in images.VARIANTS.items())
+    return Markup('src="%s" srcset="%s" sizes="%s"') % (
+        url_for('media_file', digest=media, variant=variant), srcset, sizes)
+
+app.jinja_env.globals['image_attrs'] = image_attrs
+
+def idempotent(f):
+    """Replay the first response to a POST whose Idempotency-Key (header or form field) was seen before"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+        if request.method != 'POST' or not key or 'user_id' not in session:
+            return f(*args, **kwargs)
+        
+        # Keys are scoped to the user and endpoint, so one client cannot replay another's response
+        scope = (session['user_id'], request.endpoint, key)
+        fingerprint = idempotency.fingerprint(request.method, request.path, request.form.items(multi=True),
+                                              request.get_json(silent=True))
+        state, outcome = idempotency_cache.claim(scope, fingerprint)
+        if state == idempotency.REPLAY:
+            for category, message in outcome.flashes:
+                flash(message, category)
+            return make_response(outcome.body, outcome.status, outcome.headers)
+        if state == idempotency.MISMATCH:
+            return jsonify({'success': False, 'error': 'Idempotency-Key was already used for a different request'}), 422
+        if state == idempotency.BUSY:
+            return jsonify({'success': False, 'error': 'A request with this Idempotency-Key is still in progress'}), 409
+        
+        flashed = len(session.get('_flashes', []))
+        try:
+            response = make_response(f(*args, **kwargs))
+        except BaseException:
+            idempotency_cache.release(scope)
+            raise
+        if response.status_code >= 500:
+            # Server errors are worth retrying for real
+            idempotency_cache.release(scope)
+            return response
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name.lower() not in ('set-cookie', 'content-length')]
+        idempotency_cache.complete(scope, idempotency.Outcome(
+            response.get_data(), response.status_code, headers, session.get('_flashes', [])[flashed:]))
+        return response
+    return decorated_function
+
+def write_json_atomic(path, data, **kwargs):
+    """Write JSON to a temp file and rename it over path, so readers never see a partial file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, **kwargs)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def data_path(filename):
+    """Path of a data file or directory under DATA_DIR (an absolute filename is kept as it is)"""
+    return os.path.join(app.config['DATA_DIR'], filename)
+
+def store_file(filename):
+    """Path of a store file under DATA_DIR, in the configured STORE_FORMAT"""
+    filename = data_path(filename)
+    if app.config['STORE_FORMAT'] == 'snapshot':
+        return snapshot.snapshot_path(filename)
+    return filename
+
+def file_signature(path):
+    """Identify the current on-disk version of a data file (None if missing)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def hidden_user_ids(deleted_users):
+    """Ids of deleted accounts whose data is still on disk (see tombstones.py)"""
+    return deleted_users.user_ids() if deleted_users is not None else frozenset()
+
+# Reported as changed, but without their values: secrets, and image data too large for the log
+CHANGE_OMITTED_FIELDS = ('password', 'calendar_token', 'profile_picture', 'gallery')
+
+def change_value(value):
+    """A field value as change events carry it: datetimes in ISO format, like users' created_at"""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def change_fields(record, names=None):
+    """{field: value} of a record (or just the named fields) for a change event"""
+    names = list(record.keys()) if names is None else names
+    return {name: None if name in CHANGE_OMITTED_FIELDS else change_value(record.get(name)) for name in names}
+
+def changed_names(before, record):
+    """Fields of record that differ from before, a dict(dict.items(record)) copy (pending snapshot blobs stay unread)"""
+    return [key for key, value in dict.items(record) if key not in before or before[key] != value]
+
+def log_changes(change_log, events):
+    """Append (entity, id, op, fields) events to a store's change log; a no-op without one"""
+    if change_log is None or not events:
+        return
+    try:
+        change_log.append_many(events)
+    except Exception:
+        # The change itself is saved; a log that cannot be written must not turn it into an error
+        app.logger.exception('Could not log %d store changes', len(events))
+
 # Simple User Manager
 class SimpleUserManager:
-    def __init__(self, users_file: str = "users.json"):
+    def __init__(self, users_file: str = "users.json", id_allocator=None, deleted_users=None, change_log=None):
         self.users_file = users_file
+        self.ids = id_allocator or ids.IdAllocator(app.config['ID_FILE'])
+        self.deleted_users = deleted_users
+        self.change_log = change_log
+        self._signature = None
+        self._dirty = False
+        self.listeners = []
+        # Guards the users list; held only for in-memory changes, not for file writes
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        # Held by a writer (in any worker process) from reading the file through saving it
+        self._write_lock = locks.FileLock(users_file + '.lock')
         self.users = self.load_users()
+        self._observe_ids()
     
+    @metrics.timed('users', 'load')
     def load_users(self):
-        if os.path.exists(self.users_file):
+        self._signature = file_signature(self.users_file)
+        if snapshot.is_snapshot(self.users_file) and os.path.exists(self.users_file):
+            # Profile pictures and galleries stay on disk until first read
+            return snapshot.load_snapshot(self.users_file, 'users')
+        # With no snapshot yet, start from the JSON file; the next save writes the snapshot
+        users_file = snapshot.json_path(self.users_file)
+        if os.path.exists(users_file):
             try:
-                with open(self.users_file, 'r') as f:
+                with open(users_file, 'r') as f:
                     return json.load(f)
             except (json.JSONDecodeError, FileNotFoundError):
                 return []
         return []
     
+    @metrics.timed('users', 'save')
     def save_users(self):
-        with open(self.users_file, 'w') as f:
-            json.dump(self.users, f, indent=2)
+        # Writes are serialized, and each one takes a fresh copy of the list, so the last write wins with the newest data
+        with self._write_lock, self._save_lock:
+            with self._lock:
+                users = list(self.users)
+            try:
+                if snapshot.is_snapshot(self.users_file):
+                    snapshot.write_snapshot(self.users_file, 'users', users)
+                else:
+                    write_json_atomic(self.users_file, users, indent=2)
+            except BaseException:
+                # Kept in memory; flush() retries it
+                self._dirty = True
+                raise
+            self._signature = file_signature(self.users_file)
+            self._dirty = False
+    
+    def refresh(self):
+        """Reload users if another process has rewritten the file"""
+        if file_signature(self.users_file) != self._signature:
+            with self._lock:
+                self.users = self.load_users()
+                self._observe_ids()
+                self._dirty = False
+            self._notify('reloaded', None)
+    
+    @contextmanager
+    def writing(self):
+        """Hold the write lock with the newest users loaded; check, change and save inside the block"""
+        with self._write_lock:
+            self.refresh()
+            yield
+    
+    def _observe_ids(self):
+        self.ids.observe('users', self.users)
+        self.ids.observe('gallery_images', [image for user in self.users for image in user.get('gallery') or []])
+    
+    def flush(self):
+        """Retry a save that failed, unless another process has rewritten the file since"""
+        if self._dirty:
+            with self._write_lock:
+                if file_signature(self.users_file) == self._signature:
+                    self.save_users()
+    
+    def add_listener(self, listener):
+        """Register listener(event, user) for 'created', 'updated', 'deleted' and 'reloaded'"""
+        self.listeners.append(listener)
+    
+    def _notify(self, event, user):
+        for listener in self.listeners:
+            try:
+                listener(event, user)
+            except Exception:
+                app.logger.exception('User listener failed for %s event', event)
     
     def hash_password(self, password):
         return hashlib.sha256(password.encode()).hexdigest()
     
     def create_user(self, username, password, email="", 
                    role="consumer", **kwargs):
-        if any(user['username'].lower() == username.lower() for user in self.users):
-            return False
-        
+        with self.writing():
+            with self._lock:
+                # The username check and the append happen under one lock, so two sign-ups cannot both take a name.
+                # Deleted accounts awaiting compaction no longer hold theirs
+                hidden = hidden_user_ids(self.deleted_users)
+                if any(user['username'].lower() == username.lower() and user['id'] not in hidden
+                       for user in self.users):
+                    return False
+                user = self._new_user(username, password, email, role, **kwargs)
+                self.users.append(user)
+            self.save_users()
+        log_changes(self.change_log, [('user', user['id'], 'created', change_fields(user))])
+        self._notify('created', user)
+        return True
+    
+    def _new_user(self, username, password, email, role, **kwargs):
         user = {
-            'id': len(self.users) + 1,
+            'id': self.ids.next('users'),
             'username': username,
             'password': self.hash_password(password),
             'email': email,
@@ -81,13 +454,13 @@ class SimpleUserManager:
                 'saturday': {'enabled': False, 'start': '09:00', 'end': '17:00'},
                 'sunday': {'enabled': False, 'start': '09:00', 'end': '17:00'}
             })
-        
-        self.users.append(user)
-        self.save_users()
-        return True
+        return user
     
+    @metrics.timed('users', 'authenticate')
     def authenticate(self, username, password):
-        user = next((u for u in self.users if u['username'].lower() == username.lower()), None)
+        hidden = hidden_user_ids(self.deleted_users)
+        user = next((u for u in self.users
+                     if u['username'].lower() == username.lower() and u['id'] not in hidden), None)
         if user and user['password'] == self.hash_password(password):
             user_data = {
                 'id': user['id'], 
@@ -96,6 +469,7 @@ class SimpleUserManager:
                 'phone': user.get('phone', ''),
                 'name': user.get('name', user['username']),
                 'profile_picture': user.get('profile_picture', ''),
+                'profile_picture_media': user.get('profile_picture_media', ''),
                 'role': user.get('role', 'consumer')
             }
             
@@ -111,7 +485,10 @@ class SimpleUserManager:
             return user_data
         return None
     
+    @metrics.timed('users', 'get_user_by_id')
     def get_user_by_id(self, user_id):
+        if user_id in hidden_user_ids(self.deleted_users):
+            return None
         user = next((u for u in self.users if u['id'] == user_id), None)
         if user:
             user_data = {
@@ -121,6 +498,8 @@ class SimpleUserManager:
                 'phone': user.get('phone', ''),
                 'name': user.get('name', user['username']),
                 'profile_picture': user.get('profile_picture', ''),
+                'profile_picture_media': user.get('profile_picture_media', ''),
+                'calendar_token': user.get('calendar_token', ''),
                 'role': user.get('role', 'consumer')
             }
             
@@ -139,10 +518,21 @@ class SimpleUserManager:
     
     def update_user(self, user_id, name=None, email=None, 
                    phone=None, profile_picture=None, **kwargs):
-        user = next((u for u in self.users if u['id'] == user_id), None)
-        if not user:
-            return False
-        
+        with self.writing():
+            with self._lock:
+                user = next((u for u in self.users if u['id'] == user_id), None)
+                if not user:
+                    return False
+                before = dict(dict.items(user))
+                self._apply_update(user, name, email, phone, profile_picture, **kwargs)
+                changed = changed_names(before, user)
+            self.save_users()
+        if changed:
+            log_changes(self.change_log, [('user', user_id, 'updated', change_fields(user, changed))])
+        self._notify('updated', user)
+        return True
+    
+    def _apply_update(self, user, name, email, phone, profile_picture, **kwargs):
         if name is not None:
             user['name'] = name
         if email is not None:
@@ -151,6 +541,8 @@ class SimpleUserManager:
             user['phone'] = phone
         if profile_picture is not None:
             user['profile_picture'] = profile_picture
+        if 'profile_picture_media' in kwargs:
+            user['profile_picture_media'] = kwargs['profile_picture_media']
         
         # Provider-specific fields
         if user.get('role') == 'provider':
@@ -164,18 +556,127 @@ class SimpleUserManager:
                 user['services_offered'] = kwargs['services_offered']
             if 'address' in kwargs:
                 user['address'] = kwargs['address']
-        
-        self.save_users()
+            if 'availability' in kwargs:
+                user['availability'] = kwargs['availability']
+    
+    def reset_calendar_token(self, user_id):
+        """Give a user a new secret for their calendar feed links (old links stop working); returns it"""
+        token = secrets.token_urlsafe(24)
+        with self.writing():
+            with self._lock:
+                user = next((u for u in self.users if u['id'] == user_id), None)
+                if not user:
+                    return None
+                user['calendar_token'] = token
+            self.save_users()
+        log_changes(self.change_log, [('user', user_id, 'updated', change_fields(user, ['calendar_token']))])
+        self._notify('updated', user)
+        return token
+    
+    def active_users(self):
+        """Every user except deleted accounts still waiting to be removed"""
+        hidden = hidden_user_ids(self.deleted_users)
+        if not hidden:
+            return self.users
+        return [user for user in self.users if user['id'] not in hidden]
+    
+    def hide_user(self, user_id):
+        """Tell listeners a tombstoned user is gone, ahead of delete_user removing the record"""
+        user = next((u for u in self.users if u['id'] == user_id), None)
+        if user:
+            self._notify('deleted', user)
+    
+    def delete_user(self, user_id):
+        """Remove a user account"""
+        with self.writing():
+            with self._lock:
+                user = next((u for u in self.users if u['id'] == user_id), None)
+                if not user:
+                    return False
+                self.users = [u for u in self.users if u['id'] != user_id]
+            self.save_users()
+        log_changes(self.change_log, [('user', user_id, 'deleted', None)])
+        self._notify('deleted', user)
+        return True
+    
+    def add_gallery_image(self, user_id, image):
+        """Append an image entry to a provider's gallery; returns it with its new id, or None"""
+        with self.writing():
+            with self._lock:
+                user = next((u for u in self.users if u['id'] == user_id), None)
+                if not user:
+                    return None
+                image = dict(image, id=self.ids.next('gallery_images'))
+                # A new list rather than an in-place append, so a concurrent save never sees it half-built
+                user['gallery'] = user.get('gallery', []) + [image]
+            self.save_users()
+        log_changes(self.change_log, [('user', user_id, 'updated', change_fields(user, ['gallery']))])
+        self._notify('updated', user)
+        return image
+    
+    def remove_gallery_image(self, user_id, image_id):
+        """Remove one image from a provider's gallery; returns False if it was not there"""
+        with self.writing():
+            with self._lock:
+                user = next((u for u in self.users if u['id'] == user_id), None)
+                gallery = (user or {}).get('gallery', [])
+                remaining = [image for image in gallery if image['id'] != image_id]
+                if not user or len(remaining) == len(gallery):
+                    return False
+                user['gallery'] = remaining
+            self.save_users()
+        log_changes(self.change_log, [('user', user_id, 'updated', change_fields(user, ['gallery']))])
+        self._notify('updated', user)
         return True
 
-# Initialize managers
-user_manager = SimpleUserManager()
+# Initialize managers (each loads its file on first use; see create_app)
+id_allocator = lazy.LazyStore('ids', lambda: ids.IdAllocator(data_path(app.config['ID_FILE'])))
+deleted_users = lazy.LazyStore('tombstones', lambda: tombstones.Tombstones(data_path(app.config['TOMBSTONE_FILE'])))
+change_log = lazy.LazyStore('changes', lambda: changes.ChangeLog(
+    data_path(app.config['CHANGES_FILE']), max_events=app.config['CHANGES_MAX_EVENTS']))
+
+def store_change_log():
+    """The change log stores write to, or None with CHANGES_ENABLED off"""
+    return change_log if app.config['CHANGES_ENABLED'] else None
+
+user_manager = lazy.LazyStore('users', lambda: SimpleUserManager(
+    store_file(app.config['USERS_FILE']), id_allocator, deleted_users, store_change_log()))
 
 
 class AppointmentScheduler:
-    def __init__(self, data_file: str = "appointments.json"):
+    # Statuses that no longer occupy a time slot
+    INACTIVE_STATUSES = ('declined', 'expired')
+    
+    def __init__(self, data_file: str = "appointments.json",
+                 series_file: str = "recurring_series.json", id_allocator=None, deleted_users=None, shard_count=0,
+                 change_log=None):
         self.data_file = data_file
+        self.series_file = series_file
+        self.ids = id_allocator or ids.IdAllocator(app.config['ID_FILE'])
+        self.deleted_users = deleted_users
+        self.change_log = change_log
+        # With shard_count, appointments live in per-provider segments next to data_file (see shards.py)
+        self.shards = shards.ShardedFiles(data_file, shard_count) if shard_count else None
+        self._dirty_shards = set()
+        self._signature = None
+        self._series_signature = None
+        self._dirty = False
+        self.listeners = []
+        # _lock guards the lists and indexes and is held only briefly. The provider locks are
+        # file locks held across check-then-book (in every worker process) so two requests
+        # cannot take the same slot; the write lock is held only while the file is saved
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._write_lock = locks.FileLock(data_file + '.lock')
+        self._series_write_lock = locks.FileLock(series_file + '.lock')
+        self._lock_directory = os.path.splitext(data_file)[0] + '.locks'
+        self._provider_locks = {}
+        self._held_providers = {}  # provider_id -> depth, while a thread here holds its lock
+        self._series_dirty = False
         self.appointments = self.load_appointments()
+        self.series = self.load_series()
+        self._rebuild_indexes()
+        self._observe_ids()
         self.appointment_types = {
             "hair": "Hair Salon",
             "nails": "Nail Salon", 
@@ -185,25 +686,329 @@ class AppointmentScheduler:
             "other": "Other"
         }
     
+    @metrics.timed('appointments', 'load')
     def load_appointments(self):
-        """Load appointments from JSON file"""
-        if os.path.exists(self.data_file):
+        """Load appointments from JSON (or snapshot) file, or from every segment when sharded"""
+        if self.shards is not None:
+            if self.shards.exists():
+                appointments, resharded = self.shards.load(record_class=Appointment)
+                if resharded:
+                    # APPOINTMENT_SHARDS changed: the next save lays every segment out again
+                    self._dirty_shards.update(range(self.shards.count))
+                return appointments
+            # First start with sharding: read the single file; the next save writes the segments
+            self._dirty_shards.update(range(self.shards.count))
+        self._signature = file_signature(self.data_file)
+        if snapshot.is_snapshot(self.data_file) and os.path.exists(self.data_file):
+            return snapshot.load_snapshot(self.data_file, 'appointments', record_class=Appointment)
+        data_file = snapshot.json_path(self.data_file)
+        if os.path.exists(data_file):
             try:
-                with open(self.data_file, 'r') as f:
+                with open(data_file, 'r') as f:
+                    # Compact records parse the datetime strings themselves
+                    return [Appointment.from_dict(apt) for apt in json.load(f)]
+            except (json.JSONDecodeError, FileNotFoundError):
+                return []
+        return []
+    
+    @metrics.timed('appointments', 'save')
+    def save_appointments(self, changed=None):
+        """Save appointments to JSON (or snapshot) file
+        
+        When sharded, only the segments holding changed (the appointments just
+        added, changed or removed; None for all) are rewritten.
+        """
+        if self.shards is not None:
+            return self._save_segments(changed)
+        with self._write_lock, self._save_lock:
+            # Another worker may have saved since we loaded: take in its changes first
+            self.refresh()
+            with self._lock:
+                appointments = list(self.appointments)
+            try:
+                if snapshot.is_snapshot(self.data_file):
+                    snapshot.write_snapshot(self.data_file, 'appointments', appointments)
+                else:
+                    write_json_atomic(self.data_file, appointments, indent=2, default=records.json_default)
+            except BaseException:
+                # Kept in memory; flush() retries it
+                self._dirty = True
+                raise
+            self._signature = file_signature(self.data_file)
+            self._dirty = False
+    
+    def _save_segments(self, changed):
+        with self._lock:
+            if changed is None:
+                self._dirty_shards.update(range(self.shards.count))
+            else:
+                self._dirty_shards.update(self.shards.shard_of(apt.get('provider_id')) for apt in changed)
+        with self._save_lock:
+            with self._lock:
+                dirty, self._dirty_shards = self._dirty_shards, set()
+            # Segments whose lock another writer holds are not waited for (that could deadlock
+            # against its own locks); they stay dirty and go out with a later save or flush
+            held = [shard for shard in sorted(dirty) if self.shards.lock(shard).acquire(blocking=False)]
+            busy = dirty.difference(held)
+            try:
+                # A segment another worker rewrote since we read it holds none of our changes
+                # (those are in segments locked since the reload): take theirs instead of overwriting it
+                stale = [shard for shard in self.shards.changed_segments() or () if shard in held]
+                if stale:
+                    with self._lock:
+                        self._reload_segments(stale)
+                with self._lock:
+                    # A segment is its providers' timelines, which already hold every status
+                    segments = {shard: [] for shard in held if shard not in stale}
+                    for provider_id, timeline in self._timelines.items():
+                        segment = segments.get(self.shards.shard_of(provider_id))
+                        if segment is not None:
+                            segment.extend(timeline)
+                self.shards.save(segments)
+            except BaseException:
+                # Written again by the next save
+                busy.update(held)
+                raise
+            finally:
+                for shard in reversed(held):
+                    self.shards.lock(shard).release()
+                if busy:
+                    with self._lock:
+                        self._dirty_shards.update(busy)
+            self._dirty = False
+        if stale:
+            self._notify('reloaded', None)
+    
+    def _reload_segments(self, changed_shards):
+        """Swap in segments another process rewrote; other providers' records and indexes stay as they are"""
+        loaded = self.shards.load_segments(changed_shards, record_class=Appointment)
+        shard_of = self.shards.shard_of
+        kept = []
+        for appointment in self.appointments:
+            if shard_of(appointment.get('provider_id')) in loaded:
+                self._unindex(appointment)
+            else:
+                kept.append(appointment)
+        for appointments in loaded.values():
+            kept.extend(appointments)
+            for appointment in appointments:
+                self._index(appointment)
+        self.appointments = kept
+    
+    def load_series(self):
+        """Load recurring series from JSON file"""
+        self._series_signature = file_signature(self.series_file)
+        if os.path.exists(self.series_file):
+            try:
+                with open(self.series_file, 'r') as f:
                     data = json.load(f)
-                    # Convert datetime strings back to datetime objects
-                    for apt in data:
-                        apt['datetime'] = datetime.fromisoformat(apt['datetime'])
-                        apt['created_at'] = datetime.fromisoformat(apt['created_at'])
+                    for series in data:
+                        series['start'] = datetime.fromisoformat(series['start'])
+                        series['created_at'] = datetime.fromisoformat(series['created_at'])
+                        if series.get('until'):
+                            series['until'] = datetime.fromisoformat(series['until'])
                     return data
             except (json.JSONDecodeError, FileNotFoundError):
                 return []
         return []
     
-    def save_appointments(self):
-        """Save appointments to JSON file"""
-        with open(self.data_file, 'w') as f:
-            json.dump(self.appointments, f, indent=2, default=str)
+    def save_series(self):
+        """Save recurring series to JSON file"""
+        with self._series_write_lock, self._save_lock:
+            with self._lock:
+                series = list(self.series)
+            try:
+                write_json_atomic(self.series_file, series, indent=2, default=str)
+            except BaseException:
+                self._series_dirty = True
+                raise
+            self._series_signature = file_signature(self.series_file)
+            self._series_dirty = False
+    
+    def _rebuild_indexes(self):
+        """Per-provider timelines and series lists used for windowed conflict checks,
+        per-customer timelines for their listings, and day buckets for date ranges"""
+        self._timelines = {}
+        self._user_timelines = {}
+        self._days = {}
+        for appointment in self.appointments:
+            self._index(appointment)
+        self._series_by_provider = {}
+        for series in self.series:
+            self._series_by_provider.setdefault(series.get('provider_id'), []).append(series)
+    
+    def _timeline(self, provider_id):
+        timeline = self._timelines.get(provider_id)
+        if timeline is None:
+            with self._lock:
+                timeline = self._timelines.setdefault(provider_id, Timeline())
+        return timeline
+    
+    def _user_timeline(self, user_id):
+        timeline = self._user_timelines.get(user_id)
+        if timeline is None:
+            with self._lock:
+                timeline = self._user_timelines.setdefault(user_id, Timeline())
+        return timeline
+    
+    def _index(self, appointment):
+        self._timeline(appointment.get('provider_id')).add(appointment)
+        self._user_timeline(appointment.get('user_id')).add(appointment)
+        self._days.setdefault(appointment['datetime'].date(), []).append(appointment)
+    
+    def _unindex(self, appointment):
+        self._timeline(appointment.get('provider_id')).remove(appointment)
+        self._user_timeline(appointment.get('user_id')).remove(appointment)
+        day = appointment['datetime'].date()
+        bucket = [apt for apt in self._days.get(day, ()) if apt is not appointment]
+        if bucket:
+            self._days[day] = bucket
+        else:
+            self._days.pop(day, None)
+    
+    def _observe_ids(self):
+        self.ids.observe('appointments', self.appointments)
+        self.ids.observe('series', self.series)
+    
+    def _provider_lock(self, provider_id):
+        lock = self._provider_locks.get(provider_id)
+        if lock is None:
+            os.makedirs(self._lock_directory, exist_ok=True)
+            with self._lock:
+                lock = self._provider_locks.setdefault(
+                    provider_id, locks.FileLock(os.path.join(self._lock_directory, f'provider-{provider_id}.lock')))
+        return lock
+    
+    def provider_lock(self, provider_id, series=False):
+        """Hold the lock of one provider's schedule (see locked_providers)"""
+        return self.locked_providers([provider_id], series=series)
+    
+    @contextmanager
+    def locked_providers(self, provider_ids, series=False):
+        """Hold the locks of several providers' schedules, with the newest data loaded
+        
+        They are file locks, so other worker processes are kept out too: a
+        check and change made inside the block cannot race another worker's,
+        while bookings with other providers go ahead in parallel. (When
+        sharded, each lock covers a whole segment.) With series the series
+        file is locked as well. Locks are always taken in the same order so
+        batches cannot deadlock, and a thread already holding them can take
+        them again.
+        """
+        if self.shards is None:
+            providers = sorted(set(provider_ids), key=repr)
+            held = [self._provider_lock(provider_id) for provider_id in providers]
+        else:
+            providers = ()
+            held = [self.shards.lock(shard) for shard in sorted({self.shards.shard_of(p) for p in provider_ids})]
+        if series:
+            held.append(self._series_write_lock)
+        for lock in held:
+            lock.acquire()
+        try:
+            self.refresh()
+            with self._lock:
+                for provider_id in providers:
+                    self._held_providers[provider_id] = self._held_providers.get(provider_id, 0) + 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    for provider_id in providers:
+                        self._held_providers[provider_id] -= 1
+                        if not self._held_providers[provider_id]:
+                            del self._held_providers[provider_id]
+        finally:
+            for lock in reversed(held):
+                lock.release()
+    
+    def _reload_appointments(self):
+        """Load the appointments another process saved, keeping ours of providers locked here
+        
+        Those may hold changes not saved yet, and no other process can have
+        changed them since the lock was taken.
+        """
+        appointments = self.load_appointments()
+        if self._held_providers:
+            appointments = [apt for apt in appointments if apt.get('provider_id') not in self._held_providers]
+            appointments.extend(apt for apt in self.appointments if apt.get('provider_id') in self._held_providers)
+        return appointments
+    
+    def _current(self, appointment):
+        """The loaded record of an appointment found before the last reload, or None if it is gone"""
+        return self.find_appointment(appointment.get('provider_id'), appointment['datetime'], appointment['id'])
+    
+    def find_appointment(self, provider_id, start, appointment_id):
+        """The loaded appointment with this provider, start time and id, or None (one bisect)"""
+        return self._timeline(provider_id).get((start, appointment_id))
+    
+    def refresh(self):
+        """Reload appointments if another process has rewritten the file (or, when sharded, some segments)"""
+        changed = rebuild = False
+        with self._lock:
+            if self.shards is None:
+                rebuild = file_signature(self.data_file) != self._signature
+            else:
+                changed_shards = self.shards.changed_segments()
+                if changed_shards is None:
+                    rebuild = True
+                elif changed_shards:
+                    self._reload_segments(changed_shards)
+                    changed = True
+            if rebuild:
+                self.appointments = self._reload_appointments()
+                self._dirty = False
+            if file_signature(self.series_file) != self._series_signature:
+                self.series = self.load_series()
+                self._series_dirty = False
+                rebuild = True
+            if rebuild:
+                self._rebuild_indexes()
+            changed = changed or rebuild
+            if changed:
+                self._observe_ids()
+        if changed:
+            self._notify('reloaded', None)
+    
+    def flush(self):
+        """Retry saves that failed, unless another process has rewritten the files since"""
+        if self._dirty or self._dirty_shards:
+            if self.shards is not None:
+                # Just the segments still waiting to be written; those another worker rewrote are reloaded instead
+                self.save_appointments(())
+            else:
+                with self._write_lock:
+                    if file_signature(self.data_file) == self._signature:
+                        self.save_appointments()
+        if self._series_dirty:
+            with self._series_write_lock:
+                if file_signature(self.series_file) == self._series_signature:
+                    self.save_series()
+    
+    def add_listener(self, listener):
+        """Register listener(event, appointment, previous_status) for appointment changes
+        
+        Recurring series report through the same listeners, with events named
+        series_created, series_status_changed and series_purged (passing the
+        series) and series_skipped (passing the skipped occurrence).
+        """
+        self.listeners.append(listener)
+    
+    def _notify(self, event, appointment, previous_status=None):
+        for listener in self.listeners:
+            try:
+                listener(event, appointment, previous_status)
+            except Exception:
+                # A failing listener must never undo or block the change itself
+                app.logger.exception('Appointment listener failed for %s event', event)
+    
+    def _visible(self, records):
+        """records without those of deleted accounts (customer or provider) still waiting to be removed"""
+        hidden = hidden_user_ids(self.deleted_users)
+        if not hidden:
+            return records
+        return [record for record in records
+                if record.get('user_id') not in hidden and record.get('provider_id') not in hidden]
     
     def add_appointment(self, appointment_type, date, time, 
                        duration, notes="", user_id=None, 
@@ -212,94 +1017,574 @@ class AppointmentScheduler:
         try:
             # Parse date and time
             appointment_datetime = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
-            
+        except ValueError:
+            return False
+        
+        with self.provider_lock(provider_id):
             # Check for conflicts
-            if self.has_conflict(appointment_datetime, duration):
+            if self.has_conflict(appointment_datetime, duration, provider_id):
                 return False
             
-            appointment = {
-                "id": len(self.appointments) + 1,
-                "type": appointment_type,
-                "datetime": appointment_datetime,
-                "duration": duration,
-                "notes": notes,
-                "created_at": datetime.now(),
-                "user_id": user_id,
-                "provider_id": provider_id,
-                "status": "pending"  # pending, confirmed, declined
-            }
+            appointment = Appointment(
+                id=self.ids.next('appointments'),
+                type=appointment_type,
+                datetime=appointment_datetime,
+                duration=duration,
+                notes=notes,
+                created_at=datetime.now(),
+                user_id=user_id,
+                provider_id=provider_id,
+                status="pending"  # pending, confirmed, declined
+            )
             
-            self.appointments.append(appointment)
-            self.save_appointments()
-            return True
-            
-        except ValueError:
-            return False
+            with self._lock:
+                self.appointments.append(appointment)
+                self._index(appointment)
+            self.save_appointments([appointment])
+        log_changes(self.change_log, [('appointment', appointment['id'], 'created', change_fields(appointment))])
+        self._notify('created', appointment)
+        return True
     
-    def has_conflict(self, appointment_datetime, duration):
+    @metrics.timed('appointments', 'has_conflict')
+    def has_conflict(self, appointment_datetime, duration, provider_id=None):
         """Check if appointment conflicts with existing ones"""
         end_time = appointment_datetime + timedelta(minutes=duration)
         
-        for existing in self.appointments:
+        if provider_id is not None:
+            # Only this provider's schedule, and only the part around the new slot
+            return any(True for _ in self.iter_busy(provider_id, appointment_datetime, end_time))
+        
+        for existing in self._visible(self.appointments):
+            # Declined and expired requests no longer hold their slot
+            if existing.get('status') in self.INACTIVE_STATUSES:
+                continue
             existing_start = existing["datetime"]
             existing_end = existing_start + timedelta(minutes=existing["duration"])
             
             # Check for overlap
             if (appointment_datetime < existing_end and end_time > existing_start):
                 return True
-        return False
+        # Recurring sessions hold their slots too
+        return any(next(recurrence.iter_occurrence_starts(series, appointment_datetime, end_time), None) is not None
+                   for series in self._visible(self.series) if series['status'] in recurrence.ACTIVE_STATUSES)
     
+    @metrics.timed('appointments', 'get_appointments')
     def get_appointments(self, date=None):
         """Get appointments, optionally filtered by date"""
         if date:
             try:
                 target_date = datetime.strptime(date, "%Y-%m-%d").date()
-                return [apt for apt in self.appointments 
-                       if apt["datetime"].date() == target_date]
             except ValueError:
                 return []
-        return sorted(self.appointments, key=lambda x: x["datetime"])
+            return self._visible(list(self._days.get(target_date, ())))
+        return sorted(self._visible(self.appointments), key=lambda x: x["datetime"])
+    
+    @metrics.timed('appointments', 'get_appointments_between')
+    def get_appointments_between(self, start, end, user_id=None, provider_id=None):
+        """Appointments (every status) starting in [start, end), by start time
+        
+        For one provider or customer this is a slice of their timeline;
+        otherwise only the day buckets from start to end are read.
+        """
+        if provider_id is not None:
+            appointments = self._timeline(provider_id).starting_between(start, end)
+            if user_id is not None:
+                appointments = [apt for apt in appointments if apt.get('user_id') == user_id]
+        elif user_id is not None:
+            appointments = self._user_timeline(user_id).starting_between(start, end)
+        else:
+            first, last = start.date(), (end - timedelta(microseconds=1)).date()
+            span = (last - first).days + 1
+            if span <= len(self._days):
+                days = (first + timedelta(days=offset) for offset in range(span))
+            else:
+                # A range wider than the number of booked days: walk the days that have bookings
+                days = sorted(day for day in list(self._days) if first <= day <= last)
+            appointments = sorted((apt for day in days for apt in self._days.get(day, ())
+                                   if start <= apt['datetime'] < end), key=sort_key)
+        return self._visible(appointments)
+    
+    def iter_busy(self, provider_id, start, end, exclude=()):
+        """(start, end) of a provider's active bookings and series occurrences overlapping [start, end), by start
+        
+        exclude holds id()s of appointments to treat as free (e.g. being cancelled).
+        """
+        hidden = hidden_user_ids(self.deleted_users)
+        booked = ((apt['datetime'], apt['datetime'] + timedelta(minutes=apt['duration']))
+                  for apt in self._timeline(provider_id).overlapping(start, end)
+                  if apt.get('status') not in self.INACTIVE_STATUSES and id(apt) not in exclude
+                  and apt.get('user_id') not in hidden)
+        streams = [booked]
+        for series in self._visible(self._series_by_provider.get(provider_id, [])):
+            if series['status'] in recurrence.ACTIVE_STATUSES:
+                duration = timedelta(minutes=series['duration'])
+                streams.append((occurrence, occurrence + duration)
+                               for occurrence in recurrence.iter_occurrence_starts(series, start, end))
+        return heapq.merge(*streams)
+    
+    def add_series(self, appointment_type, date, time, duration, frequency,
+                   count=None, until=None, notes="", user_id=None, provider_id=None,
+                   skip_conflicts=False):
+        """Add a recurring series; returns (series, conflicting occurrence dates)
+        
+        Conflicts are found with one sweep over the provider's bookings in the
+        series' whole span. With skip_conflicts, clashing dates become exceptions
+        instead of rejecting the series.
+        """
+        try:
+            start = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+        except ValueError:
+            return None, []
+        if frequency not in recurrence.FREQUENCIES or (not count and not until):
+            return None, []
+        if until is not None and until < start:
+            return None, []
+        
+        series = {
+            "id": None,
+            "type": appointment_type,
+            "start": start,
+            "duration": duration,
+            "frequency": frequency,
+            "count": count,
+            "until": until,
+            "exceptions": [],
+            "notes": notes,
+            "created_at": datetime.now(),
+            "user_id": user_id,
+            "provider_id": provider_id,
+            "status": "pending"
+        }
+        
+        span_end = recurrence.series_end(series)
+        occurrence_length = timedelta(minutes=duration)
+        candidates = [(occurrence, occurrence + occurrence_length)
+                      for occurrence in recurrence.iter_occurrence_starts(series, start, span_end)]
+        with self.provider_lock(provider_id, series=True):
+            if provider_id is not None:
+                existing = self.iter_busy(provider_id, start, span_end)
+            else:
+                existing = sorted([(apt['datetime'], apt['datetime'] + timedelta(minutes=apt['duration']))
+                                   for apt in list(self.appointments)
+                                   if apt.get('status') not in self.INACTIVE_STATUSES]
+                                  + [(occurrence, occurrence + timedelta(minutes=other['duration']))
+                                     for other in self._visible(self.series)
+                                     if other['status'] in recurrence.ACTIVE_STATUSES
+                                     for occurrence in recurrence.iter_occurrence_starts(other, start, span_end)])
+            conflicts = [occurrence.strftime('%Y-%m-%d')
+                         for occurrence, _ in recurrence.find_conflicts(candidates, existing)]
+            if conflicts and not skip_conflicts:
+                return None, conflicts
+            if len(conflicts) == len(candidates):
+                return None, conflicts
+            series['exceptions'] = conflicts
+            series['id'] = self.ids.next('series')
+            
+            with self._lock:
+                self.series.append(series)
+                self._series_by_provider.setdefault(provider_id, []).append(series)
+            self.save_series()
+        log_changes(self.change_log, [('series', series['id'], 'created', change_fields(series))])
+        self._notify('series_created', series)
+        return series, conflicts
+    
+    def get_series(self, series_id):
+        return next((s for s in self.series if s['id'] == series_id), None)
+    
+    def set_series_status(self, series, status, expected=None):
+        """Change a series' status; returns whether it changed
+        
+        With expected, a series whose status has moved on since the caller
+        looked is left alone.
+        """
+        with self.provider_lock(series.get('provider_id'), series=True):
+            series = self.get_series(series['id'])
+            if series is None or (expected is not None and series['status'] != expected):
+                return False
+            previous_status = series['status']
+            series['status'] = status
+            self.save_series()
+        log_changes(self.change_log, [('series', series['id'], 'updated', change_fields(series, ['status']))])
+        self._notify('series_status_changed', series, previous_status)
+        return True
+    
+    def skip_occurrence(self, series, occurrence_date):
+        """Drop one date from a series without touching the rest; returns the skipped occurrence
+        
+        Returns None (and changes nothing) unless occurrence_date is a
+        YYYY-MM-DD date on which the series has a session that is not
+        skipped already.
+        """
+        with self.provider_lock(series.get('provider_id'), series=True):
+            series = self.get_series(series['id'])
+            occurrence = series and self.get_occurrence(series, occurrence_date)
+            if occurrence is None:
+                return None
+            series['exceptions'].append(occurrence['occurrence'])
+            self.save_series()
+        log_changes(self.change_log, [('series', series['id'], 'updated', change_fields(series, ['exceptions']))])
+        self._notify('series_skipped', occurrence, occurrence['status'])
+        return occurrence
+    
+    def get_occurrence(self, series, occurrence_date):
+        """The series' occurrence on a given YYYY-MM-DD date, or None"""
+        try:
+            day = datetime.strptime(occurrence_date, "%Y-%m-%d")
+        except ValueError:
+            return None
+        return next((occurrence for occurrence in recurrence.expand(series, day, day + timedelta(days=1))
+                     if occurrence['occurrence'] == occurrence_date), None)
+    
+    def materialize_occurrence(self, series, occurrence_date, **fields):
+        """Turn one occurrence into a regular appointment (e.g. to complete and review it)"""
+        with self.provider_lock(series.get('provider_id'), series=True):
+            # Checked under the lock: a second request for the same date finds it already an exception
+            series = self.get_series(series['id'])
+            occurrence = series and self.get_occurrence(series, occurrence_date)
+            if occurrence is None:
+                return None
+            appointment = self._occurrence_appointment(series, occurrence, fields)
+            with self._lock:
+                series['exceptions'].append(occurrence_date)
+                self.appointments.append(appointment)
+                self._index(appointment)
+            self.save_series()
+            self.save_appointments([appointment])
+        log_changes(self.change_log, [('series', series['id'], 'updated', change_fields(series, ['exceptions'])),
+                                      ('appointment', appointment['id'], 'created', change_fields(appointment))])
+        return appointment
+    
+    def _occurrence_appointment(self, series, occurrence, fields):
+        appointment = Appointment(
+            id=self.ids.next('appointments'),
+            type=series['type'],
+            datetime=occurrence['datetime'],
+            duration=series['duration'],
+            notes=series.get('notes', ''),
+            created_at=datetime.now(),
+            user_id=series.get('user_id'),
+            provider_id=series.get('provider_id'),
+            status=series['status'],
+            series_id=series['id']
+        )
+        appointment.update(fields)
+        return appointment
+    
+    def get_occurrences(self, start, end, user_id=None, provider_id=None):
+        """Occurrences of active series in [start, end), expanded lazily and sorted by time"""
+        if provider_id is not None:
+            candidates = self._series_by_provider.get(provider_id, [])
+        else:
+            candidates = self.series
+        candidates = self._visible(candidates)
+        streams = [recurrence.expand(series, start, end) for series in candidates
+                   if series['status'] in recurrence.ACTIVE_STATUSES
+                   and (user_id is None or series.get('user_id') == user_id)]
+        return list(heapq.merge(*streams, key=lambda occurrence: occurrence['datetime']))
+    
+    def get_provider_appointments(self, provider_id):
+        """A provider's appointments (every status), by start time"""
+        return self._visible(list(self._timeline(provider_id)))
+    
+    def get_user_appointments(self, user_id):
+        """A customer's appointments (every status), by start time"""
+        return self._visible(list(self._user_timeline(user_id)))
+    
+    def user_history_page(self, user_id, before=None, limit=25):
+        """(appointments, next cursor): a page of a customer's bookings, newest first
+        
+        before is the (datetime, id) cursor that came with the previous page;
+        the next cursor is None on the last page. A page costs one bisect plus
+        the page itself, however long the history.
+        """
+        return self._page(self._user_timeline(user_id).iter_before(before), limit)
+    
+    def user_appointments_page(self, user_id, after=None, limit=25):
+        """(appointments, next cursor): a page of a customer's bookings, oldest first"""
+        return self._page(self._user_timeline(user_id).iter_after(after), limit)
+    
+    def upcoming(self, user_id, now, limit=5):
+        """A customer's next limit appointments starting at or after now"""
+        return self._page(self._user_timeline(user_id).iter_from(now), limit)[0]
+    
+    def user_appointment_counts(self, user_id, now):
+        """(all, starting after now) of a customer's appointments, without listing them"""
+        timeline = self._user_timeline(user_id)
+        if hidden_user_ids(self.deleted_users):
+            appointments = self.get_user_appointments(user_id)
+            return len(appointments), sum(1 for apt in appointments if apt['datetime'] > now)
+        return len(timeline), timeline.count_after(now)
+    
+    def _page(self, appointments, limit):
+        hidden = hidden_user_ids(self.deleted_users)
+        visible = (apt for apt in appointments
+                   if apt.get('user_id') not in hidden and apt.get('provider_id') not in hidden)
+        # Taken under the lock: the timeline cannot shift under the iterator
+        with self._lock:
+            page = list(itertools.islice(visible, limit + 1))
+        if len(page) > limit:
+            return page[:limit], sort_key(page[limit - 1])
+        return page, None
+    
+    def next_start(self, provider_id, at_or_after):
+        """When the provider's next appointment (any status) starts, or None"""
+        return self._timeline(provider_id).first_start(at_or_after)
+    
+    def get_provider_series(self, provider_id):
+        """A provider's recurring series (every status)"""
+        return self._visible(list(self._series_by_provider.get(provider_id, [])))
     
     def cancel_appointment(self, appointment_id):
         """Cancel an appointment by ID"""
-        for i, appointment in enumerate(self.appointments):
-            if appointment["id"] == appointment_id:
-                del self.appointments[i]
-                self.save_appointments()
-                return True
-        return False
+        appointment = next((apt for apt in self.appointments if apt["id"] == appointment_id), None)
+        if appointment is None:
+            return False
+        with self.provider_lock(appointment.get('provider_id')):
+            with self._lock:
+                index = next((i for i, appointment in enumerate(self.appointments)
+                              if appointment["id"] == appointment_id), None)
+                if index is None:
+                    return False
+                appointment = self.appointments.pop(index)
+                self._unindex(appointment)
+            self.save_appointments([appointment])
+        log_changes(self.change_log, [('appointment', appointment_id, 'deleted', None)])
+        self._notify('cancelled', appointment, appointment.get('status'))
+        return True
+    
+    def set_status(self, appointment, status, **fields):
+        """Change an appointment's status (plus any extra fields) and save; returns False if it is gone"""
+        return bool(self.set_statuses([(appointment, status, fields)]))
+    
+    def set_statuses(self, changes, expected=None):
+        """Apply a batch of (appointment, status, fields) changes with a single save; returns those applied
+        
+        expected, one status per change, skips appointments whose status has
+        moved on since the caller looked (e.g. confirmed just before expiring).
+        """
+        providers = {appointment.get('provider_id') for appointment, _, _ in changes}
+        with self.locked_providers(providers):
+            applied, previous = [], []
+            with self._lock:
+                for position, (appointment, status, fields) in enumerate(changes):
+                    # Another worker's write may have been loaded since the caller found it
+                    appointment = self._current(appointment)
+                    if appointment is None or (expected is not None
+                                               and appointment.get('status') != expected[position]):
+                        continue
+                    previous.append(appointment.get('status'))
+                    appointment['status'] = status
+                    appointment.update(fields)
+                    applied.append((appointment, status, fields))
+            changes = applied
+            if changes:
+                self.save_appointments([appointment for appointment, _, _ in changes])
+        log_changes(self.change_log, [('appointment', appointment['id'], 'updated',
+                                       change_fields(appointment, ['status', *fields]))
+                                      for appointment, status, fields in changes])
+        for (appointment, _, _), previous_status in zip(changes, previous):
+            self._notify('status_changed', appointment, previous_status)
+        return changes
+    
+    def batch_conflicts(self, new_appointments, released=()):
+        """Positions of new appointments that overlap existing bookings or each other
+        
+        One sorted sweep per provider over the batch's span; appointments in
+        released (being cancelled or declined alongside) do not block.
+        """
+        released_ids = {id(appointment) for appointment in released}
+        by_provider = {}
+        for position, appointment in enumerate(new_appointments):
+            start = appointment['datetime']
+            end = start + timedelta(minutes=appointment['duration'])
+            by_provider.setdefault(appointment['provider_id'], []).append((start, end, position))
+        
+        conflicts = set()
+        for provider_id, intervals in by_provider.items():
+            intervals.sort()
+            span_end = max(end for _, end, _ in intervals)
+            existing = self.iter_busy(provider_id, intervals[0][0], span_end, exclude=released_ids)
+            conflicts.update(position for _, _, position in recurrence.find_conflicts(intervals, existing))
+            # Bookings within the batch: a later one clashes if it starts before an earlier one ends
+            latest_end = None
+            for start, end, position in intervals:
+                if latest_end is not None and start < latest_end:
+                    conflicts.add(position)
+                latest_end = end if latest_end is None else max(latest_end, end)
+        return sorted(conflicts)
+    
+    @metrics.timed('appointments', 'apply_bulk')
+    def apply_bulk(self, new_appointments, changes, cancellations):
+        """Apply a validated batch (see bulk.plan_operations) with a single save
+        
+        Callers hold the locks of every provider in the batch (see locked_providers)
+        from planning through here.
+        """
+        next_id = self.ids.allocate('appointments', len(new_appointments)) if new_appointments else None
+        with self._lock:
+            for offset, appointment in enumerate(new_appointments):
+                appointment['id'] = next_id + offset
+                self.appointments.append(appointment)
+                self._index(appointment)
+            
+            previous = []
+            for appointment, status, fields in changes:
+                previous.append(appointment.get('status'))
+                appointment['status'] = status
+                appointment.update(fields)
+            
+            cancelled_ids = {id(appointment) for appointment in cancellations}
+            if cancelled_ids:
+                self.appointments = [apt for apt in self.appointments if id(apt) not in cancelled_ids]
+                for appointment in cancellations:
+                    self._unindex(appointment)
+        
+        self.save_appointments(itertools.chain(new_appointments, (apt for apt, _, _ in changes), cancellations))
+        log_changes(self.change_log,
+                    [('appointment', appointment['id'], 'created', change_fields(appointment))
+                     for appointment in new_appointments]
+                    + [('appointment', appointment['id'], 'updated', change_fields(appointment, ['status', *fields]))
+                       for appointment, status, fields in changes]
+                    + [('appointment', appointment['id'], 'deleted', None) for appointment in cancellations])
+        
+        for appointment in new_appointments:
+            self._notify('created', appointment)
+        for (appointment, _, _), previous_status in zip(changes, previous):
+            self._notify('status_changed', appointment, previous_status)
+        for appointment in cancellations:
+            self._notify('cancelled', appointment, appointment.get('status'))
+    
+    def purge_user_appointments(self, user_id, limit):
+        """Remove up to limit appointments and series a user booked or provides; returns how many
+        
+        For the deletion compactor: one save per batch, and a 'purged' (or
+        'series_purged') event per record so listeners drop it without
+        treating it as cancelled.
+        """
+        with self._lock:
+            providers = {apt.get('provider_id') for apt in self.appointments
+                         if apt.get('user_id') == user_id or apt.get('provider_id') == user_id}
+        with self.locked_providers(providers, series=True):
+            with self._lock:
+                # Bookings made since with other providers wait for the next batch
+                doomed = [apt for apt in self.appointments
+                          if (apt.get('user_id') == user_id or apt.get('provider_id') == user_id)
+                          and apt.get('provider_id') in providers][:limit]
+                if doomed:
+                    doomed_ids = {id(apt) for apt in doomed}
+                    self.appointments = [apt for apt in self.appointments if id(apt) not in doomed_ids]
+                    for appointment in doomed:
+                        self._unindex(appointment)
+                series = [s for s in self.series
+                          if s.get('user_id') == user_id or s.get('provider_id') == user_id][:limit - len(doomed)]
+                if series:
+                    doomed_ids = {id(s) for s in series}
+                    self.series = [s for s in self.series if id(s) not in doomed_ids]
+                    for provider_id in {s.get('provider_id') for s in series}:
+                        self._series_by_provider[provider_id] = [
+                            s for s in self._series_by_provider[provider_id] if id(s) not in doomed_ids]
+            if doomed:
+                self.save_appointments(doomed)
+            if series:
+                self.save_series()
+        log_changes(self.change_log, [('appointment', appointment['id'], 'deleted', None) for appointment in doomed]
+                    + [('series', s['id'], 'deleted', None) for s in series])
+        for appointment in doomed:
+            self._notify('purged', appointment, appointment.get('status'))
+        for removed in series:
+            self._notify('series_purged', removed, removed['status'])
+        return len(doomed) + len(series)
     
     def get_appointment_types(self):
         """Get available appointment types"""
         return self.appointment_types
 
 # Initialize scheduler
-scheduler = AppointmentScheduler()
+scheduler = lazy.LazyStore('appointments', lambda: AppointmentScheduler(
+    store_file(app.config['APPOINTMENTS_FILE']), id_allocator=id_allocator, deleted_users=deleted_users,
+    shard_count=app.config['APPOINTMENT_SHARDS'], change_log=store_change_log()))
 
 
 class ReviewManager:
-    def __init__(self, reviews_file: str = "reviews.json"):
+    def __init__(self, reviews_file: str = "reviews.json", id_allocator=None, deleted_users=None, change_log=None):
         self.reviews_file = reviews_file
+        self.ids = id_allocator or ids.IdAllocator(app.config['ID_FILE'])
+        self.deleted_users = deleted_users
+        self.change_log = change_log
+        self._signature = None
+        self._dirty = False
+        self.listeners = []
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._write_lock = locks.FileLock(reviews_file + '.lock')
         self.reviews = self.load_reviews()
+        self.ids.observe('reviews', self.reviews)
     
+    @metrics.timed('reviews', 'load')
     def load_reviews(self):
-        """Load reviews from JSON file"""
-        if os.path.exists(self.reviews_file):
+        """Load reviews from JSON (or snapshot) file"""
+        self._signature = file_signature(self.reviews_file)
+        if snapshot.is_snapshot(self.reviews_file) and os.path.exists(self.reviews_file):
+            return snapshot.load_snapshot(self.reviews_file, 'reviews', record_class=Review)
+        reviews_file = snapshot.json_path(self.reviews_file)
+        if os.path.exists(reviews_file):
             try:
-                with open(self.reviews_file, 'r') as f:
-                    data = json.load(f)
-                    # Convert datetime strings back to datetime objects
-                    for review in data:
-                        review['created_at'] = datetime.fromisoformat(review['created_at'])
-                    return data
+                with open(reviews_file, 'r') as f:
+                    return [Review.from_dict(review) for review in json.load(f)]
             except (json.JSONDecodeError, FileNotFoundError):
                 return []
         return []
     
+    @metrics.timed('reviews', 'save')
     def save_reviews(self):
-        """Save reviews to JSON file"""
-        with open(self.reviews_file, 'w') as f:
-            json.dump(self.reviews, f, indent=2, default=str)
+        """Save reviews to JSON (or snapshot) file"""
+        with self._write_lock, self._save_lock:
+            with self._lock:
+                reviews = list(self.reviews)
+            try:
+                if snapshot.is_snapshot(self.reviews_file):
+                    snapshot.write_snapshot(self.reviews_file, 'reviews', reviews)
+                else:
+                    write_json_atomic(self.reviews_file, reviews, indent=2, default=records.json_default)
+            except BaseException:
+                self._dirty = True
+                raise
+            self._signature = file_signature(self.reviews_file)
+            self._dirty = False
+    
+    def refresh(self):
+        """Reload reviews if another process has rewritten the file"""
+        if file_signature(self.reviews_file) != self._signature:
+            with self._lock:
+                self.reviews = self.load_reviews()
+                self.ids.observe('reviews', self.reviews)
+                self._dirty = False
+            self._notify('reloaded', None)
+    
+    @contextmanager
+    def writing(self):
+        """Hold the write lock with the newest reviews loaded (see SimpleUserManager.writing)"""
+        with self._write_lock:
+            self.refresh()
+            yield
+    
+    def flush(self):
+        """Retry a save that failed, unless another process has rewritten the file since"""
+        if self._dirty:
+            with self._write_lock:
+                if file_signature(self.reviews_file) == self._signature:
+                    self.save_reviews()
+    
+    def add_listener(self, listener):
+        """Register listener(event, review) for 'created', 'purged' and 'reloaded'"""
+        self.listeners.append(listener)
+    
+    def _notify(self, event, review):
+        for listener in self.listeners:
+            try:
+                listener(event, review)
+            except Exception:
+                app.logger.exception('Review listener failed for %s event', event)
     
     def add_review(self, appointment_id, reviewer_id, reviewed_id, rating, comment=""):
         """Add a new review"""
@@ -308,41 +1593,56 @@ class ReviewManager:
             if not isinstance(rating, int) or rating < 1 or rating > 5:
                 return False
             
-            # Check if review already exists for this appointment
-            existing_review = next((r for r in self.reviews 
-                                 if r['appointment_id'] == appointment_id and 
-                                    r['reviewer_id'] == reviewer_id), None)
-            if existing_review:
-                return False
-            
-            review = {
-                "id": len(self.reviews) + 1,
-                "appointment_id": appointment_id,
-                "reviewer_id": reviewer_id,
-                "reviewed_id": reviewed_id,
-                "rating": rating,
-                "comment": comment.strip(),
-                "created_at": datetime.now()
-            }
-            
-            self.reviews.append(review)
-            self.save_reviews()
+            with self.writing():
+                with self._lock:
+                    # Check if review already exists for this appointment
+                    existing_review = next((r for r in self.reviews 
+                                         if r['appointment_id'] == appointment_id and 
+                                            r['reviewer_id'] == reviewer_id), None)
+                    if existing_review:
+                        return False
+                    
+                    review = Review(
+                        id=self.ids.next('reviews'),
+                        appointment_id=appointment_id,
+                        reviewer_id=reviewer_id,
+                        reviewed_id=reviewed_id,
+                        rating=rating,
+                        comment=comment.strip(),
+                        created_at=datetime.now()
+                    )
+                    
+                    self.reviews.append(review)
+                self.save_reviews()
+            log_changes(self.change_log, [('review', review['id'], 'created', change_fields(review))])
+            self._notify('created', review)
             return True
             
         except Exception:
             return False
     
+    def active_reviews(self):
+        """Every review except those written or received by deleted accounts still waiting to be removed"""
+        hidden = hidden_user_ids(self.deleted_users)
+        if not hidden:
+            return self.reviews
+        return [review for review in self.reviews
+                if review['reviewer_id'] not in hidden and review['reviewed_id'] not in hidden]
+    
+    @metrics.timed('reviews', 'get_reviews_for_user')
     def get_reviews_for_user(self, user_id):
         """Get all reviews for a specific user (reviews they received)"""
-        return [review for review in self.reviews if review['reviewed_id'] == user_id]
+        return [review for review in self.active_reviews() if review['reviewed_id'] == user_id]
     
+    @metrics.timed('reviews', 'get_reviews_by_user')
     def get_reviews_by_user(self, user_id):
         """Get all reviews written by a specific user"""
-        return [review for review in self.reviews if review['reviewer_id'] == user_id]
+        return [review for review in self.active_reviews() if review['reviewer_id'] == user_id]
     
+    @metrics.timed('reviews', 'get_review_for_appointment')
     def get_review_for_appointment(self, appointment_id, reviewer_id):
         """Get review for a specific appointment by a specific reviewer"""
-        return next((r for r in self.reviews 
+        return next((r for r in self.active_reviews() 
                     if r['appointment_id'] == appointment_id and 
                        r['reviewer_id'] == reviewer_id), None)
     
@@ -352,9 +1652,279 @@ class ReviewManager:
         if not user_reviews:
             return 0.0
         return sum(review['rating'] for review in user_reviews) / len(user_reviews)
+    
+    def purge_user_reviews(self, user_id, limit):
+        """Remove up to limit reviews a user wrote or received (deletion compactor); returns how many"""
+        with self.writing():
+            with self._lock:
+                doomed = [review for review in self.reviews
+                          if review['reviewer_id'] == user_id or review['reviewed_id'] == user_id][:limit]
+                if not doomed:
+                    return 0
+                doomed_ids = {id(review) for review in doomed}
+                self.reviews = [review for review in self.reviews if id(review) not in doomed_ids]
+            self.save_reviews()
+        log_changes(self.change_log, [('review', review['id'], 'deleted', None) for review in doomed])
+        for review in doomed:
+            self._notify('purged', review)
+        return len(doomed)
 
 # Initialize review manager
-review_manager = ReviewManager()
+review_manager = lazy.LazyStore('reviews', lambda: ReviewManager(
+    store_file(app.config['REVIEWS_FILE']), id_allocator=id_allocator, deleted_users=deleted_users,
+    change_log=store_change_log()))
+
+# Request/store instrumentation and the /metrics endpoint
+metrics.init_app(app, {
+    'users': (lambda: user_manager.users, lambda: user_manager.users_file),
+    'appointments': (lambda: scheduler.appointments, lambda: scheduler.data_file),
+    'reviews': (lambda: review_manager.reviews, lambda: review_manager.reviews_file),
+})
+profiler.init_app(app)
+# Runs before the store refresh below, so shed requests never touch the stores
+admission.init_app(
+    app,
+    auth_endpoints=('login', 'register'),
+    expensive_endpoints=('add_appointment', 'bulk_appointments', 'api_providers', 'api_search',
+                         'provider_analytics_page', 'api_provider_analytics', 'upload_gallery_image'),
+    # Token-checked before any work, so scrapes and change feeds keep flowing under load
+    exempt_endpoints=('static', 'metrics', 'media_file', 'api_changes'))
+
+def all_stores():
+    """Every data store, in the order they should be flushed"""
+    return [user_manager, scheduler, review_manager]
+
+def apply_settings():
+    """Carry app.config over to the long-lived helpers built at import (see create_app)"""
+    admission.configure(app)
+    notifier.lead = timedelta(hours=app.config['REMINDER_LEAD_HOURS'])
+    transition_engine.auto_complete = app.config['AUTO_COMPLETE_APPOINTMENTS']
+    transition_engine.expiry_grace = timedelta(minutes=app.config['PENDING_EXPIRY_GRACE_MINUTES'])
+    provider_analytics.auto_complete = app.config['AUTO_COMPLETE_APPOINTMENTS']
+    provider_analytics.clear()
+    compactor.batch_size = app.config['COMPACT_BATCH_SIZE']
+    event_broker.buffer_size = app.config['SSE_BUFFER_EVENTS']
+    event_hub.heartbeat = app.config['SSE_HEARTBEAT_SECONDS']
+    event_hub.max_connections = app.config['SSE_MAX_CONNECTIONS']
+
+def create_app(config=None, preload=False):
+    """The configured app
+    
+    config overrides app.config (e.g. DATA_DIR or USERS_FILE for a test's
+    own data files). Stores load on first use; if any already did, they are
+    dropped and load again from the new settings. preload=True loads every
+    store now, as serve.py does before forking workers.
+    """
+    if config:
+        app.config.update(config)
+        if outbox.loaded:
+            outbox.stop()
+        # The scheduler is replaced: its heap is rebuilt, not caught up
+        transition_engine.reset()
+        for service in (id_allocator, deleted_users, change_log, idempotency_cache, image_variants, outbox):
+            service.reset()
+        for store in all_stores():
+            store.reset()
+        # Reopened (if shared) from the new DATA_DIR on next use
+        event_broker.share(open_live_event_log)
+        apply_settings()
+    if preload:
+        for store in all_stores():
+            store.load()
+    return app
+
+@app.before_request
+def refresh_shared_stores():
+    """With several worker processes, pick up data files rewritten by other workers"""
+    if app.config.get('SHARED_STORES'):
+        for store in all_stores():
+            store.refresh()
+        # Accounts deleted through other workers disappear here too
+        for user_id in deleted_users.refresh():
+            hide_deleted_user(user_id)
+
+# Notifications: handlers append to the outbox, one process delivers and runs reminders
+def open_outbox():
+    """The notification outbox under DATA_DIR, delivering through the configured transport"""
+    box = notifications.Outbox(data_path(app.config['NOTIFICATIONS_OUTBOX']),
+                               notifications.transport_from_config(app.config))
+    box.on_leader = lambda: notifier.backfill(scheduler.appointments)
+    return box
+
+outbox = lazy.LazyStore('outbox', open_outbox)
+notifier = notifications.AppointmentNotifier(
+    outbox, lambda user_id: user_manager.get_user_by_id(user_id), lead=timedelta(hours=app.config['REMINDER_LEAD_HOURS']))
+
+def notify_appointment_event(event, appointment, previous_status=None):
+    """Scheduler listener: booking emails and reminders, while NOTIFICATIONS_ENABLED"""
+    if app.config['NOTIFICATIONS_ENABLED']:
+        notifier(event, appointment, previous_status)
+
+scheduler.add_listener(notify_appointment_event)
+
+# Expire stale pending requests (and optionally complete past confirmed ones). The engine
+# ignores events until start_background_workers() starts it (only with TRANSITIONS_ENABLED)
+transition_engine = transitions.StatusTransitionEngine(
+    scheduler,
+    auto_complete=app.config['AUTO_COMPLETE_APPOINTMENTS'],
+    expiry_grace=timedelta(minutes=app.config['PENDING_EXPIRY_GRACE_MINUTES']),
+    get_change_log=store_change_log)
+scheduler.add_listener(transition_engine)
+
+# Full-text provider search, re-indexed one provider at a time as profiles change
+search_index = search.SearchIndex(lambda: user_manager.active_users())
+user_manager.add_listener(search_index)
+
+# Listing facets (category, rating, open days) and sort orders, updated per provider
+provider_facets = facets.ProviderFacets(lambda: user_manager.active_users(), lambda: review_manager.active_reviews())
+user_manager.add_listener(provider_facets.user_changed)
+review_manager.add_listener(provider_facets.review_changed)
+
+# Per-provider utilization reports, cached until the provider's bookings change
+provider_analytics = analytics.ProviderAnalytics(scheduler, lambda user_id: user_manager.get_user_by_id(user_id),
+                                                 auto_complete=app.config['AUTO_COMPLETE_APPOINTMENTS'])
+scheduler.add_listener(provider_analytics)
+
+# Booking events for provider dashboards, pushed over server-sent events
+event_broker = sse.EventBroker(app.config['SSE_BUFFER_EVENTS'])
+event_hub = sse.EventHub(event_broker, heartbeat=app.config['SSE_HEARTBEAT_SECONDS'],
+                         max_connections=app.config['SSE_MAX_CONNECTIONS'])
+
+def open_live_event_log():
+    """The log carrying live events between worker processes, or None with just one process"""
+    if not app.config.get('SHARED_STORES'):
+        return None
+    return changes.ChangeLog(data_path(app.config['SSE_EVENTS_FILE']),
+                             max_events=app.config['SSE_LOG_EVENTS'])
+
+event_broker.share(open_live_event_log)
+
+def provider_feed_item(appointment, previous_status=None):
+    """What the dashboard needs to show one appointment (a single customer lookup)"""
+    customer = user_manager.get_user_by_id(appointment.get('user_id'))
+    return {
+        'id': appointment['id'],
+        'status': appointment.get('status'),
+        'previous_status': previous_status,
+        'type': appointment.get('type'),
+        'start': appointment['datetime'].isoformat(),
+        'date_label': appointment['datetime'].strftime('%B %d, %Y'),
+        'time_label': appointment['datetime'].strftime('%I:%M %p'),
+        'duration': appointment.get('duration'),
+        'notes': appointment.get('notes', ''),
+        'customer_name': customer.get('name', customer.get('username', 'Unknown')) if customer else 'Unknown',
+        'customer_phone': customer.get('phone', '') if customer else '',
+        'customer_email': customer.get('email', '') if customer else '',
+    }
+
+def publish_appointment_event(event, appointment, previous_status=None):
+    """Scheduler listener: forward booking changes to the provider's live feed"""
+    if event == 'reloaded':
+        # Other workers' changes arrive through the shared log; a lone process has no other way to hear of them
+        if not event_broker.shared:
+            event_broker.resync_all()
+    elif event.startswith('series_'):
+        # A series shows up in several sections of the dashboard at once, so the page redraws it
+        if appointment.get('provider_id') is not None:
+            event_broker.publish(appointment['provider_id'], 'series_changed', {
+                'series_id': appointment.get('series_id', appointment['id']),
+                'event': event,
+                'status': appointment.get('status'),
+                'previous_status': previous_status,
+            })
+    elif appointment.get('provider_id') is not None:
+        # A deleted account's bookings leave the dashboard like cancelled ones
+        name = 'cancelled' if event == 'purged' else event
+        event_broker.publish(appointment['provider_id'], name, provider_feed_item(appointment, previous_status))
+
+scheduler.add_listener(publish_appointment_event)
+
+# Version counters behind the ETags of public pages and APIs
+store_versions = versions.StoreVersions()
+user_manager.add_listener(store_versions.user_changed)
+scheduler.add_listener(store_versions.appointment_changed)
+review_manager.add_listener(store_versions.review_changed)
+
+def hide_deleted_user(user_id):
+    """Take a tombstoned account out of every index and cache at once (the compactor removes its data later)"""
+    # Search, facets and the user's version counter drop them on 'deleted'
+    user_manager.hide_user(user_id)
+    # Their bookings and reviews are filtered out of every read from now on, so
+    # whatever was derived from them is stale: ratings, reports and ETags
+    provider_facets.review_changed('reloaded', None)
+    provider_analytics.clear()
+    store_versions.reset('appointments')
+    store_versions.reset('reviews')
+
+def media_digests(user):
+    """Digests of a user's uploaded images (profile picture and gallery) in MEDIA_DIR"""
+    digests = [image.get('media') for image in user.get('gallery') or []]
+    digests.append(user.get('profile_picture_media'))
+    return {digest for digest in digests if digest}
+
+def purge_user_images(user_id, limit):
+    """Delete up to limit of a deleted user's images that no other account uses; returns how many"""
+    user = next((u for u in user_manager.users if u['id'] == user_id), None)
+    if user is None:
+        return 0
+    # Images are stored by content, so someone else may have uploaded the same one
+    theirs = media_digests(user) - {digest for other in user_manager.users if other['id'] != user_id
+                                    for digest in media_digests(other)}
+    doomed = [digest for digest in sorted(theirs) if image_variants.exists(digest)][:limit]
+    return sum(image_variants.remove(digest) for digest in doomed)
+
+# Deleted accounts: hidden at once, removed in batches by one background compactor
+compactor = tombstones.Compactor(deleted_users, [
+    ('appointments', lambda user_id, limit: scheduler.purge_user_appointments(user_id, limit)),
+    ('reviews', lambda user_id, limit: review_manager.purge_user_reviews(user_id, limit)),
+    ('images', purge_user_images),
+    ('account', lambda user_id, limit: int(user_manager.delete_user(user_id))),
+], batch_size=app.config['COMPACT_BATCH_SIZE'], refresh=refresh_shared_stores)
+
+def conditional(depends_on, personal=True):
+    """Answer a matching If-None-Match with 304 before the view runs
+    
+    depends_on(**view_args) returns the store/entity versions (and anything else)
+    the response depends on; the query string is always included, and for
+    personal pages so is the signed-in user.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if personal and session.get('_flashes'):
+                # Pending flash messages are shown once, inside the page
+                return f(*args, **kwargs)
+            parts = [request.full_path]
+            if personal:
+                user_id = session.get('user_id')
+                parts += [user_id, store_versions.version('users', user_id)]
+            etag = store_versions.etag(*parts, *depends_on(**kwargs))
+            cache_control = 'private, no-cache' if personal else 'no-cache'
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return decorated_function
+    return decorator
+
+def listing_versions():
+    """What provider listing pages depend on: profiles and ratings"""
+    return [store_versions.version('users'), store_versions.version('reviews')]
+
+@app.before_request
+def start_background_workers():
+    """Start background loops lazily, so they run in forked workers rather than the master"""
+    if app.config['NOTIFICATIONS_ENABLED']:
+        outbox.start()
+    if app.config['TRANSITIONS_ENABLED']:
+        transition_engine.start()
+    if app.config['COMPACTION_ENABLED']:
+        compactor.start()
 
 
 def get_current_user():
@@ -362,10 +1932,29 @@ def get_current_user():
         return user_manager.get_user_by_id(session['user_id'])
     return None
 
+def parse_cursor(value):
+    """The (datetime, id) of a ?before= or ?after= listing cursor; None if missing or malformed"""
+    when, _, appointment_id = (value or '').rpartition(',')
+    try:
+        when, appointment_id = datetime.fromisoformat(when), int(appointment_id)
+    except ValueError:
+        return None
+    if when.tzinfo is not None:
+        # Appointment times are naive; an offset cannot be compared with them
+        return None
+    return when, appointment_id
+
+def format_cursor(cursor):
+    return f'{cursor[0].isoformat()},{cursor[1]}' if cursor else None
+
+def appointments_per_page():
+    per_page = request.args.get('limit', app.config['APPOINTMENTS_PER_PAGE'], type=int) or app.config['APPOINTMENTS_PER_PAGE']
+    return max(1, min(per_page, app.config['APPOINTMENTS_MAX_PER_PAGE']))
+
 def get_providers_by_service(service_key):
     """Get all providers offering a specific service type"""
     providers = []
-    for user in user_manager.users:
+    for user in user_manager.active_users():
         if user.get('role') == 'provider' and user.get('service_category') == service_key:
             providers.append({
                 'name': user.get('business_name', user.get('name')),
@@ -380,14 +1969,12 @@ def get_providers_by_service(service_key):
 def index():
     """Home page - show upcoming appointments"""
     current_user = get_current_user()
-    appointments = scheduler.get_appointments()
-    # Show only future appointments for logged-in user
-    now = datetime.now()
+    # Show only the next few appointments for logged-in user (a bisect into their timeline)
     if current_user:
-        upcoming = [apt for apt in appointments if apt['datetime'] >= now and apt.get('user_id') == current_user['id']]
+        upcoming = scheduler.upcoming(current_user['id'], datetime.now(), 5)
     else:
         upcoming = []
-    return render_template('index.html', appointments=upcoming[:5], current_user=current_user)
+    return render_template('index.html', appointments=upcoming, current_user=current_user)
 
 @app.route('/schedule')
 @login_required
@@ -396,7 +1983,7 @@ def schedule():
     current_user = get_current_user()
     
     # Get all providers with their availability
-    all_providers = [user for user in user_manager.users if user.get('role') == 'provider']
+    all_providers = [user for user in user_manager.active_users() if user.get('role') == 'provider']
     providers_data = []
     for provider in all_providers:
         providers_data.append({
@@ -417,32 +2004,60 @@ def schedule():
 def appointments():
     """View all appointments"""
     current_user = get_current_user()
-    all_appointments = scheduler.get_appointments()
-    # Show only user's appointments
-    appointments = [apt for apt in all_appointments if apt.get('user_id') == current_user['id']]
-    return render_template('appointments.html', appointments=appointments, current_user=current_user)
-
+    # One page of the user's appointments, oldest first, resuming after the ?after= cursor
+    after = parse_cursor(request.args.get('after'))
+    appointments, next_cursor = scheduler.user_appointments_page(current_user['id'], after, appointments_per_page())
+    # Plus upcoming occurrences of recurring bookings, expanded only for the listing window and
+    # only where they fall between this page's first and the next page's first appointment
+    now = datetime.now()
+    window_start = max(now, after[0]) if after else now
+    window_end = now + timedelta(weeks=app.config['SERIES_LISTING_WEEKS'])
+    if next_cursor:
+        window_end = min(window_end, next_cursor[0])
+    if window_start < window_end:
+        occurrences = scheduler.get_occurrences(window_start, window_end, user_id=current_user['id'])
+        appointments = list(heapq.merge(appointments, occurrences, key=lambda apt: apt['datetime']))
+    next_url = url_for('appointments', after=format_cursor(next_cursor), limit=request.args.get('limit')) if next_cursor else None
+    return render_template('appointments.html', appointments=appointments, current_user=current_user,
+                           next_url=next_url, paged=after is not None)
+
+
+@app.route('/appointments/<date>')
+@login_required
+def appointments_on_date(date):
+    """The user's appointments on one day (the date filter of the appointments page)"""
+    try:
+        day = datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        flash('Please choose a valid date.', 'error')
+        return redirect(url_for('appointments'))
+    current_user = get_current_user()
+    appointments = scheduler.get_appointments_between(day, day + timedelta(days=1), user_id=current_user['id'])
+    occurrences = scheduler.get_occurrences(day, day + timedelta(days=1), user_id=current_user['id'])
+    appointments = list(heapq.merge(appointments, occurrences, key=lambda apt: apt['datetime']))
+    return render_template('appointments.html', appointments=appointments, current_user=current_user,
+                           selected_date=date)
 
 @app.route('/history')
 @login_required
 def history():
     """View appointment history and orders"""
     current_user = get_current_user()
-    all_appointments = scheduler.get_appointments()
-    # Show only user's appointments
-    appointments = [apt for apt in all_appointments if apt.get('user_id') == current_user['id']]
-    # Sort by date descending (most recent first)
-    appointments.sort(key=lambda x: x['datetime'], reverse=True)
+    # One page, most recent first, resuming before the ?before= cursor
+    before = parse_cursor(request.args.get('before'))
+    appointments, next_cursor = scheduler.user_history_page(current_user['id'], before, appointments_per_page())
     now = datetime.now()
-    return render_template('history.html', appointments=appointments, now=now, current_user=current_user)
+    total, upcoming = scheduler.user_appointment_counts(current_user['id'], now)
+    older_url = url_for('history', before=format_cursor(next_cursor), limit=request.args.get('limit')) if next_cursor else None
+    return render_template('history.html', appointments=appointments, now=now, current_user=current_user,
+                           total=total, upcoming=upcoming, older_url=older_url, paged=before is not None)
 
 @app.route('/profile')
 @login_required
 def profile():
     """View user profile and information - unified with provider dashboard"""
     current_user = get_current_user()
-    all_appointments = scheduler.get_appointments()
-    user_appointments = [apt for apt in all_appointments if apt.get('user_id') == current_user['id']]
+    user_appointments = scheduler.get_user_appointments(current_user['id'])
     
     user_profile = {
         'id': current_user['id'],
@@ -460,7 +2075,7 @@ def profile():
     provider_data = {}
     if current_user.get('role') == 'provider':
         # Get provider appointments (bookings made by customers for this provider)
-        provider_appointments = [apt for apt in all_appointments if apt.get('provider_id') == current_user['id']]
+        provider_appointments = scheduler.get_provider_appointments(current_user['id'])
         
         # Calculate provider statistics
         total_bookings = len(provider_appointments)
@@ -473,11 +2088,31 @@ def profile():
             'pending_count': pending_count
         }
     
+    # Calendar subscription links, once the user has asked for them
+    calendar_feeds = {}
+    if current_user.get('calendar_token'):
+        feeds = ['bookings', 'schedule'] if current_user.get('role') == 'provider' else ['bookings']
+        calendar_feeds = {feed: url_for('calendar_feed', user_id=current_user['id'], token=current_user['calendar_token'],
+                                        feed=feed, _external=True) for feed in feeds}
+    
     return render_template('profile.html', 
                          user=user_profile, 
                          current_user=current_user,
+                         calendar_feeds=calendar_feeds,
                          **provider_data)
 
+@app.route('/profile/calendar', methods=['POST'])
+@login_required
+def reset_calendar_link():
+    """Create (or replace) the secret in the user's calendar feed links"""
+    had_link = bool(get_current_user().get('calendar_token'))
+    user_manager.reset_calendar_token(session['user_id'])
+    if had_link:
+        flash('New calendar link created. The old link no longer works.', 'success')
+    else:
+        flash('Calendar link created. Add it to your calendar app as a subscription.', 'success')
+    return redirect(url_for('profile'))
+
 @app.route('/profile/edit', methods=['POST'])
 @login_required
 def edit_profile():
@@ -490,6 +2125,7 @@ def edit_profile():
     
     # Handle profile picture upload
     profile_picture = current_user.get('profile_picture', '')
+    profile_picture_media = current_user.get('profile_picture_media', '')
     if 'profile_picture' in request.files:
         file = request.files['profile_picture']
         if file and file.filename:
@@ -501,6 +2137,8 @@ def edit_profile():
                     ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else 'jpg'
                     if ext in ['jpg', 'jpeg', 'png', 'gif']:
                         profile_picture = f"data:image/{ext};base64,{base64.b64encode(image_data).decode()}"
+                        # Downscaled variants are rendered in the background
+                        profile_picture_media = image_variants.store(image_data, ext)
                     else:
                         flash('Invalid image format. Please use JPG, PNG, or GIF.', 'error')
                         return redirect(url_for('profile'))
@@ -521,13 +2159,74 @@ def edit_profile():
     
     # Update user
     if user_manager.update_user(current_user['id'], name=name, email=email, 
-                                phone=phone, profile_picture=profile_picture, **provider_data):
+                                phone=phone, profile_picture=profile_picture,
+                                profile_picture_media=profile_picture_media, **provider_data):
         flash('Profile updated successfully!', 'success')
     else:
         flash('Error updating profile.', 'error')
     
     return redirect(url_for('profile'))
 
+def calendar_feed_versions(user_id, token, feed):
+    """What a calendar feed depends on: the user's bookings, series, names, and today's window"""
+    return [store_versions.version('appointments', user_id), store_versions.version('users'),
+            file_signature(scheduler.series_file), datetime.now().date()]
+
+def calendar_event(item, feed, people):
+    """VEVENT for an appointment or series occurrence in a customer's (bookings) or provider's (schedule) feed"""
+    if feed == 'schedule':
+        customer = people(item.get('user_id'))
+        summary = f"{item['type']}: {customer.get('name', customer['username']) if customer else 'Customer'}"
+        location = ''
+    else:
+        provider = people(item.get('provider_id'))
+        provider_name = (provider.get('business_name') or provider.get('name', '')) if provider else ''
+        summary = f"{item['type']} with {provider_name}" if provider_name else item['type']
+        location = provider.get('address', '') if provider else ''
+    description = item.get('notes', '')
+    if item.get('status') == 'pending':
+        description = ('Awaiting confirmation. ' + description).strip()
+    if item.get('series_id') is not None and 'occurrence' in item:
+        uid = f"series-{item['series_id']}-{item['occurrence']}@appointment-scheduler"
+    else:
+        uid = f"appointment-{item['id']}@appointment-scheduler"
+    return ical.event(uid, item['datetime'], item['datetime'] + timedelta(minutes=item['duration']), summary,
+                      description=description, location=location, status=ical.EVENT_STATUSES[item['status']],
+                      stamp=item.get('created_at'))
+
+@app.route('/calendar/<int:user_id>/<token>/<any(bookings, schedule):feed>.ics')
+@conditional(calendar_feed_versions, personal=False)
+def calendar_feed(user_id, token, feed):
+    """iCalendar feed of a customer's bookings or a provider's schedule, for calendar apps to subscribe to
+    
+    The token in the link stands in for signing in. Events are generated
+    while the response streams, and a client polling with If-None-Match
+    gets 304 until something in the feed changes.
+    """
+    user = user_manager.get_user_by_id(user_id)
+    if (not user or not user.get('calendar_token') or not hmac.compare_digest(user['calendar_token'], token)
+            or (feed == 'schedule' and user.get('role') != 'provider')):
+        return jsonify({'success': False, 'error': 'Calendar not found'}), 404
+    
+    now = datetime.now()
+    start = now - timedelta(days=app.config['CALENDAR_PAST_DAYS'])
+    end = now + timedelta(days=app.config['CALENDAR_FUTURE_DAYS'])
+    scope = {'provider_id': user_id} if feed == 'schedule' else {'user_id': user_id}
+    items = heapq.merge(scheduler.get_appointments_between(start, end, **scope),
+                        scheduler.get_occurrences(start, end, **scope), key=lambda item: item['datetime'])
+    
+    names = {}
+    def people(other_id):
+        if other_id not in names:
+            names[other_id] = user_manager.get_user_by_id(other_id)
+        return names[other_id]
+    
+    events = (calendar_event(item, feed, people) for item in items if item.get('status') in ical.EVENT_STATUSES)
+    title = f"{user.get('business_name') or user.get('name', user['username'])} schedule" if feed == 'schedule' else 'My appointments'
+    response = Response(ical.calendar(title, events), mimetype='text/calendar')
+    response.headers['Content-Disposition'] = f'inline; filename="{feed}.ics"'
+    return response
+
 @app.route('/delete-account', methods=['POST'])
 @login_required
 def delete_account():
@@ -536,14 +2235,11 @@ def delete_account():
         current_user = get_current_user()
         user_id = current_user['id']
         
-        # Delete user from the user manager
-        user_manager.users = [user for user in user_manager.users if user['id'] != user_id]
-        user_manager.save_users()
-        
-        # Delete all appointments for this user
-        all_appointments = scheduler.get_appointments()
-        scheduler.appointments = [apt for apt in all_appointments if apt.get('user_id') != user_id]
-        scheduler.save_appointments()
+        # Tombstone the account: it and everything attached to it disappear now, and
+        # the compactor removes the appointments, reviews and images in the background
+        if deleted_users.add(user_id):
+            hide_deleted_user(user_id)
+            compactor.wake()
         
         # Clear session
         session.clear()
@@ -811,6 +2507,7 @@ def services():
 
 @app.route('/add_appointment', methods=['POST'])
 @login_required
+@idempotent
 def add_appointment():
     """Add new appointment"""
     current_user = get_current_user()
@@ -827,6 +2524,36 @@ def add_appointment():
     # Convert key to display name (e.g., "hair" -> "Hair Salon")
     appointment_type = scheduler.appointment_types.get(appointment_type_key, appointment_type_key)
     
+    # Recurring booking: store the series once instead of one row per week
+    repeat = request.form.get('repeat', 'none')
+    if repeat in recurrence.FREQUENCIES:
+        repeat_count = request.form.get('repeat_count', '').strip()
+        try:
+            count = int(repeat_count) if repeat_count else None
+            until = recurrence.parse_until(request.form.get('repeat_until', '').strip())
+        except ValueError:
+            flash('Please enter a valid number of sessions or end date.', 'error')
+            return redirect(url_for('appointments'))
+        if not count and not until:
+            flash('Please choose how many sessions or an end date for the recurring booking.', 'error')
+            return redirect(url_for('appointments'))
+        
+        series, conflicts = scheduler.add_series(
+            appointment_type, date, time, duration, repeat, count=count, until=until, notes=notes,
+            user_id=current_user['id'], provider_id=provider_id,
+            skip_conflicts=request.form.get('skip_conflicts') == '1')
+        if series:
+            message = 'Recurring appointment request submitted! Waiting for provider confirmation.'
+            if conflicts:
+                message += f" Skipped unavailable dates: {', '.join(conflicts)}."
+            flash(message, 'success')
+        elif conflicts:
+            flash(f"These dates are already booked: {', '.join(conflicts[:10])}"
+                  f"{' and more' if len(conflicts) > 10 else ''}. Tick 'skip unavailable dates' to book the rest.", 'error')
+        else:
+            flash('Failed to schedule recurring appointment. Please check the dates.', 'error')
+        return redirect(url_for('appointments'))
+    
     if scheduler.add_appointment(appointment_type, date, time, duration, notes, 
                                  user_id=current_user['id'], provider_id=provider_id):
         flash('Appointment request submitted! Waiting for provider confirmation.', 'success')
@@ -945,20 +2672,40 @@ def register():
     
     return render_template('register.html')
 
-def get_providers_with_ratings(service_category):
-    """Helper function to get providers with rating information"""
-    all_providers = [user for user in user_manager.users if user.get('role') == 'provider']
+def browse_providers(service_category=None):
+    """One page of providers with rating information, filtered and sorted by the request args
+    
+    Args: category (when service_category is not fixed by the page), min_rating,
+    open (weekdays, repeated or comma-separated), sort (rating, reviews, newest),
+    page and per_page. Returns a facets.Page of provider dicts.
+    """
+    days = [day for value in request.args.getlist('open') for day in value.lower().split(',') if day]
+    min_rating = request.args.get('min_rating', type=float)
+    per_page = request.args.get('per_page', app.config['PROVIDERS_PER_PAGE'], type=int) or app.config['PROVIDERS_PER_PAGE']
+    page = provider_facets.query(
+        category=service_category or request.args.get('category'),
+        min_rating=max(0.0, min(min_rating, 5.0)) if min_rating else None,
+        days=days,
+        sort=request.args.get('sort', 'rating'),
+        page=max(1, request.args.get('page', 1, type=int) or 1),
+        per_page=max(1, min(per_page, app.config['PROVIDERS_MAX_PER_PAGE'])))
+    
     providers = []
-    for provider in all_providers:
-        if provider.get('service_category') == service_category:
-            provider_data = {k: v for k, v in provider.items() if k != 'password'}
-            # Add rating information
-            provider_data['average_rating'] = review_manager.calculate_average_rating(provider['id'])
-            provider_data['total_reviews'] = len(review_manager.get_reviews_for_user(provider['id']))
-            providers.append(provider_data)
-    return providers
+    for provider_id in page:
+        provider = provider_facets.user(provider_id)
+        provider_data = {k: v for k, v in provider.items() if k != 'password'}
+        # Add rating information
+        provider_data['average_rating'], provider_data['total_reviews'] = provider_facets.rating(provider_id)
+        providers.append(provider_data)
+    page[:] = providers
+    return page
+
+def get_providers_with_ratings(service_category):
+    """Helper function to get providers with rating information (one page, see browse_providers)"""
+    return browse_providers(service_category)
 
 @app.route('/providers/hair-salon')
+@conditional(listing_versions)
 def hair_providers():
     """View hair salon providers"""
     current_user = get_current_user()
@@ -966,6 +2713,7 @@ def hair_providers():
     return render_template('hair_providers.html', providers=hair_providers, current_user=current_user)
 
 @app.route('/providers/nail-salon')
+@conditional(listing_versions)
 def nail_providers():
     """View nail salon providers"""
     current_user = get_current_user()
@@ -973,6 +2721,7 @@ def nail_providers():
     return render_template('nail_providers.html', providers=nail_providers, current_user=current_user)
 
 @app.route('/providers/massage-therapy')
+@conditional(listing_versions)
 def massage_providers():
     """View massage therapy providers"""
     current_user = get_current_user()
@@ -980,6 +2729,7 @@ def massage_providers():
     return render_template('massage_providers.html', providers=massage_providers, current_user=current_user)
 
 @app.route('/providers/spa-treatment')
+@conditional(listing_versions)
 def spa_providers():
     """View spa treatment providers"""
     current_user = get_current_user()
@@ -987,6 +2737,7 @@ def spa_providers():
     return render_template('spa_providers.html', providers=spa_providers, current_user=current_user)
 
 @app.route('/providers/personal-training')
+@conditional(listing_versions)
 def training_providers():
     """View personal training providers"""
     current_user = get_current_user()
@@ -994,6 +2745,7 @@ def training_providers():
     return render_template('training_providers.html', providers=training_providers, current_user=current_user)
 
 @app.route('/providers/yoga-classes')
+@conditional(listing_versions)
 def yoga_providers():
     """View yoga classes providers"""
     current_user = get_current_user()
@@ -1001,6 +2753,7 @@ def yoga_providers():
     return render_template('yoga_providers.html', providers=yoga_providers, current_user=current_user)
 
 @app.route('/providers/eyebrow-eyelash')
+@conditional(listing_versions)
 def eyebrow_providers():
     """View eyebrow & eyelash providers"""
     current_user = get_current_user()
@@ -1008,6 +2761,7 @@ def eyebrow_providers():
     return render_template('eyebrow_providers.html', providers=eyebrow_providers, current_user=current_user)
 
 @app.route('/providers/aromatherapy')
+@conditional(listing_versions)
 def aromatherapy_providers():
     """View aromatherapy providers"""
     current_user = get_current_user()
@@ -1015,6 +2769,7 @@ def aromatherapy_providers():
     return render_template('aromatherapy_providers.html', providers=aromatherapy_providers, current_user=current_user)
 
 @app.route('/providers/pilates')
+@conditional(listing_versions)
 def pilates_providers():
     """View pilates providers"""
     current_user = get_current_user()
@@ -1022,6 +2777,7 @@ def pilates_providers():
     return render_template('pilates_providers.html', providers=pilates_providers, current_user=current_user)
 
 @app.route('/providers/dermatology')
+@conditional(listing_versions)
 def dermatology_providers():
     """View dermatology providers"""
     current_user = get_current_user()
@@ -1029,6 +2785,7 @@ def dermatology_providers():
     return render_template('dermatology_providers.html', providers=dermatology_providers, current_user=current_user)
 
 @app.route('/providers/physical-therapy')
+@conditional(listing_versions)
 def physical_therapy_providers():
     """View physical therapy providers"""
     current_user = get_current_user()
@@ -1036,6 +2793,7 @@ def physical_therapy_providers():
     return render_template('physical_therapy_providers.html', providers=physical_therapy_providers, current_user=current_user)
 
 @app.route('/providers/nutrition-consulting')
+@conditional(listing_versions)
 def nutrition_providers():
     """View nutrition consulting providers"""
     current_user = get_current_user()
@@ -1043,6 +2801,7 @@ def nutrition_providers():
     return render_template('nutrition_providers.html', providers=nutrition_providers, current_user=current_user)
 
 @app.route('/providers/makeup-artist')
+@conditional(listing_versions)
 def makeup_providers():
     """View makeup artist providers"""
     current_user = get_current_user()
@@ -1050,6 +2809,7 @@ def makeup_providers():
     return render_template('makeup_providers.html', providers=makeup_providers, current_user=current_user)
 
 @app.route('/providers/photography')
+@conditional(listing_versions)
 def photography_providers():
     """View photography providers"""
     current_user = get_current_user()
@@ -1063,10 +2823,11 @@ def find_near_you():
     return render_template('find_near_you.html', current_user=current_user)
 
 @app.route('/api/providers')
+@conditional(lambda: [store_versions.version('users')], personal=False)
 def api_providers():
     """API endpoint to get all providers with their location data"""
     providers = []
-    for user in user_manager.users:
+    for user in user_manager.active_users():
         if user.get('role') == 'provider' and user.get('address'):
             provider_data = {
                 'id': user['id'],
@@ -1081,7 +2842,65 @@ def api_providers():
             providers.append(provider_data)
     return jsonify(providers)
 
+@app.route('/api/providers/browse')
+def api_browse_providers():
+    """Filtered, sorted and paged providers plus per-facet counts"""
+    page = browse_providers()
+    return jsonify({
+        'total': page.total,
+        'page': page.page,
+        'pages': page.pages,
+        'per_page': page.per_page,
+        'sort': page.sort,
+        'providers': [{
+            'id': provider['id'],
+            'name': provider.get('name', ''),
+            'business_name': provider.get('business_name', ''),
+            'service_category': provider.get('service_category', ''),
+            'services_offered': provider.get('services_offered', ''),
+            'address': provider.get('address', ''),
+            'average_rating': round(provider['average_rating'], 2),
+            'total_reviews': provider['total_reviews'],
+            'url': url_for('provider_profile', provider_id=provider['id']),
+        } for provider in page],
+        'facets': provider_facets.counts(page.category, page.min_rating, page.days),
+    })
+
+@app.route('/api/search')
+def api_search():
+    """Ranked provider search; the last word of q is completed as a prefix
+    
+    Optional: category (service category key), limit, suggest=1 to also
+    return completions for the word being typed.
+    """
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 20, type=int) or 20, app.config['SEARCH_MAX_RESULTS']))
+    category = request.args.get('category')
+    allowed = None
+    if category:
+        allowed = {user['id'] for user in user_manager.active_users()
+                   if user.get('role') == 'provider' and user.get('service_category') == category}
+    
+    results = []
+    for provider_id, score in search_index.search(query, limit=limit, allowed=allowed):
+        result = dict(search_index.summary(provider_id))
+        result['score'] = round(score, 4)
+        result['url'] = url_for('provider_profile', provider_id=provider_id)
+        results.append(result)
+    
+    response = {'query': query, 'results': results}
+    if request.args.get('suggest') == '1':
+        response['suggestions'] = search_index.suggest(query)
+    return jsonify(response)
+
+@app.route('/api/search/suggest')
+def api_search_suggest():
+    """Completions for the last word of q, most common first"""
+    return jsonify({'suggestions': search_index.suggest(request.args.get('q', ''),
+                                                        limit=max(1, min(request.args.get('limit', 8, type=int) or 8, 20)))})
+
 @app.route('/providers/life-coaching')
+@conditional(listing_versions)
 def lifecoaching_providers():
     """View life coaching providers"""
     current_user = get_current_user()
@@ -1092,6 +2911,7 @@ def lifecoaching_providers():
 
 @app.route('/appointment/<int:appointment_id>/complete', methods=['POST'])
 @login_required
+@idempotent
 def complete_appointment(appointment_id):
     """Mark an appointment as completed"""
     current_user = get_current_user()
@@ -1100,36 +2920,69 @@ def complete_appointment(appointment_id):
         return jsonify({'success': False, 'error': 'Only providers can complete appointments'}), 403
     
     try:
-        appointment = next((apt for apt in scheduler.appointments if apt['id'] == appointment_id), None)
-        
-        if not appointment:
-            return jsonify({'success': False, 'error': 'Appointment not found'}), 404
-        
-        if appointment.get('provider_id') != current_user['id']:
-            return jsonify({'success': False, 'error': 'Not your appointment'}), 403
-        
-        if appointment.get('status') != 'confirmed':
-            return jsonify({'success': False, 'error': 'Only confirmed appointments can be completed'}), 400
-        
-        # Check if appointment time has been reached
-        appointment_datetime = appointment.get('datetime')
-        if appointment_datetime:
-            if isinstance(appointment_datetime, str):
-                appointment_datetime = datetime.fromisoformat(appointment_datetime.replace('Z', '+00:00'))
+        # Checked and set under the provider's write lock, so the transition engine (or
+        # another worker) cannot change the status in between
+        with scheduler.provider_lock(current_user['id']):
+            appointment = next((apt for apt in scheduler.appointments if apt['id'] == appointment_id), None)
             
-            current_time = datetime.now()
-            if current_time < appointment_datetime:
-                return jsonify({'success': False, 'error': 'Cannot complete appointment before its scheduled time'}), 400
-        
-        appointment['status'] = 'completed'
-        appointment['completed_at'] = datetime.now().isoformat()
-        scheduler.save_appointments()
+            if not appointment:
+                return jsonify({'success': False, 'error': 'Appointment not found'}), 404
+            
+            if appointment.get('provider_id') != current_user['id']:
+                return jsonify({'success': False, 'error': 'Not your appointment'}), 403
+            
+            if appointment.get('status') != 'confirmed':
+                return jsonify({'success': False, 'error': 'Only confirmed appointments can be completed'}), 400
+            
+            # Check if appointment time has been reached
+            appointment_datetime = appointment.get('datetime')
+            if appointment_datetime:
+                if isinstance(appointment_datetime, str):
+                    appointment_datetime = datetime.fromisoformat(appointment_datetime.replace('Z', '+00:00'))
+            
+                current_time = datetime.now()
+                if current_time < appointment_datetime:
+                    return jsonify({'success': False, 'error': 'Cannot complete appointment before its scheduled time'}), 400
+            
+            scheduler.set_status(appointment, 'completed', completed_at=datetime.now().isoformat())
         
         return jsonify({'success': True})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/appointments/bulk', methods=['POST'])
+@login_required
+def bulk_appointments():
+    """Create, confirm, decline, complete or cancel many appointments in one all-or-nothing batch"""
+    current_user = get_current_user()
+    payload = request.get_json(silent=True) or {}
+    operations = payload.get('operations')
+    
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'error': 'Expected a non-empty list of operations'}), 400
+    
+    if len(operations) > app.config['BULK_MAX_OPERATIONS']:
+        return jsonify({'success': False,
+                        'error': f"At most {app.config['BULK_MAX_OPERATIONS']} operations per request"}), 400
+    
+    # Plan and apply under the locks of every schedule the batch touches
+    with scheduler.locked_providers(bulk.provider_ids(scheduler, operations, current_user, user_manager.get_user_by_id)):
+        plan = bulk.plan_operations(scheduler, operations, current_user, user_manager.get_user_by_id)
+        if not plan.ok:
+            for result in plan.results:
+                if result['success']:
+                    result['success'] = False
+                    result['error'] = bulk.NOT_APPLIED
+            return jsonify({'success': False, 'results': plan.results}), 400
+        
+        new_appointments = [appointment for _, appointment in plan.creates]
+        scheduler.apply_bulk(new_appointments, plan.changes, plan.cancellations)
+    for index, appointment in plan.creates:
+        plan.results[index]['id'] = appointment['id']
+    
+    return jsonify({'success': True, 'results': plan.results})
+
 @app.route('/profile/availability/update', methods=['POST'])
 @login_required
 def update_availability():
@@ -1142,14 +2995,9 @@ def update_availability():
     try:
         availability_data = request.get_json()
         
-        # Get user from database
-        user = next((u for u in user_manager.users if u['id'] == current_user['id']), None)
-        if not user:
-            return jsonify({'success': False, 'error': 'User not found'}), 404
-        
         # Update availability
-        user['availability'] = availability_data
-        user_manager.save_users()
+        if not user_manager.update_user(current_user['id'], availability=availability_data):
+            return jsonify({'success': False, 'error': 'User not found'}), 404
         
         return jsonify({'success': True})
     
@@ -1159,6 +3007,7 @@ def update_availability():
 
 @app.route('/appointment/<int:appointment_id>/review', methods=['GET', 'POST'])
 @login_required
+@idempotent
 def review_appointment(appointment_id):
     """Review an appointment - both customer and provider can review"""
     current_user = get_current_user()
@@ -1241,7 +3090,9 @@ def reviews():
     # Calculate average rating
     average_rating = review_manager.calculate_average_rating(current_user['id'])
     
-    # Add reviewer/reviewed user names to reviews
+    # Add reviewer/reviewed user names to display copies, not the stored reviews
+    received_reviews = [dict(review) for review in received_reviews]
+    written_reviews = [dict(review) for review in written_reviews]
     for review in received_reviews + written_reviews:
         reviewer = user_manager.get_user_by_id(review['reviewer_id'])
         reviewed = user_manager.get_user_by_id(review['reviewed_id'])
@@ -1259,12 +3110,15 @@ def reviews():
                          current_user=current_user)
 
 @app.route('/api/reviews/<int:user_id>')
+@conditional(lambda user_id: [store_versions.version('reviews', user_id), store_versions.version('users')],
+             personal=False)
 def api_user_reviews(user_id):
     """API endpoint to get reviews for a specific user"""
     reviews = review_manager.get_reviews_for_user(user_id)
     average_rating = review_manager.calculate_average_rating(user_id)
     
     # Add reviewer names
+    reviews = [dict(review) for review in reviews]
     for review in reviews:
         reviewer = user_manager.get_user_by_id(review['reviewer_id'])
         review['reviewer_name'] = reviewer.get('name', reviewer.get('username', 'Anonymous')) if reviewer else 'Anonymous'
@@ -1278,6 +3132,10 @@ def api_user_reviews(user_id):
 
 
 @app.route('/provider/<int:provider_id>')
+@conditional(lambda provider_id: [store_versions.version('users'), store_versions.version('reviews', provider_id),
+                                  store_versions.version('appointments', provider_id),
+                                  # The upcoming count drops when the next appointment starts
+                                  scheduler.next_start(provider_id, datetime.now())])
 def provider_profile(provider_id):
     """Individual provider profile page"""
     current_user = get_current_user()
@@ -1293,6 +3151,7 @@ def provider_profile(provider_id):
     average_rating = review_manager.calculate_average_rating(provider_id)
     
     # Add reviewer names and appointment details
+    provider_reviews = [dict(review) for review in provider_reviews]
     for review in provider_reviews:
         reviewer = user_manager.get_user_by_id(review['reviewer_id'])
         review['reviewer_name'] = reviewer.get('name', reviewer.get('username', 'Anonymous')) if reviewer else 'Anonymous'
@@ -1305,11 +3164,9 @@ def provider_profile(provider_id):
     provider_reviews.sort(key=lambda x: x['created_at'], reverse=True)
     
     # Get provider's upcoming appointments (for availability indication)
-    all_appointments = scheduler.get_appointments()
-    provider_appointments = [apt for apt in all_appointments 
-                           if apt.get('provider_id') == provider_id and 
-                              apt.get('status') in ['confirmed', 'pending'] and
-                              apt['datetime'] >= datetime.now()]
+    provider_appointments = [apt for apt in scheduler.get_provider_appointments(provider_id)
+                             if apt.get('status') in ['confirmed', 'pending'] and
+                                apt['datetime'] >= datetime.now()]
     
     return render_template('provider_profile.html', 
                          provider=provider,
@@ -1320,6 +3177,8 @@ def provider_profile(provider_id):
                          current_user=current_user)
 
 @app.route('/provider/<int:provider_id>/reviews')
+@conditional(lambda provider_id: [store_versions.version('users'), store_versions.version('reviews', provider_id),
+                                  store_versions.version('appointments', provider_id)])
 def provider_reviews(provider_id):
     """View all reviews for a specific provider - public access for customers"""
     current_user = get_current_user()
@@ -1335,6 +3194,7 @@ def provider_reviews(provider_id):
     average_rating = review_manager.calculate_average_rating(provider_id)
     
     # Add reviewer names and appointment details
+    provider_reviews = [dict(review) for review in provider_reviews]
     for review in provider_reviews:
         reviewer = user_manager.get_user_by_id(review['reviewer_id'])
         review['reviewer_name'] = reviewer.get('name', reviewer.get('username', 'Anonymous')) if reviewer else 'Anonymous'
@@ -1363,17 +3223,29 @@ def provider_appointments():
         flash('Only providers can access this page.', 'error')
         return redirect(url_for('profile'))
     
+    # Taken first: the page's live feed replays anything that changes after this point
+    feed_position = event_broker.last_event_id()
+    
     # Get all appointments for this provider
-    all_appointments = scheduler.get_appointments()
-    provider_appointments = [apt for apt in all_appointments if apt.get('provider_id') == current_user['id']]
+    provider_appointments = [dict(apt) for apt in scheduler.get_provider_appointments(current_user['id'])]
+    
+    # Recurring bookings: pending series await a decision, confirmed ones show their next occurrences
+    now = datetime.now()
+    pending_series = [dict(series) for series in scheduler.get_provider_series(current_user['id'])
+                      if series['status'] == 'pending']
+    occurrences = scheduler.get_occurrences(now - timedelta(weeks=1),
+                                            now + timedelta(weeks=app.config['SERIES_LISTING_WEEKS']),
+                                            provider_id=current_user['id'])
+    occurrences = [occurrence for occurrence in occurrences if occurrence['status'] == 'confirmed']
     
     # Separate by status
     pending_appointments = [apt for apt in provider_appointments if apt.get('status') == 'pending']
     confirmed_appointments = [apt for apt in provider_appointments if apt.get('status') == 'confirmed']
+    confirmed_appointments = list(heapq.merge(confirmed_appointments, occurrences, key=lambda apt: apt['datetime']))
     completed_appointments = [apt for apt in provider_appointments if apt.get('status') == 'completed']
     
     # Add customer names to appointments
-    for apt in provider_appointments:
+    for apt in provider_appointments + occurrences + pending_series:
         customer = user_manager.get_user_by_id(apt.get('user_id'))
         apt['customer_name'] = customer.get('name', customer.get('username', 'Unknown')) if customer else 'Unknown'
         apt['customer_phone'] = customer.get('phone', '') if customer else ''
@@ -1381,13 +3253,102 @@ def provider_appointments():
     
     return render_template('provider_appointments.html', 
                          pending_appointments=pending_appointments,
+                         pending_series=pending_series,
                          confirmed_appointments=confirmed_appointments,
                          completed_appointments=completed_appointments,
                          current_user=current_user,
-                         now=datetime.now())
+                         now=datetime.now(),
+                         feed_position=feed_position)
+
+@app.route('/provider/appointments/events')
+@login_required
+def provider_appointment_events():
+    """Live booking events for the signed-in provider's dashboard (text/event-stream)
+    
+    Resumes after the Last-Event-ID header (or ?last_event_id= on the first
+    connection). Under serve.py the connection is handed to the event hub once
+    the headers are sent, so it does not hold a request thread while idle.
+    """
+    current_user = get_current_user()
+    if current_user.get('role') != 'provider':
+        return jsonify({'success': False, 'error': 'Only providers have a booking feed'}), 403
+    
+    provider_id = current_user['id']
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    detach = request.environ.get('serve.detach')
+    if detach is None:
+        return Response(sse.stream(event_broker, provider_id, last_event_id, app.config['SSE_HEARTBEAT_SECONDS']),
+                        mimetype='text/event-stream', headers=headers)
+    if not event_hub.has_room():
+        response = jsonify({'success': False, 'error': 'Too many live connections, try again shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    detach(lambda sock: event_hub.attach(sock, provider_id, last_event_id))
+    # Headers only; the hub writes the events
+    return Response(iter(()), mimetype='text/event-stream', headers=headers)
+
+def _analytics_weeks():
+    """Report length from ?weeks=, clamped to [1, ANALYTICS_MAX_WEEKS]"""
+    weeks = request.args.get('weeks', app.config['ANALYTICS_WEEKS'], type=int) or app.config['ANALYTICS_WEEKS']
+    return max(1, min(weeks, app.config['ANALYTICS_MAX_WEEKS']))
+
+@app.route('/provider/analytics')
+@login_required
+def provider_analytics_page():
+    """Provider utilization dashboard"""
+    current_user = get_current_user()
+    
+    if current_user.get('role') != 'provider':
+        flash('Only providers can access this page.', 'error')
+        return redirect(url_for('profile'))
+    
+    report = provider_analytics.report(current_user['id'], _analytics_weeks())
+    return render_template('provider_analytics.html', report=report, current_user=current_user)
+
+@app.route('/api/provider/analytics')
+@login_required
+def api_provider_analytics():
+    """Utilization heatmap, request rates, no-shows and weekly trend for the current provider"""
+    current_user = get_current_user()
+    
+    if current_user.get('role') != 'provider':
+        return jsonify({'success': False, 'error': 'Only providers have analytics'}), 403
+    
+    return jsonify(provider_analytics.report(current_user['id'], _analytics_weeks()))
+
+@app.route('/api/changes')
+def api_changes():
+    """Store changes after ?since=<seq>, oldest first, for consumers following the stores (see changes.py)
+    
+    Needs the CHANGES_TOKEN in an X-Changes-Token header. ?limit= caps the
+    batch; with ?wait=<seconds> an empty batch waits (up to
+    CHANGES_MAX_WAIT_SECONDS) for the next change. A consumer whose since is
+    no longer in the log gets reset=true: it reloads, then follows from next.
+    """
+    token = app.config['CHANGES_TOKEN']
+    if (not app.config['CHANGES_ENABLED'] or not token
+            or not hmac.compare_digest(request.headers.get('X-Changes-Token', ''), token)):
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    
+    since = max(0, request.args.get('since', 0, type=int) or 0)
+    limit = max(1, min(request.args.get('limit', 100, type=int) or 100, app.config['CHANGES_MAX_BATCH']))
+    wait = max(0.0, min(request.args.get('wait', 0, type=float) or 0.0, app.config['CHANGES_MAX_WAIT_SECONDS']))
+    try:
+        events = change_log.read(since, limit)
+        if not events and wait and change_log.wait(since, wait):
+            events = change_log.read(since, limit)
+    except changes.ChangesExpired as e:
+        return jsonify({'success': True, 'reset': True, 'events': [], 'next': change_log.last_seq,
+                        'oldest': e.oldest, 'latest': change_log.last_seq})
+    return jsonify({'success': True, 'reset': False, 'events': events,
+                    'next': events[-1]['seq'] if events else since,
+                    'oldest': change_log.oldest_seq, 'latest': change_log.last_seq})
 
 @app.route('/appointment/<int:appointment_id>/confirm', methods=['POST'])
 @login_required
+@idempotent
 def confirm_appointment(appointment_id):
     """Confirm a pending appointment"""
     current_user = get_current_user()
@@ -1396,19 +3357,21 @@ def confirm_appointment(appointment_id):
         return jsonify({'success': False, 'error': 'Only providers can confirm appointments'}), 403
     
     try:
-        appointment = next((apt for apt in scheduler.appointments if apt['id'] == appointment_id), None)
-        
-        if not appointment:
-            return jsonify({'success': False, 'error': 'Appointment not found'}), 404
-        
-        if appointment.get('provider_id') != current_user['id']:
-            return jsonify({'success': False, 'error': 'Not your appointment'}), 403
-        
-        if appointment.get('status') != 'pending':
-            return jsonify({'success': False, 'error': 'Only pending appointments can be confirmed'}), 400
-        
-        appointment['status'] = 'confirmed'
-        scheduler.save_appointments()
+        # Checked and set under the provider's write lock, so the transition engine (or
+        # another worker) cannot change the status in between
+        with scheduler.provider_lock(current_user['id']):
+            appointment = next((apt for apt in scheduler.appointments if apt['id'] == appointment_id), None)
+            
+            if not appointment:
+                return jsonify({'success': False, 'error': 'Appointment not found'}), 404
+            
+            if appointment.get('provider_id') != current_user['id']:
+                return jsonify({'success': False, 'error': 'Not your appointment'}), 403
+            
+            if appointment.get('status') != 'pending':
+                return jsonify({'success': False, 'error': 'Only pending appointments can be confirmed'}), 400
+            
+            scheduler.set_status(appointment, 'confirmed')
         
         return jsonify({'success': True})
     
@@ -1417,6 +3380,7 @@ def confirm_appointment(appointment_id):
 
 @app.route('/appointment/<int:appointment_id>/decline', methods=['POST'])
 @login_required
+@idempotent
 def decline_appointment(appointment_id):
     """Decline a pending appointment"""
     current_user = get_current_user()
@@ -1425,24 +3389,120 @@ def decline_appointment(appointment_id):
         return jsonify({'success': False, 'error': 'Only providers can decline appointments'}), 403
     
     try:
-        appointment = next((apt for apt in scheduler.appointments if apt['id'] == appointment_id), None)
+        # Checked and set under the provider's write lock, so the transition engine (or
+        # another worker) cannot change the status in between
+        with scheduler.provider_lock(current_user['id']):
+            appointment = next((apt for apt in scheduler.appointments if apt['id'] == appointment_id), None)
+            
+            if not appointment:
+                return jsonify({'success': False, 'error': 'Appointment not found'}), 404
+            
+            if appointment.get('provider_id') != current_user['id']:
+                return jsonify({'success': False, 'error': 'Not your appointment'}), 403
+            
+            if appointment.get('status') != 'pending':
+                return jsonify({'success': False, 'error': 'Only pending appointments can be declined'}), 400
+            
+            scheduler.set_status(appointment, 'declined')
         
-        if not appointment:
-            return jsonify({'success': False, 'error': 'Appointment not found'}), 404
+        return jsonify({'success': True})
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/series/<int:series_id>/confirm', methods=['POST'])
+@login_required
+@idempotent
+def confirm_series(series_id):
+    """Confirm a pending recurring booking"""
+    return _decide_series(series_id, 'confirmed')
+
+@app.route('/series/<int:series_id>/decline', methods=['POST'])
+@login_required
+@idempotent
+def decline_series(series_id):
+    """Decline a pending recurring booking"""
+    return _decide_series(series_id, 'declined')
+
+def _decide_series(series_id, status):
+    current_user = get_current_user()
+    
+    if current_user.get('role') != 'provider':
+        return jsonify({'success': False, 'error': 'Only providers can confirm or decline appointments'}), 403
+    
+    with scheduler.provider_lock(current_user['id'], series=True):
+        series = scheduler.get_series(series_id)
+        if not series:
+            return jsonify({'success': False, 'error': 'Recurring appointment not found'}), 404
         
-        if appointment.get('provider_id') != current_user['id']:
+        if series.get('provider_id') != current_user['id']:
             return jsonify({'success': False, 'error': 'Not your appointment'}), 403
         
-        if appointment.get('status') != 'pending':
-            return jsonify({'success': False, 'error': 'Only pending appointments can be declined'}), 400
+        if series['status'] != 'pending':
+            return jsonify({'success': False, 'error': 'Only pending appointments can be confirmed or declined'}), 400
         
-        appointment['status'] = 'declined'
-        scheduler.save_appointments()
-        
-        return jsonify({'success': True})
+        scheduler.set_series_status(series, status)
+    return jsonify({'success': True})
+
+@app.route('/series/<int:series_id>/cancel', methods=['POST'])
+@login_required
+def cancel_series(series_id):
+    """Cancel all remaining occurrences of a recurring booking"""
+    current_user = get_current_user()
+    series = scheduler.get_series(series_id)
+    if not series or current_user['id'] not in (series.get('user_id'), series.get('provider_id')):
+        flash('Recurring appointment not found.', 'error')
+    else:
+        scheduler.set_series_status(series, 'cancelled')
+        flash('Recurring appointment cancelled.', 'success')
+    return redirect(url_for('appointments'))
+
+@app.route('/series/<int:series_id>/skip/<occurrence_date>', methods=['POST'])
+@login_required
+def skip_occurrence(series_id, occurrence_date):
+    """Cancel a single occurrence of a recurring booking"""
+    current_user = get_current_user()
+    series = scheduler.get_series(series_id)
+    if not series or current_user['id'] not in (series.get('user_id'), series.get('provider_id')):
+        flash('Recurring appointment not found.', 'error')
+    elif scheduler.skip_occurrence(series, occurrence_date) is None:
+        # Not a YYYY-MM-DD date with a session of this series (or skipped already)
+        flash('That date is not part of the recurring appointment.', 'error')
+    else:
+        flash(f'Appointment on {occurrence_date} cancelled. The rest of the series is unchanged.', 'success')
+    return redirect(url_for('appointments'))
+
+@app.route('/series/<int:series_id>/occurrence/<occurrence_date>/complete', methods=['POST'])
+@login_required
+@idempotent
+def complete_occurrence(series_id, occurrence_date):
+    """Mark one occurrence of a confirmed series as completed"""
+    current_user = get_current_user()
     
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+    if current_user.get('role') != 'provider':
+        return jsonify({'success': False, 'error': 'Only providers can complete appointments'}), 403
+    
+    series = scheduler.get_series(series_id)
+    if not series:
+        return jsonify({'success': False, 'error': 'Appointment not found'}), 404
+    
+    if series.get('provider_id') != current_user['id']:
+        return jsonify({'success': False, 'error': 'Not your appointment'}), 403
+    
+    if series['status'] != 'confirmed':
+        return jsonify({'success': False, 'error': 'Only confirmed appointments can be completed'}), 400
+    
+    occurrence = scheduler.get_occurrence(series, occurrence_date)
+    if not occurrence:
+        return jsonify({'success': False, 'error': 'Appointment not found'}), 404
+    
+    if datetime.now() < occurrence['datetime']:
+        return jsonify({'success': False, 'error': 'Cannot complete appointment before its scheduled time'}), 400
+    
+    # Completing gives the occurrence its own appointment record so it can be reviewed
+    appointment = scheduler.materialize_occurrence(series, occurrence_date, status='completed',
+                                                   completed_at=datetime.now().isoformat())
+    return jsonify({'success': True, 'appointment_id': appointment['id']})
 
 @app.route('/provider/gallery/upload', methods=['POST'])
 @login_required
@@ -1472,26 +3532,17 @@ def upload_gallery_image():
             if len(image_data) > 5 * 1024 * 1024:  # 5MB limit
                 return jsonify({'success': False, 'error': 'Image too large. Maximum size is 5MB.'}), 400
             
-            # Get user from database
-            user = next((u for u in user_manager.users if u['id'] == current_user['id']), None)
-            if not user:
-                return jsonify({'success': False, 'error': 'User not found'}), 404
-            
-            # Initialize gallery if it doesn't exist
-            if 'gallery' not in user:
-                user['gallery'] = []
-            
-            # Create gallery image entry
-            gallery_image = {
-                'id': len(user['gallery']) + 1,
+            # Create gallery image entry (the user manager assigns its id)
+            gallery_image = user_manager.add_gallery_image(current_user['id'], {
                 'filename': file.filename,
                 'data': f"data:image/{ext};base64,{base64.b64encode(image_data).decode()}",
+                # Downscaled variants are rendered in the background
+                'media': image_variants.store(image_data, ext),
                 'uploaded_at': datetime.now().isoformat(),
                 'description': request.form.get('description', '').strip()
-            }
-            
-            user['gallery'].append(gallery_image)
-            user_manager.save_users()
+            })
+            if not gallery_image:
+                return jsonify({'success': False, 'error': 'User not found'}), 404
             
             return jsonify({'success': True, 'image_id': gallery_image['id']})
         
@@ -1519,18 +3570,25 @@ def delete_gallery_image(image_id):
             return jsonify({'success': False, 'error': 'No gallery found'}), 404
         
         # Find and remove the image
-        original_length = len(user['gallery'])
-        user['gallery'] = [img for img in user['gallery'] if img['id'] != image_id]
-        
-        if len(user['gallery']) == original_length:
+        if not user_manager.remove_gallery_image(user['id'], image_id):
             return jsonify({'success': False, 'error': 'Image not found'}), 404
         
-        user_manager.save_users()
         return jsonify({'success': True})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/media/<digest>/<variant>')
+def media_file(digest, variant):
+    """An uploaded image variant (thumb, card, full or original), by content digest"""
+    path, content_type, final = image_variants.lookup(digest, variant)
+    if path is None:
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    response = send_file(path, mimetype=content_type, conditional=True)
+    # Content-addressed, so a rendered variant never changes; the stand-in original is only temporary
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if final else 'public, max-age=60'
+    return response
+
 @app.route('/logout')
 def logout():
     """Logout user"""
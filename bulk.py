@@ -0,0 +1,184 @@
+"""
+Bulk appointment operations
+
+A batch is a list of operations such as
+``{"op": "confirm", "id": 12}`` or
+``{"op": "create", "provider_id": 3, "type": "hair", "date": "2026-05-04", "time": "10:00", "duration": 60}``.
+Every operation is validated against the current state before anything is
+changed; conflicts for all new bookings are found with one sorted sweep per
+provider, and the batch is applied all-or-nothing with a single save.
+"""
+
+from datetime import datetime
+
+from records import Appointment
+
+OPERATIONS = ('create', 'confirm', 'decline', 'complete', 'cancel')
+
+# op -> (required current status, new status)
+STATUS_CHANGES = {
+    'confirm': ('pending', 'confirmed'),
+    'decline': ('pending', 'declined'),
+    'complete': ('confirmed', 'completed'),
+}
+
+# Statuses a provider may give bookings imported into their own calendar
+IMPORT_STATUSES = ('pending', 'confirmed')
+
+NOT_APPLIED = 'Not applied because another operation in the batch failed'
+
+
+class BulkPlan:
+    """Validated changes for one batch, plus a result entry per operation"""
+
+    def __init__(self):
+        self.results = []
+        self.creates = []  # (result index, new appointment)
+        self.changes = []  # (appointment, status, fields)
+        self.cancellations = []
+
+    @property
+    def ok(self):
+        return all(result['success'] for result in self.results)
+
+    def fail(self, index, error):
+        self.results[index]['success'] = False
+        self.results[index]['error'] = error
+
+
+def _parse_create(operation, actor, get_user, appointment_types):
+    """New appointment record for a create operation (without an id); raises ValueError"""
+    try:
+        start = datetime.strptime(f"{operation.get('date')} {operation.get('time')}", "%Y-%m-%d %H:%M")
+        duration = int(operation.get('duration'))
+    except (TypeError, ValueError):
+        raise ValueError('date (YYYY-MM-DD), time (HH:MM) and duration (minutes) are required')
+    if duration <= 0:
+        raise ValueError('duration must be positive')
+
+    provider_id = operation.get('provider_id')
+    if actor.get('role') == 'provider' and provider_id in (None, actor['id']):
+        # A provider importing bookings into their own calendar
+        provider_id = actor['id']
+        user_id = operation.get('user_id')
+        if user_id is not None and not get_user(user_id):
+            raise ValueError(f'Customer {user_id} not found')
+        status = operation.get('status', 'confirmed')
+        if status not in IMPORT_STATUSES:
+            raise ValueError(f"status must be one of: {', '.join(IMPORT_STATUSES)}")
+    else:
+        # A customer booking with a provider
+        provider = get_user(provider_id) if provider_id is not None else None
+        if not provider or provider.get('role') != 'provider':
+            raise ValueError('A valid provider_id is required')
+        user_id = operation.get('user_id', actor['id'])
+        if user_id != actor['id']:
+            raise ValueError('You can only book appointments for yourself')
+        status = 'pending'
+
+    appointment_type = operation.get('type', '')
+    if not isinstance(appointment_type, str):
+        raise ValueError('type must be a string')
+    return Appointment(
+        id=None,
+        type=appointment_types.get(appointment_type, appointment_type),
+        datetime=start,
+        duration=duration,
+        notes=operation.get('notes', ''),
+        created_at=datetime.now(),
+        user_id=user_id,
+        provider_id=provider_id,
+        status=status
+    )
+
+
+def provider_ids(scheduler, operations, actor, get_user):
+    """Providers whose schedules a batch touches (their locks are held while it is planned and applied)"""
+    by_id = {appointment['id']: appointment for appointment in scheduler.appointments}
+    providers = set()
+    for operation in operations:
+        if not isinstance(operation, dict):
+            continue
+        if operation.get('op') == 'create':
+            provider_id = operation.get('provider_id')
+            if actor.get('role') == 'provider' and provider_id in (None, actor['id']):
+                providers.add(actor['id'])
+            elif isinstance(provider_id, int) and (get_user(provider_id) or {}).get('role') == 'provider':
+                providers.add(provider_id)
+        else:
+            operation_id = operation.get('id')
+            appointment = by_id.get(operation_id) if isinstance(operation_id, int) else None
+            if appointment is not None:
+                providers.add(appointment.get('provider_id'))
+    return providers
+
+
+def plan_operations(scheduler, operations, actor, get_user, now=None):
+    """Validate a batch against the current appointments and return a BulkPlan
+
+    Checks ownership and current status per operation, rejects operations that
+    touch the same appointment twice, and runs the conflict sweep for every
+    create at once (slots released by cancels and declines in the same batch
+    count as free).
+    """
+    now = now or datetime.now()
+    plan = BulkPlan()
+    by_id = {appointment['id']: appointment for appointment in scheduler.appointments}
+    touched = set()
+
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        result = {'index': index, 'op': op, 'id': None, 'success': True}
+        plan.results.append(result)
+        if op not in OPERATIONS:
+            plan.fail(index, f"op must be one of: {', '.join(OPERATIONS)}")
+            continue
+
+        if op == 'create':
+            try:
+                plan.creates.append((index, _parse_create(operation, actor, get_user,
+                                                          scheduler.appointment_types)))
+            except ValueError as e:
+                plan.fail(index, str(e))
+            continue
+
+        appointment = by_id.get(operation.get('id'))
+        result['id'] = operation.get('id')
+        if appointment is None:
+            plan.fail(index, 'Appointment not found')
+            continue
+        if appointment['id'] in touched:
+            plan.fail(index, 'Appointment appears more than once in the batch')
+            continue
+        touched.add(appointment['id'])
+
+        if op == 'cancel':
+            if actor['id'] not in (appointment.get('user_id'), appointment.get('provider_id')):
+                plan.fail(index, 'Not your appointment')
+            else:
+                plan.cancellations.append(appointment)
+            continue
+
+        if actor.get('role') != 'provider' or appointment.get('provider_id') != actor['id']:
+            plan.fail(index, 'Not your appointment')
+            continue
+        expected, status = STATUS_CHANGES[op]
+        if appointment.get('status') != expected:
+            plan.fail(index, f'Only {expected} appointments can be {status}')
+            continue
+        fields = {}
+        if op == 'complete':
+            if now < appointment['datetime']:
+                plan.fail(index, 'Cannot complete appointment before its scheduled time')
+                continue
+            fields['completed_at'] = now.isoformat()
+        plan.changes.append((appointment, status, fields))
+
+    if plan.creates:
+        released = plan.cancellations + [apt for apt, status, _ in plan.changes
+                                         if status in scheduler.INACTIVE_STATUSES]
+        new_appointments = [appointment for _, appointment in plan.creates]
+        for position in scheduler.batch_conflicts(new_appointments, released):
+            plan.fail(plan.creates[position][0], 'Time slot is not available')
+
+    return plan
@@ -0,0 +1,215 @@
+"""
+Change-data capture: every store mutation as a sequenced event
+
+The user, appointment and review stores append one line per change to a
+shared JSON-lines log, after the change is saved:
+
+    {"seq":41,"at":"2026-01-02T10:00:00.123456","entity":"appointment","id":12,"op":"updated","fields":{"status":"confirmed"}}
+
+``op`` is ``created`` (fields: the whole record), ``updated`` (fields: only
+what changed) or ``deleted`` (no fields). Sequence numbers increase across
+all entities and all worker processes, so a consumer that remembers the last
+seq it applied can catch up with everything after it instead of reloading
+the stores. Fields that are secret or large (passwords, image data) are
+reported as changed with a null value; read the record for those.
+
+The log keeps the newest ``max_events`` events. A consumer that falls
+further behind gets ``ChangesExpired`` (or ``reset`` from the API) and has
+to reload once before following again.
+"""
+
+import json
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime
+
+import records
+from locks import exclusive_file_lock
+
+
+class ChangesExpired(LookupError):
+    """The events after since are no longer in the log (or the log was replaced)"""
+
+    def __init__(self, since, oldest):
+        super().__init__(f'changes after {since} are gone; the log starts at {oldest}')
+        self.since = since
+        self.oldest = oldest
+
+
+def _seq_of(line):
+    # Every line starts with {"seq":N, so the index is built without parsing whole events
+    return int(line[7:line.index(b',')])
+
+
+class ChangeLog:
+    """A bounded, append-only log of store changes shared by worker processes"""
+
+    def __init__(self, path='changes.jsonl', max_events=100000, fsync=False, poll_interval=0.2):
+        self.path = path
+        self.max_events = max_events
+        self.fsync = fsync
+        self.poll_interval = poll_interval  # how often a waiting reader checks for other processes' appends
+        self._lock = threading.Lock()
+        self._appended = threading.Condition()
+        self._seqs = array('q')  # seq of every event in the file, in order
+        self._offsets = array('q')  # byte offset of each of those events
+        self._end = 0
+        self._inode = None
+        self.refresh()
+
+    @property
+    def last_seq(self):
+        """The newest seq in the log (0 while it is empty)"""
+        seqs = self._seqs
+        return seqs[-1] if seqs else 0
+
+    @property
+    def oldest_seq(self):
+        seqs = self._seqs
+        return seqs[0] if seqs else 0
+
+    # Writers
+
+    def append(self, entity, record_id, op, fields=None):
+        """Log one change; returns its seq"""
+        return self.append_many([(entity, record_id, op, fields)])
+
+    def append_many(self, changes):
+        """Log (entity, id, op, fields) changes as consecutive events with one write; returns the last seq"""
+        changes = list(changes)
+        if not changes:
+            return self.last_seq
+        at = datetime.now().isoformat()
+        with self._lock, exclusive_file_lock(self.path + '.lock'):
+            # Other processes may have appended since our last read; seqs continue from theirs
+            self._tail()
+            seq = self.last_seq
+            lines = []
+            for entity, record_id, op, fields in changes:
+                seq += 1
+                event = {'seq': seq, 'at': at, 'entity': entity, 'id': record_id, 'op': op}
+                if op != 'deleted':
+                    event['fields'] = fields or {}
+                lines.append(json.dumps(event, separators=(',', ':'), default=records.json_default) + '\n')
+            with open(self.path, 'a') as f:
+                f.write(''.join(lines))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            self._tail()
+            if len(self._seqs) > self.max_events + max(1, self.max_events // 4):
+                self._compact()
+        with self._appended:
+            self._appended.notify_all()
+        return seq
+
+    def _compact(self):
+        """Keep only the newest max_events events (called with the file lock held)"""
+        cut = self._offsets[len(self._offsets) - self.max_events]
+        tmp_path = self.path + '.tmp'
+        with open(self.path, 'rb') as source, open(tmp_path, 'wb') as target:
+            source.seek(cut)
+            target.write(source.read())
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(tmp_path, self.path)
+        self._inode = None
+        self._tail()
+
+    # Readers
+
+    def refresh(self):
+        """Index events appended (by any process) since the last read"""
+        with self._lock:
+            self._tail()
+
+    def _tail(self):
+        try:
+            with open(self.path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._inode:
+                    # Compacted (or first read): index the rewritten log from the start
+                    self._inode = inode
+                    self._end = 0
+                    self._seqs = array('q')
+                    self._offsets = array('q')
+                f.seek(self._end)
+                data = f.read()
+        except FileNotFoundError:
+            self._inode = None
+            self._end = 0
+            self._seqs = array('q')
+            self._offsets = array('q')
+            return
+        complete = data.rfind(b'\n') + 1
+        position = 0
+        seqs, offsets = array('q'), array('q')
+        while position < complete:
+            newline = data.index(b'\n', position)
+            if newline > position:
+                seqs.append(_seq_of(data[position:newline]))
+                offsets.append(self._end + position)
+            position = newline + 1
+        self._seqs.extend(seqs)
+        self._offsets.extend(offsets)
+        self._end += complete
+
+    def read(self, since=0, limit=100):
+        """Up to limit events with seq > since, oldest first
+
+        Raises ChangesExpired when events after since have already been
+        dropped from the log, so the caller knows to reload instead.
+        """
+        with self._lock:
+            self._tail()
+            seqs, offsets, count, end, inode = self._seqs, self._offsets, len(self._seqs), self._end, self._inode
+        if since > (seqs[count - 1] if count else 0) or (count and since < seqs[0] - 1):
+            raise ChangesExpired(since, seqs[0] if count else 0)
+        start = bisect_right(seqs, since, 0, count)
+        stop = min(count, start + limit)
+        if start >= stop:
+            return []
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_ino != inode:
+                    # Compacted between indexing and reading: try again with the new index
+                    return self.read(since, limit)
+                f.seek(offsets[start])
+                data = f.read((offsets[stop] if stop < count else end) - offsets[start])
+        except FileNotFoundError:
+            return []
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    def wait(self, since, timeout):
+        """Block until an event after since exists or timeout seconds pass; returns whether one does"""
+        deadline = time.monotonic() + timeout
+        while True:
+            self.refresh()
+            if self.last_seq != since:
+                # Newer events, or a replaced log (which read() reports as expired)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # Appends from this process wake us at once; other processes' are seen on the next poll
+            with self._appended:
+                self._appended.wait(min(self.poll_interval, remaining))
+
+    def follow(self, since=0, timeout=None, batch_size=500):
+        """Iterate over events after since as they arrive (long-polling the log)
+
+        Ends once timeout seconds pass with nothing new (never, when timeout
+        is None). Raises ChangesExpired if the consumer fell too far behind.
+        """
+        while True:
+            events = self.read(since, batch_size)
+            if events:
+                for event in events:
+                    yield event
+                since = events[-1]['seq']
+                continue
+            if not self.wait(since, 3600 if timeout is None else timeout) and timeout is not None:
+                return
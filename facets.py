@@ -0,0 +1,254 @@
+"""
+Faceted provider browsing
+
+Listing pages filter providers by category, minimum average rating and the
+weekdays they are open, and sort them by rating, review count or newest.
+Nothing is scanned per request:
+
+- every category and weekday has a set of provider ids, so a filter is a
+  set intersection (smallest set first);
+- each sort order is a list of (key, id) tuples kept sorted with bisect, so
+  an unfiltered page is a slice and "rating >= x" is a prefix of the rating
+  order;
+- profile, availability and review changes update only the provider they
+  concern (register ``user_changed`` and ``review_changed`` as listeners).
+"""
+
+import bisect
+import math
+import threading
+from datetime import datetime
+
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+SORTS = ('rating', 'reviews', 'newest')
+
+# Walk a presorted order while the filtered set is at least this share of it; sort the set otherwise
+WALK_FRACTION = 1 / 16
+
+
+class Page(list):
+    """One page of providers plus the paging and filter state that produced it"""
+
+    def __init__(self, items=(), total=0, page=1, per_page=12, sort='rating', category=None,
+                 min_rating=None, days=()):
+        super().__init__(items)
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+        self.sort = sort
+        self.category = category
+        self.min_rating = min_rating
+        self.days = tuple(days)
+
+    @property
+    def pages(self):
+        return max(1, math.ceil(self.total / self.per_page))
+
+
+def _timestamp(value):
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def open_days(availability):
+    return frozenset(day for day in DAYS if ((availability or {}).get(day) or {}).get('enabled'))
+
+
+class ProviderFacets:
+    """Per-facet id sets and presorted orders over all providers"""
+
+    def __init__(self, get_users, get_reviews):
+        self.get_users = get_users
+        self.get_reviews = get_reviews
+        self._lock = threading.RLock()
+        self._built = False  # built on first use, so the stores need not be loaded yet
+
+    def _ensure_built(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.rebuild()
+
+    def rebuild(self):
+        """Recompute everything (first use and after a store is reloaded)"""
+        with self._lock:
+            self._built = True
+            self._users = {}  # provider id -> user record
+            self._entries = {}  # provider id -> (category, open days, created timestamp)
+            self._ratings = {}  # provider id -> [rating sum, review count]
+            self._by_category = {}
+            self._by_day = {day: set() for day in DAYS}
+            self._orders = {sort: [] for sort in SORTS}
+            self._keys = {sort: {} for sort in SORTS}
+            for review in self.get_reviews():
+                totals = self._ratings.setdefault(review['reviewed_id'], [0, 0])
+                totals[0] += review['rating']
+                totals[1] += 1
+            for user in self.get_users():
+                self._add(user)
+
+    # Incremental updates
+
+    def user_changed(self, event, user):
+        """User manager listener"""
+        with self._lock:
+            if event == 'reloaded':
+                self._built = False
+            if not self._built:
+                return  # the first use builds from the current stores anyway
+            self._remove(user['id'])
+            if event != 'deleted':
+                self._add(user)
+
+    def review_changed(self, event, review):
+        """Review manager listener"""
+        with self._lock:
+            if event == 'reloaded':
+                self._built = False
+            if not self._built or event != 'created':
+                return
+            provider_id = review['reviewed_id']
+            totals = self._ratings.setdefault(provider_id, [0, 0])
+            totals[0] += review['rating']
+            totals[1] += 1
+            if provider_id in self._entries:
+                self._unsort(provider_id)
+                self._sort(provider_id)
+
+    def _add(self, user):
+        if user.get('role') != 'provider':
+            return
+        provider_id = user['id']
+        category = user.get('service_category') or ''
+        days = open_days(user.get('availability'))
+        self._users[provider_id] = user
+        self._entries[provider_id] = (category, days, _timestamp(user.get('created_at')))
+        self._by_category.setdefault(category, set()).add(provider_id)
+        for day in days:
+            self._by_day[day].add(provider_id)
+        self._sort(provider_id)
+
+    def _remove(self, provider_id):
+        entry = self._entries.pop(provider_id, None)
+        if entry is None:
+            return
+        category, days, _ = entry
+        del self._users[provider_id]
+        self._by_category[category].discard(provider_id)
+        if not self._by_category[category]:
+            del self._by_category[category]
+        for day in days:
+            self._by_day[day].discard(provider_id)
+        self._unsort(provider_id)
+
+    def _sort_keys(self, provider_id):
+        rating_sum, count = self._ratings.get(provider_id, (0, 0))
+        average = rating_sum / count if count else 0.0
+        created = self._entries[provider_id][2]
+        # Ascending tuple order is display order; the id breaks ties deterministically
+        return {
+            'rating': (-average, -count, provider_id),
+            'reviews': (-count, -average, provider_id),
+            'newest': (-created, -provider_id, provider_id),
+        }
+
+    def _sort(self, provider_id):
+        for sort, key in self._sort_keys(provider_id).items():
+            self._keys[sort][provider_id] = key
+            bisect.insort(self._orders[sort], key)
+
+    def _unsort(self, provider_id):
+        for sort in SORTS:
+            key = self._keys[sort].pop(provider_id, None)
+            if key is not None:
+                order = self._orders[sort]
+                del order[bisect.bisect_left(order, key)]
+
+    # Queries
+
+    def rating(self, provider_id):
+        """(average rating, review count)"""
+        self._ensure_built()
+        rating_sum, count = self._ratings.get(provider_id, (0, 0))
+        return (rating_sum / count if count else 0.0), count
+
+    def user(self, provider_id):
+        self._ensure_built()
+        return self._users.get(provider_id)
+
+    def categories(self):
+        self._ensure_built()
+        with self._lock:
+            return sorted(self._by_category)
+
+    def _rated_prefix(self, min_rating):
+        """Length of the rating order prefix with average >= min_rating"""
+        return bisect.bisect_right(self._orders['rating'], (-min_rating, math.inf))
+
+    def _filtered(self, category=None, min_rating=None, days=()):
+        """Ids matching every filter, or None when nothing is filtered"""
+        sets = []
+        if category:
+            sets.append(self._by_category.get(category, set()))
+        sets.extend(self._by_day[day] for day in days)
+        if min_rating:
+            rated = self._orders['rating'][:self._rated_prefix(min_rating)]
+            sets.append({key[-1] for key in rated})
+        if not sets:
+            return None
+        sets.sort(key=len)
+        matches = set(sets[0])
+        for ids in sets[1:]:
+            matches.intersection_update(ids)
+            if not matches:
+                break
+        return matches
+
+    def query(self, category=None, min_rating=None, days=(), sort='rating', page=1, per_page=12):
+        """A Page of provider ids"""
+        self._ensure_built()
+        days = [day for day in DAYS if day in set(days)]
+        sort = sort if sort in SORTS else 'rating'
+        offset = (page - 1) * per_page
+        with self._lock:
+            order = self._orders[sort]
+            if not category and not days:
+                # Only the rating filter (or none): the result is a prefix of a presorted order
+                if min_rating and sort != 'rating':
+                    matches = self._filtered(min_rating=min_rating)
+                else:
+                    end = self._rated_prefix(min_rating) if min_rating else len(order)
+                    ids = [key[-1] for key in order[offset:min(end, offset + per_page)]]
+                    return Page(ids, end, page, per_page, sort, category, min_rating, days)
+            else:
+                matches = self._filtered(category, min_rating, days)
+
+            if len(matches) < len(order) * WALK_FRACTION:
+                keys = self._keys[sort]
+                ids = sorted(matches, key=keys.__getitem__)[offset:offset + per_page]
+            else:
+                ids = []
+                skipped = 0
+                for key in order:
+                    if key[-1] in matches:
+                        if skipped < offset:
+                            skipped += 1
+                            continue
+                        ids.append(key[-1])
+                        if len(ids) == per_page:
+                            break
+            return Page(ids, len(matches), page, per_page, sort, category, min_rating, days)
+
+    def counts(self, category=None, min_rating=None, days=()):
+        """How many providers each category / weekday would leave, given the other filters"""
+        self._ensure_built()
+        with self._lock:
+            days = [day for day in DAYS if day in set(days)]
+            others = self._filtered(min_rating=min_rating, days=days)
+            categories = {name: len(ids) if others is None else len(ids & others)
+                          for name, ids in self._by_category.items() if name}
+            base = self._filtered(category, min_rating, days)
+            open_on = {day: len(ids) if base is None else len(ids & base) for day, ids in self._by_day.items()}
+            return {'category': categories, 'open': open_on}
@@ -0,0 +1,69 @@
+"""
+iCalendar (RFC 5545) feeds
+
+Builds a VCALENDAR one line at a time, so a feed can be streamed to a
+calendar client as it is generated. Times are written as floating local
+times (no time zone), like everywhere else in the app.
+"""
+
+from datetime import datetime
+
+PRODID = '-//Appointment Scheduler//Calendar Feed//EN'
+
+# Appointment status -> VEVENT STATUS; other statuses are left out of feeds
+EVENT_STATUSES = {'pending': 'TENTATIVE', 'confirmed': 'CONFIRMED', 'completed': 'CONFIRMED'}
+
+
+def escape(text):
+    """A TEXT property value: backslashes, separators and newlines escaped"""
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Content line folded at 75 octets, CRLF-terminated"""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts = []
+    limit = 75
+    while data:
+        cut = min(limit, len(data))
+        # Never split a UTF-8 sequence
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        limit = 74  # continuation lines start with a space
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def format_datetime(value):
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def event(uid, start, end, summary, description='', location='', status='CONFIRMED', stamp=None):
+    """The folded lines of one VEVENT"""
+    lines = ['BEGIN:VEVENT',
+             f'UID:{uid}',
+             f'DTSTAMP:{format_datetime(stamp or datetime.now())}',
+             f'DTSTART:{format_datetime(start)}',
+             f'DTEND:{format_datetime(end)}',
+             f'SUMMARY:{escape(summary)}',
+             f'STATUS:{status}']
+    if description:
+        lines.append(f'DESCRIPTION:{escape(description)}')
+    if location:
+        lines.append(f'LOCATION:{escape(location)}')
+    lines.append('END:VEVENT')
+    return ''.join(fold(line) for line in lines)
+
+
+def calendar(name, events):
+    """Generator of a whole VCALENDAR; events is an iterable of event() strings"""
+    yield ''.join(fold(line) for line in (
+        'BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}', 'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH', f'X-WR-CALNAME:{escape(name)}'))
+    for text in events:
+        yield text
+    yield fold('END:VCALENDAR')
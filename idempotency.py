@@ -0,0 +1,196 @@
+"""
+Idempotency keys for retried submissions
+
+A client sends the same ``Idempotency-Key`` (header or ``idempotency_key``
+form field) with every retry of one submission. The first request runs
+and its response is remembered, and retries get that response back without
+running the view again. Entries expire after a TTL, and the least recently
+used ones are dropped once the cache is full.
+
+Outcomes are kept as files in a directory that every worker process
+shares, so a retry gets the first response back whichever worker it lands on.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from locks import exclusive_file_lock
+
+# claim() results
+CLAIMED = 'claimed'  # first time: run the request, then complete() or release()
+REPLAY = 'replay'  # finished before: return the stored outcome
+MISMATCH = 'mismatch'  # same key, different request
+BUSY = 'busy'  # the first request is still running
+
+
+class Outcome:
+    """What a finished request returned (enough to send it again)"""
+
+    __slots__ = ('body', 'status', 'headers', 'flashes')
+
+    def __init__(self, body, status, headers, flashes=()):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.flashes = list(flashes)
+
+    def to_dict(self):
+        return {'body': base64.b64encode(self.body).decode('ascii'), 'status': self.status,
+                'headers': [list(header) for header in self.headers],
+                'flashes': [list(flash) for flash in self.flashes]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(base64.b64decode(data['body']), data['status'], [tuple(header) for header in data['headers']],
+                   [tuple(flash) for flash in data['flashes']])
+
+
+class IdempotencyCache:
+    """Outcomes by key in one small file each under directory, shared by every worker process
+
+    A key's file is created atomically by whichever request claims it first,
+    so a retry that lands on another worker finds the claim (or the stored
+    outcome) instead of running the view again. Files expire after ttl
+    seconds, and the least recently used are removed once there are more
+    than max_entries.
+    """
+
+    def __init__(self, directory, max_entries=10000, ttl=86400, clock=time.time,
+                 poll_interval=0.05, abandon_after=300):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.poll_interval = poll_interval  # how often a retry checks whether the first request finished
+        self.abandon_after = abandon_after  # a claim this old without an outcome belonged to a worker that died
+        self._claims = {}  # key -> entry claimed by this process and not yet finished
+        self._completed = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.json'))
+
+    def _path(self, key):
+        digest = hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()
+        return os.path.join(self.directory, digest + '.json')
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write(self, path, entry, exclusive=False):
+        """Write entry to path through a temp file; with exclusive, only if path does not exist yet"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            if not exclusive:
+                os.replace(tmp_path, path)
+                return True
+            try:
+                # link() fails if the key's file exists, and a reader never sees it half-written
+                os.link(tmp_path, path)
+                return True
+            except FileExistsError:
+                return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _remove(self, path, entry):
+        """Delete a key's file if it still holds entry (not a newer claim made meanwhile)"""
+        with exclusive_file_lock(os.path.join(self.directory, '.lock')):
+            if self._read(path) == entry:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def claim(self, key, fingerprint, wait=10.0):
+        """(CLAIMED | REPLAY | MISMATCH | BUSY, outcome or None)
+
+        A retry that arrives while the first request is still running (in
+        any worker) waits up to `wait` seconds for it to finish.
+        """
+        path = self._path(key)
+        deadline = time.monotonic() + wait
+        while True:
+            now = self.clock()
+            entry = {'fingerprint': fingerprint, 'claimed': now, 'expires': now + self.ttl, 'outcome': None}
+            if self._write(path, entry, exclusive=True):
+                with self._lock:
+                    self._claims[key] = entry
+                return CLAIMED, None
+            existing = self._read(path)
+            if existing is None:
+                continue  # released or removed since: claim it again
+            if existing['expires'] <= now or (existing['outcome'] is None
+                                              and existing['claimed'] + self.abandon_after <= now):
+                self._remove(path, existing)
+                continue
+            if existing['fingerprint'] != fingerprint:
+                return MISMATCH, None
+            if existing['outcome'] is not None:
+                try:
+                    os.utime(path)  # recently used: evicted last
+                except FileNotFoundError:
+                    pass
+                return REPLAY, Outcome.from_dict(existing['outcome'])
+            if time.monotonic() >= deadline:
+                return BUSY, None
+            time.sleep(self.poll_interval)
+
+    def complete(self, key, outcome):
+        """Store the outcome of a claimed key"""
+        with self._lock:
+            entry = self._claims.pop(key, None)
+            if entry is None:
+                return
+            self._completed += 1
+            sweep = self._completed % 100 == 0
+        self._write(self._path(key), dict(entry, outcome=outcome.to_dict()))
+        if sweep:
+            self.evict()
+
+    def release(self, key):
+        """Forget a claimed key without an outcome, so a retry runs again"""
+        with self._lock:
+            entry = self._claims.pop(key, None)
+        if entry is not None:
+            self._remove(self._path(key), entry)
+
+    def evict(self):
+        """Remove expired entries, then the least recently used ones while over max_entries"""
+        now = time.time()
+        files = []
+        for dir_entry in os.scandir(self.directory):
+            if dir_entry.name.endswith('.json'):
+                try:
+                    files.append((dir_entry.stat().st_mtime, dir_entry.path))
+                except FileNotFoundError:
+                    pass
+        files.sort()
+        excess = len(files) - self.max_entries
+        for position, (mtime, path) in enumerate(files):
+            if position >= excess and mtime + self.ttl > now:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def fingerprint(method, path, form=(), payload=None):
+    """Digest of what a request asks for, to catch a key reused for a different request"""
+    form = sorted((name, value) for name, value in form if name != 'idempotency_key')
+    data = json.dumps([method, path, form, payload], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
@@ -0,0 +1,72 @@
+"""
+Monotonic id allocation
+
+New users, appointments, series, reviews and gallery images get their ids
+from named sequences stored in a small JSON file (``ids.json``). Ids are
+never reused, even after the highest record is deleted, and worker
+processes share the sequences through a file lock. The sequences are
+seeded from the highest id already in each store, so existing data files
+keep working.
+"""
+
+import json
+import os
+import tempfile
+import threading
+
+from locks import exclusive_file_lock
+
+
+class IdAllocator:
+    def __init__(self, path):
+        self.path = path
+        self._floors = {}  # sequence -> highest id seen in the loaded store
+        self._lock = threading.Lock()
+
+    def observe(self, name, records):
+        """Make sure sequence `name` continues after every id in records"""
+        highest = max((record['id'] for record in records if isinstance(record.get('id'), int)), default=0)
+        with self._lock:
+            if highest > self._floors.get(name, 0):
+                self._floors[name] = highest
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write(self, counters):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(counters, f, indent=2, sort_keys=True)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def allocate(self, name, count=1):
+        """Reserve `count` consecutive ids from sequence `name`; returns the first"""
+        with self._lock, exclusive_file_lock(self.path + '.lock'):
+            # Re-read under the file lock: other worker processes allocate from the same file
+            counters = self._read()
+            first = max(counters.get(name, 0), self._floors.get(name, 0)) + 1
+            counters[name] = first + count - 1
+            self._write(counters)
+            return first
+
+    def next(self, name):
+        return self.allocate(name)
+
+    def advance(self, name, highest):
+        """Make sure sequence `name` never hands out `highest` or any id below it"""
+        with self._lock, exclusive_file_lock(self.path + '.lock'):
+            counters = self._read()
+            if highest > counters.get(name, 0):
+                counters[name] = highest
+                self._write(counters)
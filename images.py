@@ -0,0 +1,181 @@
+"""
+Downscaled image variants for gallery and profile pictures
+
+Uploads keep their original data URI in the user record. Their bytes are
+also written to MEDIA_DIR under a content digest, and a small background
+pool renders the variants there:
+
+    thumb  160px  avatars and small cards
+    card   480px  gallery cards
+    full  1600px  the lightbox
+
+(longest edge, never upscaled). Pages reference ``/media/<digest>/<variant>``
+with a srcset, so a listing downloads thumbnails instead of inlining every
+original. Until a variant exists, or when Pillow is not installed, the
+original is served in its place.
+"""
+
+import base64
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # variants are optional: pages fall back to the original image
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# Variant name -> longest edge in pixels, smallest first
+VARIANTS = {'thumb': 160, 'card': 480, 'full': 1600}
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png',
+                 'gif': 'image/gif', 'webp': 'image/webp'}
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+if Image is not None:
+    # Refuse decompression bombs (an upload is at most 5 MB, but can still claim huge dimensions)
+    Image.MAX_IMAGE_PIXELS = 50_000_000
+
+
+def decode_data_uri(uri):
+    """(bytes, extension) of a base64 image data URI, or (None, None)"""
+    match = re.match(r'^data:image/([a-z]+);base64,', uri or '')
+    if not match:
+        return None, None
+    return base64.b64decode(uri[match.end():]), match.group(1)
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def render_variants(data):
+    """{variant: (bytes, extension)} for an encoded image, largest variant first"""
+    image = Image.open(io.BytesIO(data))
+    # Let JPEG decode at a reduced scale straight away; much faster for camera photos
+    image.draft('RGB', (VARIANTS['full'], VARIANTS['full']))
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    rendered = {}
+    for name, size in sorted(VARIANTS.items(), key=lambda item: -item[1]):
+        # Each variant is scaled down from the previous one, not from the original
+        image.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, 'WEBP', quality=80, method=4)
+        rendered[name] = (out.getvalue(), 'webp')
+    return rendered
+
+
+class ImageVariants:
+    """Originals and their variants on disk, rendered by a bounded background pool"""
+
+    def __init__(self, directory='media', workers=2, max_pending=64):
+        self.directory = directory
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pending = set()
+        self._failed = set()  # digests whose original could not be decoded; not retried
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def store(self, data, extension, background=True):
+        """Save an upload's bytes and (in the background) queue its variants; returns its digest"""
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        folder = os.path.join(self.directory, digest)
+        os.makedirs(folder, exist_ok=True)
+        if self._find(digest, 'original') is None:
+            _write_atomic(os.path.join(folder, f'original.{extension.lower()}'), data)
+        if background:
+            self.schedule(digest)
+        return digest
+
+    def schedule(self, digest):
+        """Queue rendering of any missing variants; False if not queued (done, busy or unavailable)"""
+        if not self.enabled or all(self._find(digest, name) for name in VARIANTS):
+            return False
+        with self._lock:
+            if self._pid != os.getpid():
+                # Pool threads do not survive a fork; each worker process gets its own
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='images')
+                self._pending = set()
+            if digest in self._pending or digest in self._failed or len(self._pending) >= self.max_pending:
+                return False
+            self._pending.add(digest)
+        self._pool.submit(self.render, digest)
+        return True
+
+    def render(self, digest):
+        """Render every variant of a stored original now; False if it could not be decoded"""
+        try:
+            original = self._find(digest, 'original')
+            with open(original, 'rb') as f:
+                rendered = render_variants(f.read())
+            for name, (data, extension) in rendered.items():
+                _write_atomic(os.path.join(self.directory, digest, f'{name}.{extension}'), data)
+            return True
+        except Exception:
+            with self._lock:
+                self._failed.add(digest)
+            logger.exception('Could not render variants of image %s (pid %d)', digest, os.getpid())
+            return False
+        finally:
+            with self._lock:
+                self._pending.discard(digest)
+
+    def exists(self, digest):
+        return os.path.isdir(os.path.join(self.directory, digest))
+
+    def remove(self, digest):
+        """Delete an original and all its variants; False if there was nothing to delete"""
+        if not DIGEST_PATTERN.match(digest or '') or not self.exists(digest):
+            return False
+        shutil.rmtree(os.path.join(self.directory, digest), ignore_errors=True)
+        with self._lock:
+            self._failed.discard(digest)
+        return True
+
+    def _find(self, digest, name):
+        folder = os.path.join(self.directory, digest)
+        try:
+            entries = os.listdir(folder)
+        except FileNotFoundError:
+            return None
+        for entry in entries:
+            if entry.partition('.')[0] == name and not entry.endswith('.tmp'):
+                return os.path.join(folder, entry)
+        return None
+
+    def lookup(self, digest, variant):
+        """(path, content type, final) for a variant; the original stands in (final=False) until it exists"""
+        if not DIGEST_PATTERN.match(digest) or (variant not in VARIANTS and variant != 'original'):
+            return None, None, False
+        path = self._find(digest, variant)
+        final = path is not None
+        if path is None:
+            path = self._find(digest, 'original')
+            if path is None:
+                return None, None, False
+            self.schedule(digest)
+        extension = path.rsplit('.', 1)[-1]
+        return path, CONTENT_TYPES.get(extension, 'application/octet-stream'), final
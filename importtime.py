@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Import-time budget for the app
+
+Imports app.py in a fresh interpreter under ``python -X importtime`` and
+fails when that takes longer than the budget, or when the import loaded a
+data store (stores load on first use; see create_app in app.py). Prints the
+modules with the most self time, so a regression points at its cause.
+
+    python importtime.py                       # budget: IMPORT_BUDGET_MS, default 600
+    python importtime.py --budget-ms 400 --top 20
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Reports which stores the import loaded, on stdout
+PROBE = "import app, sys; sys.stdout.write(','.join(s.name for s in app.all_stores() + [app.id_allocator] if s.loaded))"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Check how long `import app` takes')
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('IMPORT_BUDGET_MS', '600')),
+                        help='largest acceptable cumulative import time (default: 600)')
+    parser.add_argument('--runs', type=int, default=3, help='imports to time; the fastest counts (default: 3)')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to list (default: 10)')
+    return parser.parse_args(argv)
+
+
+def parse_importtime(stderr):
+    """{module: (self us, cumulative us)} from -X importtime output"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def measure():
+    """(timings, names of stores loaded by the import) for one fresh interpreter"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE],
+                            cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import app failed:\n{result.stderr[-2000:]}')
+    loaded = [name for name in result.stdout.split(',') if name]
+    return parse_importtime(result.stderr), loaded
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = [measure() for _ in range(max(1, args.runs))]
+    timings, loaded = min(runs, key=lambda run: run[0].get('app', (0, 0))[1])
+    total_ms = timings.get('app', (0, 0))[1] / 1000
+
+    print(f'import app: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms, fastest of {len(runs)})')
+    print(f'{"self ms":>9} {"cumul ms":>9}  module')
+    for name, (self_us, cumulative_us) in sorted(timings.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f'{self_us / 1000:9.1f} {cumulative_us / 1000:9.1f}  {name}')
+
+    failed = False
+    if loaded:
+        print(f'FAIL: importing app loaded stores: {", ".join(loaded)}')
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f'FAIL: import took {total_ms:.1f} ms, over the {args.budget_ms:.0f} ms budget')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""
+Stores that load on first use
+
+``LazyStore`` stands in for a store object and builds it the first time
+anything on it is used (or when ``load()`` is called), so importing the app
+reads no data files. Listeners registered before then are attached as soon
+as the store is built. ``reset()`` drops a built store, so the next use
+builds it again from the current configuration. Listeners hear about
+that straight away as a ``reloaded`` event, as they do from ``refresh()``.
+"""
+
+import threading
+import time
+
+
+class LazyStore:
+    def __init__(self, name, factory):
+        # Set through __dict__: every other attribute is forwarded to the store
+        self.__dict__.update(
+            name=name, _factory=factory, _target=None, _listeners=[], _lock=threading.RLock(), load_seconds=None)
+
+    def __repr__(self):
+        return f'<LazyStore {self.name} {"loaded" if self.loaded else "not loaded"}>'
+
+    @property
+    def loaded(self):
+        return self._target is not None
+
+    def load(self):
+        """The store, built now if it was not yet"""
+        target = self._target
+        if target is not None:
+            return target
+        with self._lock:
+            if self._target is None:
+                started = time.perf_counter()
+                target = self._factory()
+                for listener in self._listeners:
+                    target.add_listener(listener)
+                self.__dict__['load_seconds'] = time.perf_counter() - started
+                self.__dict__['_target'] = target
+            return self._target
+
+    def reset(self):
+        """Forget the built store (listeners stay registered for the next one)"""
+        with self._lock:
+            if self._target is None:
+                return
+            self.__dict__['_target'] = None
+            listeners = list(self._listeners)
+        # Indexes, caches and version counters built from the old store are stale
+        for listener in listeners:
+            listener('reloaded', None)
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+            if self._target is not None:
+                self._target.add_listener(listener)
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self.load(), attribute, value)
@@ -0,0 +1,86 @@
+"""
+Cross-process file locks used to coordinate worker processes
+"""
+
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development only, no cross-process locking
+    fcntl = None
+
+
+@contextmanager
+def exclusive_file_lock(path):
+    """Hold an exclusive flock on path for the duration of the block"""
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def try_acquire_leadership(path):
+    """Take a non-blocking exclusive lock on path; return the open file (keep it) or None
+
+    The lock is released when the returned file is closed or the process exits,
+    which lets another process take over.
+    """
+    lock_file = open(path, 'a')
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class FileLock:
+    """A lock shared by this process's threads and, through flock, by other processes
+
+    Reentrant for the thread holding it, so a store method can take it again
+    inside a caller's critical section.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """Take the lock; without blocking, return False at once if someone else holds it"""
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, 'a')
+                if fcntl is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BaseException as exc:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                if not blocking and isinstance(exc, BlockingIOError):
+                    return False
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            # Closing the file drops the flock
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
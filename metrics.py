@@ -0,0 +1,240 @@
+"""
+Lightweight in-process metrics with Prometheus text exposition
+"""
+
+import bisect
+import hmac
+import os
+import threading
+import time
+from functools import wraps
+
+# Latency buckets in seconds, tuned for page renders and JSON file I/O
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in sorted(items):
+            yield self.name, _format_labels(self.labelnames, labelvalues), value
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect plus two additions"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # Per-bucket (non-cumulative) counts, plus the +Inf slot, sum and count
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items()]
+        for labelvalues, (counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, ('le', _format_value(float(bound))))
+                yield self.name + '_bucket', labels, cumulative
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Gauge:
+    """Gauge whose values are collected by a callback at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def samples(self):
+        if self.collect is None:
+            return
+        for labelvalues, value in self.collect():
+            if not isinstance(labelvalues, tuple):
+                labelvalues = (labelvalues,)
+            yield self.name, _format_labels(self.labelnames, labelvalues), value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, labelnames=(), collect=None):
+        return self._register(Gauge(name, help_text, labelnames, collect))
+
+    def render(self):
+        """Render every metric in the Prometheus text format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = MetricsRegistry()
+
+http_requests_total = registry.counter(
+    'http_requests_total', 'HTTP requests handled, by route and status',
+    ('method', 'endpoint', 'status'))
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time spent handling HTTP requests',
+    ('method', 'endpoint'))
+store_operation_duration = registry.histogram(
+    'store_operation_duration_seconds', 'Time spent in store load/save/lookup operations',
+    ('store', 'op'))
+process_start_time = time.time()
+registry.gauge('process_start_time_seconds', 'Start time of the process since unix epoch',
+               collect=lambda: [((), process_start_time)])
+
+
+def timed(store, op):
+    """Decorator recording the duration of a store method"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                store_operation_duration.observe(time.perf_counter() - started, store, op)
+        return wrapper
+    return decorator
+
+
+def register_stores(stores):
+    """Expose record counts and on-disk sizes for a {name: (records_fn, path_fn)} mapping"""
+    def collect_records():
+        return [((name,), len(records())) for name, (records, _) in stores.items()]
+
+    def collect_sizes():
+        samples = []
+        for name, (_, path) in stores.items():
+            try:
+                samples.append(((name,), os.path.getsize(path())))
+            except OSError:
+                samples.append(((name,), 0))
+        return samples
+
+    registry.gauge('store_records', 'Records currently held in memory', ('store',), collect_records)
+    registry.gauge('store_file_size_bytes', 'Size of the store data file on disk', ('store',), collect_sizes)
+
+
+def init_app(app, stores):
+    """Install request hooks and the /metrics endpoint on a Flask app"""
+    from flask import Response, g, request
+
+    register_stores(stores)
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _remember_status(response):
+        g._metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _record_request_metrics(exc):
+        # Teardown runs even when the view or a hook raised, so failed requests count as 500s
+        started = g.pop('_metrics_started', None)
+        status = g.pop('_metrics_status', None)
+        if started is not None:
+            # Use the route template, not the concrete path, to keep label cardinality bounded
+            endpoint = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+            http_request_duration.observe(time.perf_counter() - started, request.method, endpoint)
+            if exc is not None or status is None:
+                status = 500
+            http_requests_total.inc(1, request.method, endpoint, str(status))
+
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus scrape endpoint; needs METRICS_TOKEN as a bearer token, 404 without one"""
+        token = app.config.get('METRICS_TOKEN')
+        scheme, _, candidate = request.headers.get('Authorization', '').partition(' ')
+        if (not token or scheme.lower() != 'bearer'
+                or not hmac.compare_digest(candidate.strip().encode(), token.encode())):
+            return Response('Not found', status=404, mimetype='text/plain')
+        return Response(registry.render(), mimetype=None, content_type=CONTENT_TYPE)
@@ -0,0 +1,494 @@
+"""
+Appointment notifications: reminder scheduling and a durable outbox
+
+Producers (request handlers, in any worker process) only append records to
+an append-only JSON-lines log. Exactly one process at a time - the leader,
+elected with a non-blocking flock - replays and tails that log, keeps due
+reminders in a min-heap and hands messages to a small pool of delivery
+threads. A message is only dropped from the log once its delivery has been
+recorded, so a crash or restart re-sends pending messages (at-least-once).
+
+Log records:
+    {"op": "send", "id", "message"}          deliver a message now
+    {"op": "schedule", "key", "due", "message"}  deliver at `due` (epoch seconds)
+    {"op": "cancel", "keys"}                 drop scheduled reminders
+    {"op": "fired", "key", "id", "message"}  a reminder became a send
+    {"op": "done" | "failed", "id"}          delivery finished
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from locks import exclusive_file_lock, try_acquire_leadership
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderHeap:
+    """Min-heap of due items with O(log n) schedule and O(1) lazy cancel"""
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._cancelled = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, due, payload):
+        self.cancel(key)
+        entry = [due, next(self._sequence), key, payload, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        # Leave the entry in the heap and skip it when it surfaces
+        entry[4] = False
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+            self._heap = [e for e in self._heap if e[4]]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        return True
+
+    def next_due(self):
+        while self._heap and not self._heap[0][4]:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return (key, payload) for every entry due at or before now"""
+        due = []
+        while self.next_due() is not None and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            del self._entries[entry[2]]
+            due.append((entry[2], entry[3]))
+        return due
+
+    def items(self):
+        return [(entry[2], entry[0], entry[3]) for entry in self._entries.values()]
+
+
+class FileTransport:
+    """Writes each message as an .eml file - a local stand-in for SMTP"""
+
+    def __init__(self, directory='mail', sender='no-reply@localhost'):
+        self.directory = directory
+        self.sender = sender
+
+    def send(self, message):
+        os.makedirs(self.directory, exist_ok=True)
+        email = build_email(message, self.sender)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{message['id']}.eml"
+        tmp_path = os.path.join(self.directory, '.' + name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(email))
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+
+class SMTPTransport:
+    def __init__(self, host='localhost', port=25, sender='no-reply@localhost',
+                 username=None, password=None, use_tls=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+
+    def send(self, message):
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(build_email(message, self.sender))
+
+
+def build_email(message, sender):
+    email = EmailMessage()
+    email['From'] = sender
+    email['To'] = message['to']
+    email['Subject'] = message['subject']
+    email['Message-ID'] = f"<{message['id']}@scheduler>"
+    email.set_content(message['body'])
+    return email
+
+
+def transport_from_config(config):
+    sender = config.get('MAIL_SENDER', 'no-reply@localhost')
+    if config.get('NOTIFICATIONS_TRANSPORT') == 'smtp':
+        return SMTPTransport(
+            host=config.get('SMTP_HOST', 'localhost'),
+            port=int(config.get('SMTP_PORT', 25)),
+            sender=sender,
+            username=config.get('SMTP_USERNAME') or None,
+            password=config.get('SMTP_PASSWORD') or None,
+            use_tls=bool(config.get('SMTP_USE_TLS')))
+    # Under DATA_DIR, like the outbox
+    return FileTransport(os.path.join(config.get('DATA_DIR', '.'), config.get('NOTIFICATIONS_MAIL_DIR', 'mail')), sender)
+
+
+class Outbox:
+    """Durable notification log with leader-elected delivery"""
+
+    def __init__(self, path, transport, workers=2, max_attempts=5,
+                 retry_delay=30.0, poll_interval=1.0, compact_after=1000, fsync=True):
+        self.path = path
+        self.transport = transport
+        self.num_workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.compact_after = compact_after
+        self.fsync = fsync
+        self.on_leader = None
+        self._append_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._started_pid = None
+        self._reset_leader_state()
+
+    def _reset_leader_state(self):
+        self.is_leader = False
+        self._leader_file = None
+        self._offset = 0
+        self._records_since_compaction = 0
+        self._pending = {}  # id -> [message, attempts]
+        self._reminders = ReminderHeap()
+        self._deliveries = queue.Queue()
+        self._state_lock = threading.Lock()
+
+    # Producer API - safe to call from any thread in any process
+
+    def send(self, message):
+        message = dict(message, id=uuid.uuid4().hex)
+        self._append({'op': 'send', 'id': message['id'], 'message': message})
+
+    def schedule(self, key, due, message):
+        due = due.timestamp() if isinstance(due, datetime) else due
+        self._append({'op': 'schedule', 'key': key, 'due': due, 'message': message})
+
+    def cancel(self, keys):
+        self._append({'op': 'cancel', 'keys': list(keys)})
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._append_lock, exclusive_file_lock(self.path + '.lock'):
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        self._wake.set()
+
+    # Leader side
+
+    def start(self):
+        """Start the background leader loop once per process (cheap to call per request)"""
+        if self._started_pid == os.getpid():
+            return
+        self._started_pid = os.getpid()
+        # After a fork, inherited locks and leadership belong to the parent
+        self._append_lock = threading.Lock()
+        self._stop.clear()
+        self._reset_leader_state()
+        threading.Thread(target=self._run, name='outbox-leader', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _try_become_leader(self):
+        leader_file = try_acquire_leadership(self.path + '.leader')
+        if leader_file is None:
+            return False
+        self._leader_file = leader_file
+        self.is_leader = True
+        self._tail()
+        for _ in range(self.num_workers):
+            threading.Thread(target=self._deliver_loop, name='outbox-delivery', daemon=True).start()
+        if self.on_leader is not None:
+            self.on_leader()
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            timeout = self.poll_interval * 5
+            try:
+                if self.is_leader or self._try_become_leader():
+                    self._tail()
+                    self._fire_due()
+                    self._maybe_compact()
+                    next_due = self._reminders.next_due()
+                    timeout = self.poll_interval
+                    if next_due is not None:
+                        timeout = max(0.0, min(timeout, next_due - time.time()))
+            except Exception:
+                logger.exception('Outbox thread failed (pid %d)', os.getpid())
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _tail(self):
+        """Apply records appended since the last read"""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return
+        self._offset += end
+        with self._state_lock:
+            for line in data[:end].splitlines():
+                if line.strip():
+                    self._apply(json.loads(line))
+
+    def _apply(self, record):
+        op = record['op']
+        self._records_since_compaction += 1
+        if op == 'send' or op == 'fired':
+            if op == 'fired':
+                self._reminders.cancel(record['key'])
+            if record['id'] not in self._pending:
+                self._pending[record['id']] = [record['message'], 0]
+                self._deliveries.put(record['id'])
+        elif op == 'schedule':
+            self._reminders.schedule(record['key'], record['due'], record['message'])
+        elif op == 'cancel':
+            for key in record['keys']:
+                self._reminders.cancel(key)
+        elif op in ('done', 'failed'):
+            self._pending.pop(record['id'], None)
+
+    def _fire_due(self):
+        with self._state_lock:
+            due = self._reminders.pop_due(time.time())
+        for key, message in due:
+            if key.startswith('retry:'):
+                self._deliveries.put(message)
+                continue
+            message = dict(message, id=uuid.uuid4().hex)
+            self._append({'op': 'fired', 'key': key, 'id': message['id'], 'message': message})
+
+    def _deliver_loop(self):
+        while not self._stop.is_set():
+            message_id = self._deliveries.get()
+            with self._state_lock:
+                pending = self._pending.get(message_id)
+            if pending is None:
+                continue
+            message, attempts = pending
+            try:
+                self.transport.send(message)
+            except Exception as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    logger.error('Giving up on message %s after %d attempts: %s', message_id, attempts, e)
+                    self._append({'op': 'failed', 'id': message_id})
+                    continue
+                with self._state_lock:
+                    pending[1] = attempts
+                    due = time.time() + self.retry_delay * 2 ** (attempts - 1)
+                    self._reminders.schedule('retry:' + message_id, due, message_id)
+                continue
+            self._append({'op': 'done', 'id': message_id})
+
+    def _maybe_compact(self):
+        """Rewrite the log with only live records once enough history has piled up"""
+        if self._records_since_compaction < self.compact_after:
+            return
+        with self._append_lock, exclusive_file_lock(self.path + '.lock'):
+            # Nothing can be appended while we hold the lock; catch up first
+            self._tail()
+            with self._state_lock:
+                lines = [{'op': 'send', 'id': message_id, 'message': message}
+                         for message_id, (message, _) in self._pending.items()]
+                lines += [{'op': 'schedule', 'key': key, 'due': due, 'message': message}
+                          for key, due, message in self._reminders.items()
+                          if not key.startswith('retry:')]
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for record in lines:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._offset = os.path.getsize(self.path)
+            self._records_since_compaction = len(lines)
+
+    def stats(self):
+        with self._state_lock:
+            return {'leader': self.is_leader, 'pending': len(self._pending),
+                    'scheduled': len(self._reminders)}
+
+
+class AppointmentNotifier:
+    """Turns appointment changes into outbox messages and reminders"""
+
+    def __init__(self, outbox, get_user, lead=timedelta(hours=24)):
+        self.outbox = outbox
+        self.get_user = get_user
+        self.lead = lead
+
+    @staticmethod
+    def reminder_keys(appointment):
+        return [f"appointment:{appointment['id']}:customer", f"appointment:{appointment['id']}:provider"]
+
+    def _contact(self, user_id):
+        user = self.get_user(user_id) if user_id is not None else None
+        if not user or not user.get('email'):
+            return None, None
+        return user['email'], user.get('business_name') or user.get('name') or user['username']
+
+    def _describe(self, appointment):
+        when = appointment['datetime'].strftime('%A, %B %d, %Y at %H:%M')
+        return f"{appointment['type']} on {when} ({appointment['duration']} min)"
+
+    def _describe_series(self, series):
+        when = series['start'].strftime('%A, %B %d, %Y at %H:%M')
+        return f"{series['frequency']} {series['type']} starting {when} ({series['duration']} min)"
+
+    def _message(self, to, subject, body):
+        return {'to': to, 'subject': subject, 'body': body}
+
+    def __call__(self, event, appointment, previous_status=None):
+        if event == 'purged':
+            # Removed with a deleted account: drop its reminders, tell no one
+            self.outbox.cancel(self.reminder_keys(appointment))
+            return
+        if event.startswith('series_'):
+            self._series_event(event, appointment, previous_status)
+            return
+        if event not in ('created', 'status_changed', 'cancelled'):
+            return
+        customer_email, customer_name = self._contact(appointment.get('user_id'))
+        provider_email, provider_name = self._contact(appointment.get('provider_id'))
+        what = self._describe(appointment)
+
+        if event == 'created':
+            if provider_email:
+                self.outbox.send(self._message(
+                    provider_email, 'New appointment request',
+                    f"{customer_name or 'A customer'} requested {what}.\n"
+                    f"Open your appointments dashboard to accept or decline it."))
+        elif event == 'status_changed' and appointment['status'] == 'confirmed':
+            if customer_email:
+                self.outbox.send(self._message(
+                    customer_email, 'Your appointment is confirmed',
+                    f"{provider_name or 'Your provider'} confirmed your {what}."))
+            self.schedule_reminders(appointment)
+        elif event == 'status_changed' and appointment['status'] == 'declined':
+            self.outbox.cancel(self.reminder_keys(appointment))
+            if customer_email:
+                self.outbox.send(self._message(
+                    customer_email, 'Your appointment request was declined',
+                    f"{provider_name or 'The provider'} could not accept your request for {what}."))
+        elif event == 'status_changed' and appointment['status'] == 'expired':
+            if customer_email:
+                self.outbox.send(self._message(
+                    customer_email, 'Your appointment request expired',
+                    f"{provider_name or 'The provider'} did not respond to your request for {what} "
+                    f"before it started. Please book another time."))
+        elif event == 'status_changed':
+            self.outbox.cancel(self.reminder_keys(appointment))
+        elif event == 'cancelled':
+            self.outbox.cancel(self.reminder_keys(appointment))
+            if provider_email and previous_status in ('pending', 'confirmed'):
+                self.outbox.send(self._message(
+                    provider_email, 'Appointment cancelled',
+                    f"{customer_name or 'A customer'} cancelled {what}."))
+
+    def _series_event(self, event, record, previous_status):
+        """Messages for a recurring booking; record is the series, or the skipped occurrence
+
+        Sessions are computed on demand rather than stored, so they get no reminders.
+        """
+        customer_email, customer_name = self._contact(record.get('user_id'))
+        provider_email, provider_name = self._contact(record.get('provider_id'))
+        if event == 'series_skipped':
+            if previous_status in ('pending', 'confirmed'):
+                what = self._describe(record)
+                for email in (customer_email, provider_email):
+                    if email:
+                        self.outbox.send(self._message(
+                            email, 'Appointment cancelled',
+                            f"The {what} session of your recurring appointment was cancelled. "
+                            f"The rest of the series is unchanged."))
+            return
+        what = self._describe_series(record)
+        if event == 'series_created':
+            if provider_email:
+                self.outbox.send(self._message(
+                    provider_email, 'New recurring appointment request',
+                    f"{customer_name or 'A customer'} requested a {what}.\n"
+                    f"Open your appointments dashboard to accept or decline it."))
+        elif event == 'series_status_changed' and record['status'] == 'confirmed':
+            if customer_email:
+                self.outbox.send(self._message(
+                    customer_email, 'Your recurring appointment is confirmed',
+                    f"{provider_name or 'Your provider'} confirmed your {what}."))
+        elif event == 'series_status_changed' and record['status'] == 'declined':
+            if customer_email:
+                self.outbox.send(self._message(
+                    customer_email, 'Your recurring appointment request was declined',
+                    f"{provider_name or 'The provider'} could not accept your request for a {what}."))
+        elif event == 'series_status_changed' and record['status'] == 'expired':
+            if customer_email:
+                self.outbox.send(self._message(
+                    customer_email, 'Your recurring appointment request expired',
+                    f"{provider_name or 'The provider'} did not respond to your request for a {what} "
+                    f"before its first session. Please book another time."))
+        elif event == 'series_status_changed' and record['status'] == 'cancelled':
+            if previous_status in ('pending', 'confirmed'):
+                for email in (customer_email, provider_email):
+                    if email:
+                        self.outbox.send(self._message(
+                            email, 'Recurring appointment cancelled',
+                            f"The remaining sessions of the {what} were cancelled."))
+
+    def schedule_reminders(self, appointment, only_future=False):
+        due = appointment['datetime'] - self.lead
+        if appointment['datetime'] <= datetime.now() or (only_future and due <= datetime.now()):
+            return
+        what = self._describe(appointment)
+        customer_key, provider_key = self.reminder_keys(appointment)
+        customer_email, _ = self._contact(appointment.get('user_id'))
+        provider_email, _ = self._contact(appointment.get('provider_id'))
+        if customer_email:
+            self.outbox.schedule(customer_key, due, self._message(
+                customer_email, 'Appointment reminder', f"Reminder: you have {what}."))
+        if provider_email:
+            self.outbox.schedule(provider_key, due, self._message(
+                provider_email, 'Appointment reminder', f"Reminder: you are booked for {what}."))
+
+    def backfill(self, appointments):
+        """Schedule reminders for confirmed appointments the log does not know about yet"""
+        known = {key for key, _, _ in self.outbox._reminders.items()}
+        for appointment in appointments:
+            if appointment.get('status') != 'confirmed':
+                continue
+            if any(key in known for key in self.reminder_keys(appointment)):
+                continue
+            self.schedule_reminders(appointment, only_future=True)
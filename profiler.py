@@ -0,0 +1,188 @@
+"""
+Opt-in per-request profiling with cProfile
+
+A request is profiled when it carries the configured token in the
+``X-Profile`` header or ``_profile`` query parameter, or when it is picked
+by random sampling (``PROFILE_SAMPLE_RATE``). Each profile is written as a
+``.prof`` file (load it with ``pstats`` or snakeviz) plus a short text
+summary of the top functions. Requests that are not sampled only pay for a
+header lookup.
+
+The body is profiled as the server reads it, and the profile is saved when
+the server closes the response, so streamed responses are not buffered.
+Event streams never end: for those only the view is profiled.
+"""
+
+import cProfile
+import hmac
+import io
+import itertools
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_QUERY_PARAM = '_profile'
+UNPROFILED_BODY_TYPES = ('text/event-stream',)
+
+
+class RequestProfiler:
+    """WSGI middleware that wraps selected requests in cProfile"""
+
+    def __init__(self, wsgi_app, profile_dir='profiles', token=None,
+                 sample_rate=0.0, keep=50, top_n=30):
+        self.wsgi_app = wsgi_app
+        self.profile_dir = profile_dir
+        self.token = token or None
+        self.sample_rate = float(sample_rate or 0.0)
+        self.keep = int(keep)
+        self.top_n = int(top_n)
+        self._rotate_lock = threading.Lock()
+        self._sequence = itertools.count(1)
+
+    def _token_matches(self, candidate):
+        return bool(self.token and candidate) and hmac.compare_digest(candidate, self.token)
+
+    def should_profile(self, environ):
+        """Decide whether this request gets profiled"""
+        if self.token:
+            if self._token_matches(environ.get(PROFILE_HEADER, '')):
+                return True
+            query = environ.get('QUERY_STRING', '')
+            if PROFILE_QUERY_PARAM in query:
+                values = parse_qs(query).get(PROFILE_QUERY_PARAM, [])
+                if values and self._token_matches(values[0]):
+                    return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+
+        profile_id = self._profile_id(environ)
+        endless = []
+
+        def profiled_start_response(status, headers, exc_info=None):
+            content_type = next((value for name, value in headers if name.lower() == 'content-type'), '')
+            if content_type.split(';')[0].strip() in UNPROFILED_BODY_TYPES:
+                endless.append(True)
+            headers = list(headers) + [('X-Profile-Id', profile_id)]
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+
+        def finish():
+            try:
+                self._save(profile, profile_id, environ, time.perf_counter() - started)
+            except OSError:
+                pass
+
+        try:
+            profile.enable()
+        except ValueError:
+            # From Python 3.12 only one profiler can be active at a time (another
+            # request's, or a debugger's): serve this request unprofiled
+            return self.wsgi_app(environ, start_response)
+        try:
+            result = self.wsgi_app(environ, profiled_start_response)
+        except BaseException:
+            profile.disable()
+            finish()
+            raise
+        profile.disable()
+        if endless:
+            finish()
+            return result
+        return ProfiledBody(result, profile, finish)
+
+    def _profile_id(self, environ):
+        path = environ.get('PATH_INFO', '/').strip('/') or 'index'
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', path)[:60]
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        method = environ.get('REQUEST_METHOD', 'GET')
+        return f"{stamp}-{os.getpid()}-{next(self._sequence)}-{method}-{slug}"
+
+    def _save(self, profile, profile_id, environ, elapsed):
+        """Write the .prof dump and a top-N summary, then rotate old profiles"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        base = os.path.join(self.profile_dir, profile_id)
+        profile.dump_stats(base + '.prof')
+
+        summary = io.StringIO()
+        summary.write(f"{environ.get('REQUEST_METHOD', 'GET')} {environ.get('PATH_INFO', '/')}")
+        if environ.get('QUERY_STRING'):
+            summary.write('?' + environ['QUERY_STRING'])
+        summary.write(f'\nwall time: {elapsed * 1000:.1f} ms\n\n')
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(self.top_n)
+        with open(base + '.txt', 'w') as f:
+            f.write(summary.getvalue())
+
+        self._rotate()
+
+    def _rotate(self):
+        with self._rotate_lock:
+            profiles = sorted(
+                (entry for entry in os.scandir(self.profile_dir) if entry.name.endswith('.prof')),
+                key=lambda entry: (entry.stat().st_mtime, entry.name))
+            for entry in profiles[:max(0, len(profiles) - self.keep)]:
+                for path in (entry.path, entry.path[:-len('.prof')] + '.txt'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+
+class ProfiledBody:
+    """A response body read under the profile (so template streaming is included), saved on close()"""
+
+    def __init__(self, result, profile, finish):
+        self.result = result
+        self.profile = profile
+        self.finish = finish
+
+    def __iter__(self):
+        chunks = iter(self.result)
+        while True:
+            # Only while producing a chunk; the server's socket writes stay out of the profile
+            try:
+                self.profile.enable()
+                enabled = True
+            except ValueError:
+                # Another profiler is active (see RequestProfiler.__call__): leave this chunk out
+                enabled = False
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                if enabled:
+                    self.profile.disable()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.finish()
+
+
+def init_app(app):
+    """Wrap the app in the profiler when profiling is configured"""
+    token = app.config.get('PROFILE_TOKEN')
+    sample_rate = float(app.config.get('PROFILE_SAMPLE_RATE') or 0.0)
+    if not token and sample_rate <= 0:
+        return
+    app.wsgi_app = RequestProfiler(
+        app.wsgi_app,
+        profile_dir=app.config.get('PROFILE_DIR', 'profiles'),
+        token=token,
+        sample_rate=sample_rate,
+        keep=app.config.get('PROFILE_KEEP', 50),
+        top_n=app.config.get('PROFILE_TOP_N', 30))
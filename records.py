@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Memory-compact records for appointments and reviews
+
+Appointment and Review keep their fields in ``__slots__`` instead of a
+per-record dict: ``status`` and ``type`` are small integer codes into shared
+vocabularies (a type outside the known ones is kept as its own string, so
+free text never grows the shared table), and times are epoch-microsecond integers (exact, and what
+snapshots store) that are turned back into ``datetime`` objects only when
+read. Times with a timezone are kept as the naive local time the rest of
+the app uses. Fields outside the fixed set
+(``completed_at``, ``series_id`` ...) live in a small per-record dict that
+is only allocated when used.
+
+Both classes are mutable mappings, so existing code and templates keep
+working unchanged: ``apt['datetime']``, ``apt.get('status')``,
+``apt.datetime.strftime(...)``, ``apt.update(...)`` and ``dict(apt)`` all
+behave as they did with plain dicts.
+
+Usage:
+    python records.py --count 1000000     # memory comparison against plain dicts
+"""
+
+import argparse
+import gc
+import json
+import sys
+import threading
+import tracemalloc
+from collections.abc import MutableMapping
+from datetime import datetime as _datetime, timedelta
+from functools import lru_cache
+from itertools import repeat
+
+EPOCH = _datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+MICROS_PER_SECOND = 1000000
+
+
+class Vocabulary:
+    """Interned values stored as small integer codes"""
+
+    def __init__(self, values=()):
+        self.values = []
+        self.codes = {}
+        self._lock = threading.Lock()
+        for value in values:
+            self.code(value)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self.codes.get(value)
+                if code is None:
+                    if isinstance(value, str):
+                        value = sys.intern(value)
+                    code = len(self.values)
+                    # values first, so a code another thread finds always resolves
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+    def lookup(self, value):
+        """Code of a known value; any other string (or None) is returned as it is"""
+        code = self.codes.get(value)
+        if code is not None:
+            return code
+        if value is None or isinstance(value, str):
+            return value
+        return self.code(value)
+
+    def value(self, code):
+        """The value for what code() or lookup() returned"""
+        return self.values[code] if code.__class__ is int else code
+
+
+STATUSES = Vocabulary(['pending', 'confirmed', 'declined', 'completed', 'expired'])
+APPOINTMENT_TYPES = Vocabulary(['Hair Salon', 'Nail Salon', 'Massage Therapy', 'Personal Training',
+                                'Spa Treatment', 'Other'])
+
+
+# Repeated integers (slot start times, user and provider ids) share one object. The table
+# is bounded like to_datetime's cache, so a long-running process does not keep every value
+@lru_cache(maxsize=65536)
+def share(value):
+    return value
+
+
+def _share_all(values, pool):
+    """values with repeats sharing one object, through a table kept only for one load"""
+    return list(map(pool.setdefault, values, values))
+
+
+@lru_cache(maxsize=65536)
+def to_datetime(micros):
+    """Naive datetime for an epoch-microsecond integer (slot times repeat, so conversions are cached)"""
+    if micros is None:
+        return None
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def to_epoch_micros(value):
+    """Epoch microseconds for a datetime or ISO string
+
+    Values with a timezone are converted to naive local time first, the
+    way the app keeps every other time.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = _datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return (value - EPOCH) // ONE_MICROSECOND
+
+
+def to_epoch(value):
+    """Epoch seconds, rounded down, for a datetime or ISO string (see to_epoch_micros)"""
+    micros = to_epoch_micros(value)
+    return None if micros is None else micros // MICROS_PER_SECOND
+
+
+class Record(MutableMapping):
+    """Mapping view over a slotted record; subclasses list their keys in FIELDS"""
+
+    __slots__ = ()
+    FIELDS = ()
+    _FIELD_SET = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls.FIELDS)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __getitem__(self, key):
+        if key in self._FIELD_SET:
+            return getattr(self, key)
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._FIELD_SET:
+            return getattr(self, key)
+        extra = self._extra
+        if extra is not None:
+            return extra.get(key, default)
+        return default
+
+    def __contains__(self, key):
+        return key in self._FIELD_SET or (self._extra is not None and key in self._extra)
+
+    def __setitem__(self, key, value):
+        if key in self._FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELD_SET:
+            raise KeyError(f'{key} is a fixed field of {type(self).__name__}')
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        del self._extra[key]
+        if not self._extra:
+            self._extra = None
+
+    def __iter__(self):
+        yield from self.FIELDS
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return len(self.FIELDS) + (len(self._extra) if self._extra is not None else 0)
+
+    def copy(self):
+        return dict(self)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+
+    def __reduce__(self):
+        return type(self).from_dict, (dict(self),)
+
+    @classmethod
+    def _attach_columns(cls, records, columns, extras, missing):
+        """Store snapshot columns outside FIELDS, and the extras column, on loaded records"""
+        for name, values in columns.items():
+            if name in cls._FIELD_SET:
+                continue
+            for record, value in zip(records, values):
+                if value is not missing:
+                    record[name] = value
+        if extras is not None:
+            for record, value in zip(records, extras):
+                if value is not missing and value is not None:
+                    record.update(json.loads(value))
+
+
+def _column(columns, name, count, missing):
+    values = columns.get(name)
+    if values is None:
+        return repeat(None, count)
+    if missing in values:
+        return [None if v is missing else v for v in values]
+    return values
+
+
+class Appointment(Record):
+    __slots__ = ('id', '_type', '_start', 'duration', 'notes', '_created',
+                 'user_id', 'provider_id', '_status', '_extra')
+    FIELDS = ('id', 'type', 'datetime', 'duration', 'notes', 'created_at',
+              'user_id', 'provider_id', 'status')
+
+    def __init__(self, id, type, datetime, duration, notes="", created_at=None,
+                 user_id=None, provider_id=None, status="pending", **extra):
+        self.id = id
+        self._type = APPOINTMENT_TYPES.lookup(type)
+        self._start = share(to_epoch_micros(datetime))
+        self.duration = duration
+        self.notes = notes
+        self._created = to_epoch_micros(created_at or _datetime.now())
+        self.user_id = share(user_id)
+        self.provider_id = share(provider_id)
+        self._status = STATUSES.code(status)
+        self._extra = extra or None
+
+    @property
+    def type(self):
+        return APPOINTMENT_TYPES.value(self._type)
+
+    @type.setter
+    def type(self, value):
+        self._type = APPOINTMENT_TYPES.lookup(value)
+
+    @property
+    def status(self):
+        return STATUSES.values[self._status]
+
+    @status.setter
+    def status(self, value):
+        self._status = STATUSES.code(value)
+
+    @property
+    def datetime(self):
+        return to_datetime(self._start)
+
+    @datetime.setter
+    def datetime(self, value):
+        self._start = share(to_epoch_micros(value))
+
+    @property
+    def created_at(self):
+        return to_datetime(self._created)
+
+    @created_at.setter
+    def created_at(self, value):
+        self._created = to_epoch_micros(value)
+
+    @classmethod
+    def from_columns(cls, count, columns, extras, missing):
+        """Build records straight from snapshot columns, without datetime objects"""
+        new = cls.__new__
+        pool = {}
+        types = list(map(APPOINTMENT_TYPES.lookup, _column(columns, 'type', count, missing)))
+        statuses = list(map(STATUSES.code, _column(columns, 'status', count, missing)))
+        starts = _share_all(_column(columns, 'datetime', count, missing), pool)
+        created = _column(columns, 'created_at', count, missing)
+        records = []
+        append = records.append
+        for values in zip(_column(columns, 'id', count, missing), types, starts,
+                          _column(columns, 'duration', count, missing),
+                          _column(columns, 'notes', count, missing), created,
+                          _share_all(_column(columns, 'user_id', count, missing), pool),
+                          _share_all(_column(columns, 'provider_id', count, missing), pool), statuses):
+            record = new(cls)
+            (record.id, record._type, record._start, record.duration, record.notes,
+             record._created, record.user_id, record.provider_id, record._status) = values
+            record._extra = None
+            append(record)
+        cls._attach_columns(records, columns, extras, missing)
+        return records
+
+
+class Review(Record):
+    __slots__ = ('id', 'appointment_id', 'reviewer_id', 'reviewed_id', 'rating', 'comment',
+                 '_created', '_extra')
+    FIELDS = ('id', 'appointment_id', 'reviewer_id', 'reviewed_id', 'rating', 'comment', 'created_at')
+
+    def __init__(self, id, appointment_id, reviewer_id, reviewed_id, rating, comment="",
+                 created_at=None, **extra):
+        self.id = id
+        self.appointment_id = appointment_id
+        self.reviewer_id = reviewer_id
+        self.reviewed_id = reviewed_id
+        self.rating = rating
+        self.comment = comment
+        self._created = to_epoch_micros(created_at or _datetime.now())
+        self._extra = extra or None
+
+    @property
+    def created_at(self):
+        return to_datetime(self._created)
+
+    @created_at.setter
+    def created_at(self, value):
+        self._created = to_epoch_micros(value)
+
+    @classmethod
+    def from_columns(cls, count, columns, extras, missing):
+        new = cls.__new__
+        created = _column(columns, 'created_at', count, missing)
+        records = []
+        append = records.append
+        for values in zip(_column(columns, 'id', count, missing),
+                          _column(columns, 'appointment_id', count, missing),
+                          _column(columns, 'reviewer_id', count, missing),
+                          _column(columns, 'reviewed_id', count, missing),
+                          _column(columns, 'rating', count, missing),
+                          _column(columns, 'comment', count, missing), created):
+            record = new(cls)
+            (record.id, record.appointment_id, record.reviewer_id, record.reviewed_id,
+             record.rating, record.comment, record._created) = values
+            record._extra = None
+            append(record)
+        cls._attach_columns(records, columns, extras, missing)
+        return records
+
+
+def appointment_columns(appointments):
+    """(start epoch seconds, duration minutes, status code) lists for appointment records"""
+    return ([appointment._start // MICROS_PER_SECOND for appointment in appointments],
+            [appointment.duration for appointment in appointments],
+            [appointment._status for appointment in appointments])
+
+
+def json_default(value):
+    """json.dump default= hook: records serialize as objects, anything else via str()"""
+    if isinstance(value, Record):
+        return dict(value)
+    return str(value)
+
+
+def _measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return items, after - before
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare memory use of dict and slotted appointment records')
+    parser.add_argument('--count', type=int, default=1000000)
+    args = parser.parse_args(argv)
+
+    base = _datetime(2026, 1, 5, 9, 0)
+    created = _datetime(2025, 12, 1, 8, 30, 15)
+    types = APPOINTMENT_TYPES.values
+    statuses = STATUSES.values
+
+    def as_dicts():
+        return [{
+            "id": i + 1,
+            "type": types[i % len(types)],
+            "datetime": base + timedelta(minutes=30 * (i % 20000)),
+            "duration": 60,
+            "notes": "",
+            "created_at": created + timedelta(seconds=i),
+            "user_id": i % 5000 + 1,
+            "provider_id": i % 300 + 1,
+            "status": statuses[i % len(statuses)],
+        } for i in range(args.count)]
+
+    def as_records():
+        return [Appointment(i + 1, types[i % len(types)], base + timedelta(minutes=30 * (i % 20000)), 60, "",
+                            created + timedelta(seconds=i), i % 5000 + 1, i % 300 + 1, statuses[i % len(statuses)])
+                for i in range(args.count)]
+
+    dicts, dict_bytes = _measure(as_dicts)
+    del dicts
+    records, record_bytes = _measure(as_records)
+    del records
+    print(f'{args.count} appointments: dicts {dict_bytes / 2 ** 20:.1f} MiB '
+          f'({dict_bytes / args.count:.0f} B each), slotted records {record_bytes / 2 ** 20:.1f} MiB '
+          f'({record_bytes / args.count:.0f} B each), {dict_bytes / record_bytes:.1f}x smaller')
+
+
+if __name__ == '__main__':
+    main()
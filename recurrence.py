@@ -0,0 +1,139 @@
+"""
+Recurring appointment series
+
+A series is stored once (start, duration, frequency, an end date or an
+occurrence count, and skipped dates). Occurrences are never materialized in
+bulk: they are computed on demand for the window being looked at, so a
+weekly booking costs the same to store and to check whether it runs for a
+month or for two years.
+"""
+
+import calendar
+import heapq
+from datetime import datetime, timedelta
+
+FREQUENCIES = {
+    'weekly': timedelta(weeks=1),
+    'biweekly': timedelta(weeks=2),
+    'monthly': None,  # same day of the month, clamped to the month's last day
+}
+
+# Upper bound on the length of a series (five years of weekly sessions)
+MAX_OCCURRENCES = 260
+
+ACTIVE_STATUSES = ('pending', 'confirmed')
+
+
+def add_months(start, months):
+    month_index = start.month - 1 + months
+    year = start.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(start.day, calendar.monthrange(year, month)[1])
+    return start.replace(year=year, month=month, day=day)
+
+
+def occurrence_start(series, index):
+    period = FREQUENCIES[series['frequency']]
+    if period is None:
+        return add_months(series['start'], index)
+    return series['start'] + period * index
+
+
+def last_index(series):
+    """Index of the final occurrence (inclusive)"""
+    if series.get('count'):
+        return min(series['count'], MAX_OCCURRENCES) - 1
+    until = series.get('until')
+    if until is None:
+        return MAX_OCCURRENCES - 1
+    period = FREQUENCIES[series['frequency']]
+    if period is None:
+        months = (until.year - series['start'].year) * 12 + until.month - series['start'].month
+        index = max(0, months)
+        while index > 0 and add_months(series['start'], index) > until:
+            index -= 1
+    else:
+        index = max(0, (until - series['start']) // period)
+    return min(index, MAX_OCCURRENCES - 1)
+
+
+def first_index_after(series, moment):
+    """Smallest index whose occurrence could start after moment (may undershoot by one)"""
+    if moment <= series['start']:
+        return 0
+    period = FREQUENCIES[series['frequency']]
+    if period is None:
+        months = (moment.year - series['start'].year) * 12 + moment.month - series['start'].month
+        return max(0, months - 1)
+    return (moment - series['start']) // period
+
+
+def iter_occurrence_starts(series, window_start, window_end):
+    """Start times of the series' occurrences overlapping [window_start, window_end)"""
+    duration = timedelta(minutes=series['duration'])
+    exceptions = set(series.get('exceptions', []))
+    last = last_index(series)
+    index = first_index_after(series, window_start - duration)
+    while index <= last:
+        start = occurrence_start(series, index)
+        if start >= window_end:
+            break
+        if start + duration > window_start and start.strftime('%Y-%m-%d') not in exceptions:
+            yield start
+        index += 1
+
+
+def series_end(series):
+    """End of the final occurrence"""
+    return occurrence_start(series, last_index(series)) + timedelta(minutes=series['duration'])
+
+
+def expand(series, window_start, window_end):
+    """Appointment-shaped dicts for each occurrence in the window"""
+    for start in iter_occurrence_starts(series, window_start, window_end):
+        yield {
+            'id': None,
+            'series_id': series['id'],
+            'occurrence': start.strftime('%Y-%m-%d'),
+            'recurring': True,
+            'frequency': series['frequency'],
+            'type': series['type'],
+            'datetime': start,
+            'duration': series['duration'],
+            'notes': series.get('notes', ''),
+            'created_at': series['created_at'],
+            'user_id': series.get('user_id'),
+            'provider_id': series.get('provider_id'),
+            'status': series['status'],
+        }
+
+
+def find_conflicts(candidates, existing):
+    """Sweep two start-ordered lists of (start, end, ...) intervals in one pass
+
+    Returns the candidates that overlap at least one existing interval. Runs
+    in O((n + m) log m) instead of checking every candidate against every
+    booking.
+    """
+    existing = list(existing)
+    conflicts = []
+    active_ends = []
+    j = 0
+    for candidate in candidates:
+        start, end = candidate[0], candidate[1]
+        while j < len(existing) and existing[j][0] < end:
+            heapq.heappush(active_ends, existing[j][1])
+            j += 1
+        # Intervals that ended before this candidate cannot overlap later ones either
+        while active_ends and active_ends[0] <= start:
+            heapq.heappop(active_ends)
+        if active_ends:
+            conflicts.append(candidate)
+    return conflicts
+
+
+def parse_until(value):
+    """End date from a form field; the series runs through the whole day"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
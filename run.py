@@ -3,7 +3,7 @@
 Simple script to run the Appointment Scheduler web app
 """
 
-from app import app
+from app import create_app
 
 if __name__ == '__main__':
     print("=" * 60)
@@ -12,6 +12,8 @@ if __name__ == '__main__':
     print("Starting web server...")
     print("Open your browser and go to: http://localhost:5000")
     print("Press Ctrl+C to stop the server")
+    print("For production, use: python serve.py --workers 4")
     print("=" * 60)
     
+    app = create_app()
     app.run(debug=True, host='0.0.0.0', port=5000)
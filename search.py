@@ -0,0 +1,235 @@
+"""
+Full-text provider search
+
+An in-memory inverted index over the providers' business name, description,
+services, category and address. Text is normalized before indexing and
+querying: lower-cased, Serbian Cyrillic transliterated to Latin, and
+diacritics folded (``đ`` -> ``dj``, ``č``/``ć`` -> ``c``, ``š`` -> ``s``,
+``ž`` -> ``z``), so "Đure Đakovića" matches "djure djakovica".
+
+- Results are ranked with BM25; a match in the business name counts for more
+  than one in the description (field weights scale the term frequency).
+- The last word of a query is completed as a prefix, using bisect on a
+  sorted term list, so results appear while the user is still typing.
+- The index is kept current one provider at a time: register it as a user
+  manager listener and it re-indexes only the provider that changed.
+"""
+
+import bisect
+import heapq
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+# Field -> weight (how many times one occurrence counts)
+FIELDS = {
+    'business_name': 3,
+    'service_category': 2,
+    'services_offered': 2,
+    'business_description': 1,
+    'address': 1,
+}
+
+# Kept per indexed provider so results can be shown without a user lookup
+SUMMARY_FIELDS = ('name', 'business_name', 'service_category', 'services_offered', 'address')
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Most terms a prefix may expand to (the most common ones are kept)
+MAX_PREFIX_TERMS = 50
+
+_CYRILLIC = dict(zip(
+    'абвгдђежзијклљмнњопрстћуфхцчџш',
+    ['a', 'b', 'v', 'g', 'd', 'dj', 'e', 'z', 'z', 'i', 'j', 'k', 'l', 'lj', 'm', 'n', 'nj',
+     'o', 'p', 'r', 's', 't', 'c', 'u', 'f', 'h', 'c', 'c', 'dz', 's']))
+# Letters that do not decompose into base letter + combining mark
+_SPECIAL = {'đ': 'dj', 'ß': 'ss', 'æ': 'ae', 'ø': 'o', 'ł': 'l'}
+_FOLD = str.maketrans({**_CYRILLIC, **_SPECIAL})
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    """Lower-case, transliterate and strip diacritics"""
+    text = str(text or '').lower()
+    if text.isascii():
+        return text
+    text = unicodedata.normalize('NFKD', text.translate(_FOLD))
+    return ''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def tokenize(text):
+    return _TOKEN.findall(normalize(text))
+
+
+class SearchIndex:
+    """Inverted index of providers with BM25 ranking and prefix completion"""
+
+    def __init__(self, get_users):
+        self.get_users = get_users
+        self._postings = {}  # term -> {provider id: weighted term frequency}
+        self._terms = []  # sorted, for prefix lookups
+        self._lengths = {}  # provider id -> weighted document length
+        self._documents = {}  # provider id -> Counter of weighted term frequencies
+        self._summaries = {}  # provider id -> SUMMARY_FIELDS
+        self._total_length = 0
+        self._lock = threading.RLock()
+        self._built = False  # indexed on first use, so the users need not be loaded yet
+
+    def __len__(self):
+        self._ensure_built()
+        return len(self._documents)
+
+    def __call__(self, event, user):
+        """User manager listener"""
+        with self._lock:
+            if event == 'reloaded':
+                self._built = False
+            elif not self._built:
+                return  # the first use indexes the current users anyway
+            elif event == 'deleted':
+                self.remove(user['id'])
+            elif event in ('created', 'updated'):
+                self.add(user)
+
+    def _ensure_built(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.rebuild()
+
+    def rebuild(self):
+        """Re-index every provider (first use and after the users file is reloaded)"""
+        with self._lock:
+            self._built = True
+            self._postings = {}
+            self._terms = []
+            self._lengths = {}
+            self._documents = {}
+            self._summaries = {}
+            self._total_length = 0
+            for user in self.get_users():
+                self.add(user)
+
+    def add(self, user):
+        """Index a provider, replacing any previous version of it"""
+        self._ensure_built()
+        provider_id = user['id']
+        with self._lock:
+            self.remove(provider_id)
+            if user.get('role') != 'provider':
+                return
+            frequencies = Counter()
+            for field, weight in FIELDS.items():
+                for term in tokenize(user.get(field)):
+                    frequencies[term] += weight
+            self._documents[provider_id] = frequencies
+            self._summaries[provider_id] = {'id': provider_id,
+                                            **{field: user.get(field, '') for field in SUMMARY_FIELDS}}
+            length = sum(frequencies.values())
+            self._lengths[provider_id] = length
+            self._total_length += length
+            for term, frequency in frequencies.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = {}
+                    bisect.insort(self._terms, term)
+                postings[provider_id] = frequency
+
+    def remove(self, provider_id):
+        with self._lock:
+            frequencies = self._documents.pop(provider_id, None)
+            if frequencies is None:
+                return
+            self._total_length -= self._lengths.pop(provider_id)
+            del self._summaries[provider_id]
+            for term in frequencies:
+                postings = self._postings[term]
+                del postings[provider_id]
+                if not postings:
+                    del self._postings[term]
+                    del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def summary(self, provider_id):
+        """Display fields of an indexed provider"""
+        self._ensure_built()
+        return self._summaries.get(provider_id)
+
+    def expand(self, prefix, limit=MAX_PREFIX_TERMS):
+        """Indexed terms starting with prefix, most common first"""
+        self._ensure_built()
+        with self._lock:
+            lo = bisect.bisect_left(self._terms, prefix)
+            hi = bisect.bisect_left(self._terms, prefix + '\uffff')
+            candidates = self._terms[lo:hi]
+            if len(candidates) > limit:
+                candidates = heapq.nlargest(limit, candidates, key=lambda term: len(self._postings[term]))
+            else:
+                candidates.sort(key=lambda term: -len(self._postings[term]))
+            return candidates
+
+    def suggest(self, text, limit=8):
+        """Completions for the last word of text, most common first"""
+        tokens = tokenize(text)
+        if not tokens or not text[-1:].isalnum():
+            return []
+        return self.expand(tokens[-1], limit)
+
+    def _idf(self, postings):
+        count = len(self._documents)
+        return math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+
+    def search(self, query, limit=20, allowed=None, complete_last=True):
+        """[(provider id, score)] matching every query word, best first
+
+        With complete_last, the final word also matches longer terms it is a
+        prefix of (unless the query ends in a space). allowed optionally
+        restricts results to a set of provider ids. Candidates are the
+        intersection of the words' posting lists, smallest first; only those
+        are scored.
+        """
+        self._ensure_built()
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+        prefix = tokens.pop() if complete_last and query[-1:].isalnum() else None
+        with self._lock:
+            if not self._documents:
+                return []
+            # Per query word, the posting lists it matches (several for a prefix)
+            words = [[self._postings.get(term, {})] for term in tokens]
+            if prefix is not None:
+                words.append([self._postings[term] for term in self.expand(prefix)])
+            words = [[(postings, self._idf(postings)) for postings in alternatives] for alternatives in words]
+
+            sets = sorted((set().union(*(postings for postings, _ in alternatives)) for alternatives in words), key=len)
+            matches = sets[0] if sets else set()
+            for ids in sets[1:]:
+                matches = matches & ids
+            if allowed is not None:
+                matches = matches & set(allowed)
+
+            average = self._total_length / len(self._documents)
+            norms = {provider_id: K1 * (1 - B + B * self._lengths[provider_id] / average)
+                     for provider_id in matches}
+            scores = dict.fromkeys(matches, 0.0)
+            for alternatives in words:
+                # A prefix scores its best completion, not the sum of all of them
+                best = {}
+                for postings, idf in alternatives:
+                    if len(postings) > len(matches):
+                        pairs = ((provider_id, postings[provider_id]) for provider_id in matches
+                                 if provider_id in postings)
+                    else:
+                        pairs = ((provider_id, frequency) for provider_id, frequency in postings.items()
+                                 if provider_id in matches)
+                    for provider_id, frequency in pairs:
+                        score = idf * frequency * (K1 + 1) / (frequency + norms[provider_id])
+                        if score > best.get(provider_id, 0.0):
+                            best[provider_id] = score
+                for provider_id, score in best.items():
+                    scores[provider_id] += score
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
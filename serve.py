@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Production server for the Appointment Scheduler web app
+
+The master process imports the app (loading every store once), freezes the
+GC heap so the preloaded objects stay shared copy-on-write, and pre-forks
+worker processes that each serve requests from a bounded thread pool on the
+shared listening socket.
+
+Signals (sent to the master):
+    SIGHUP           graceful reload - start fresh workers, then retire the old ones
+    SIGTERM, SIGINT  graceful shutdown - finish in-flight requests, flush stores, exit
+
+Usage:
+    python serve.py --bind 0.0.0.0:5000 --workers 4 --threads 8
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+class RequestHandler(WSGIRequestHandler):
+    # One request per connection: idle keep-alive clients must not pin pool threads
+    protocol_version = 'HTTP/1.0'
+    access_log = True
+
+    def make_environ(self):
+        environ = super().make_environ()
+        # A view may take over the connection once its response headers are sent (see sse.py)
+        environ['serve.detach'] = lambda callback: self.server.detach(self.connection, callback)
+        return environ
+
+    def log_request(self, *args, **kwargs):
+        if self.access_log:
+            super().log_request(*args, **kwargs)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug WSGI server that handles requests on a fixed-size thread pool"""
+
+    multithread = True
+
+    def __init__(self, app, listen_socket, threads):
+        host, port = listen_socket.getsockname()[:2]
+        super().__init__(host, port, app, handler=RequestHandler, fd=listen_socket.fileno())
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        # Stop accepting while every thread is busy, so other workers pick up the connection
+        self.slots = threading.BoundedSemaphore(threads)
+        self.detached = {}  # request socket -> callback that takes it over after the response
+
+    def detach(self, connection, callback):
+        self.detached[connection] = callback
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            callback = self.detached.pop(request, None)
+            try:
+                if callback is not None:
+                    callback(request)
+                else:
+                    self.shutdown_request(request)
+            except Exception:
+                self.shutdown_request(request)
+            self.slots.release()
+
+
+def bind_socket(bind, backlog=2048):
+    host, _, port = bind.rpartition(':')
+    host = host.strip('[]') or '0.0.0.0'
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, stores, listen_socket, threads, master_pid):
+    """Serve requests until SIGTERM (or the master going away), then flush and exit"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    server = PooledWSGIServer(app, listen_socket, threads)
+    stopping = threading.Event()
+
+    def stop(*_):
+        if not stopping.is_set():
+            stopping.set()
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    def watch_master():
+        while not stopping.wait(1.0):
+            if os.getppid() != master_pid:
+                stop()
+
+    threading.Thread(target=watch_master, daemon=True).start()
+
+    try:
+        server.serve_forever()
+    finally:
+        # serve_forever() returns once accepting stops; wait for in-flight requests
+        server.pool.shutdown(wait=True)
+        for store in stores:
+            try:
+                store.flush()
+            except Exception:
+                logger.exception('worker %d failed to flush %s', os.getpid(), type(store).__name__)
+    os._exit(0)
+
+
+class Master:
+    def __init__(self, app, stores, listen_socket, workers, threads, graceful_timeout):
+        self.app = app
+        self.stores = stores
+        self.listen_socket = listen_socket
+        self.num_workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}  # pid -> generation
+        self.generation = 0
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def log(self, message):
+        print(f'[master {os.getpid()}] {message}', file=sys.stderr, flush=True)
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self.app, self.stores, self.listen_socket, self.threads, self.master_pid)
+            finally:
+                os._exit(1)
+        self.workers[pid] = self.generation
+        return pid
+
+    def prepare_fork(self):
+        """Pick up data written by workers, then freeze the heap for copy-on-write forks"""
+        for store in self.stores:
+            store.refresh()
+        gc.collect()
+        gc.freeze()
+
+    def spawn_generation(self):
+        self.generation += 1
+        self.prepare_fork()
+        for _ in range(self.num_workers):
+            self.spawn_worker()
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            if generation == self.generation and not self.stop_requested:
+                self.log(f'worker {pid} exited unexpectedly (status {status}), respawning')
+                self.prepare_fork()
+                self.spawn_worker()
+
+    def retire(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def wait_for(self, pids, timeout):
+        deadline = time.monotonic() + timeout
+        pending = set(pids)
+        while pending and time.monotonic() < deadline:
+            self.reap()
+            pending &= set(self.workers)
+            time.sleep(0.1)
+        for pid in pending:
+            self.log(f'worker {pid} did not stop in {timeout}s, killing it')
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.reap()
+
+    def reload(self):
+        old = [pid for pid, generation in self.workers.items() if generation == self.generation]
+        self.log(f'reloading: starting {self.num_workers} new workers')
+        self.spawn_generation()
+        self.retire(old)
+
+    def run(self):
+        self.master_pid = os.getpid()
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, 'stop_requested', True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, 'stop_requested', True))
+
+        host, port = self.listen_socket.getsockname()[:2]
+        self.log(f'listening on {host}:{port} with {self.num_workers} workers x {self.threads} threads')
+        self.spawn_generation()
+
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            # Retired workers from older generations are reaped above as they finish
+            time.sleep(0.2)
+
+        self.log('shutting down')
+        pids = list(self.workers)
+        self.retire(pids)
+        self.wait_for(pids, self.graceful_timeout)
+        self.listen_socket.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the Appointment Scheduler with pre-forked workers')
+    parser.add_argument('--bind', default=os.environ.get('BIND', '0.0.0.0:5000'),
+                        help='host:port to listen on (default: 0.0.0.0:5000)')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', os.cpu_count() or 1)),
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('THREADS', '8')),
+                        help='request threads per worker (default: 8)')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='seconds to wait for in-flight requests on shutdown or reload')
+    parser.add_argument('--no-access-log', action='store_true', help='do not log every request')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    listen_socket = bind_socket(args.bind)
+    RequestHandler.access_log = not args.no_access_log
+
+    # Preload the app and all stores once in the master
+    from app import create_app, all_stores
+    app = create_app(preload=True)
+    app.debug = False
+    app.config['SHARED_STORES'] = args.workers > 1
+
+    master = Master(app, all_stores(), listen_socket, args.workers, args.threads, args.graceful_timeout)
+    master.run()
+
+
+if __name__ == '__main__':
+    main()
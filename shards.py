@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Provider-sharded storage for appointments
+
+With ``APPOINTMENT_SHARDS`` set to N, appointments are not kept in one file
+but in N segments next to it, each holding every booking of the providers
+whose id falls in that bucket (``provider_id % N``), plus a small manifest:
+
+    appointments.shards/
+        manifest.json          {"version": 1, "shards": 16, "segments": {"3": {"file":
+                                "shard-03-of-16.json", "generation": 41, "appointments": 212}, ...}}
+        shard-00-of-16.json
+        shard-01-of-16.json
+        ...
+
+Confirming, booking or cancelling one provider's appointment rewrites only
+that provider's segment and the manifest, so a write costs about one
+provider bucket's worth of records however many providers there are.
+Every rewrite bumps the segment's generation in the manifest. A process
+picking up other workers' writes reads the manifest and reloads only the
+segments whose generation moved. Each segment has its own file lock, which
+a writer holds from reloading the segment through rewriting it, so workers
+booking with providers in different segments never wait on each other.
+
+Segments use the store's format: JSON, or snapshots with ``STORE_FORMAT=snapshot``.
+
+Usage:
+    python shards.py split appointments.json --shards 16    # writes appointments.shards/
+    python shards.py join appointments.shards -o appointments.json
+    python shards.py stats appointments.shards
+"""
+
+import argparse
+import json
+import os
+import re
+import tempfile
+
+import records
+import snapshot
+from locks import FileLock, exclusive_file_lock
+
+VERSION = 1
+MANIFEST = 'manifest.json'
+SEGMENT_PATTERN = re.compile(r'^shard-\d+-of-\d+\.(json|snap)$')
+
+
+def shard_directory(data_file):
+    """appointments.json (or .snap) -> appointments.shards"""
+    return os.path.splitext(data_file)[0] + '.shards'
+
+
+def _write_atomic(path, write):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class ShardedFiles:
+    """The segment files and manifest of one sharded store, and which generations this process holds"""
+
+    def __init__(self, data_file, shards, kind='appointments'):
+        self.directory = shard_directory(data_file)
+        self.count = shards
+        self.kind = kind
+        self.extension = snapshot.EXTENSION if snapshot.is_snapshot(data_file) else '.json'
+        self.manifest_path = os.path.join(self.directory, MANIFEST)
+        self._signature = None  # of the manifest as last read or written
+        self._generations = {}  # shard -> generation of the segment held in memory
+        self._locks = {}
+
+    def shard_of(self, provider_id):
+        """The segment holding a provider's appointments (those without a provider go to 0)"""
+        return provider_id % self.count if isinstance(provider_id, int) else 0
+
+    def segment_file(self, shard, count=None):
+        return f'shard-{shard:02d}-of-{count or self.count:02d}{self.extension}'
+
+    def lock(self, shard):
+        """The write lock of one segment, shared with other processes"""
+        lock = self._locks.get(shard)
+        if lock is None:
+            os.makedirs(self.directory, exist_ok=True)
+            lock = self._locks.setdefault(shard, FileLock(os.path.join(self.directory, f'shard-{shard:02d}.lock')))
+        return lock
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # Loading
+
+    def load(self, record_class=None):
+        """(records of every segment, whether the layout differs from the configured shard count)"""
+        signature = _signature(self.manifest_path)
+        manifest = self.read_manifest()
+        self._generations = {}
+        loaded = []
+        for shard, segment in manifest['segments'].items():
+            loaded.extend(self._load_segment(segment['file'], record_class))
+            self._generations[int(shard)] = segment['generation']
+        self._signature = signature
+        return loaded, manifest['shards'] != self.count
+
+    def changed_segments(self):
+        """Shards another process rewrote since this one last read them, or None to reload everything
+
+        Costs one stat of the manifest when nothing changed.
+        """
+        signature = _signature(self.manifest_path)
+        if signature == self._signature:
+            return []
+        manifest = self.read_manifest()
+        if manifest is None or manifest['shards'] != self.count:
+            return None
+        return [int(shard) for shard, segment in manifest['segments'].items()
+                if self._generations.get(int(shard)) != segment['generation']]
+
+    def load_segments(self, shards, record_class=None):
+        """{shard: records} for the given shards, as of the current manifest"""
+        signature = _signature(self.manifest_path)
+        manifest = self.read_manifest()
+        loaded = {}
+        for shard in shards:
+            segment = manifest['segments'].get(str(shard))
+            if segment is None:
+                loaded[shard] = []
+                continue
+            loaded[shard] = self._load_segment(segment['file'], record_class)
+            self._generations[shard] = segment['generation']
+        if all(self._generations.get(int(shard)) == segment['generation']
+               for shard, segment in manifest['segments'].items()):
+            self._signature = signature
+        return loaded
+
+    def _load_segment(self, filename, record_class=None):
+        path = os.path.join(self.directory, filename)
+        if snapshot.is_snapshot(path):
+            return snapshot.load_snapshot(path, self.kind, record_class=record_class)
+        if record_class is None:
+            return snapshot.load_json(path, self.kind)
+        with open(path, 'r') as f:
+            return [record_class.from_dict(record) for record in json.load(f)]
+
+    # Saving
+
+    def save(self, segments):
+        """Rewrite the given {shard: records} segments and record their new generations
+
+        Each segment is written under its lock (callers that reloaded it
+        under the same lock already hold it), and the manifest last, under a
+        file lock of its own, so a reader never sees a generation whose file
+        is not there yet. Segments left over from a different shard count are
+        removed once the manifest no longer lists them.
+        """
+        held = [self.lock(shard) for shard in sorted(segments)]
+        for lock in held:
+            lock.acquire()
+        try:
+            for shard, shard_records in segments.items():
+                self._write_segment(self.segment_file(shard), shard_records)
+            self._save_manifest(segments)
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+    def _save_manifest(self, segments):
+        with exclusive_file_lock(self.manifest_path + '.lock'):
+            manifest = self.read_manifest()
+            if manifest is None or manifest['shards'] != self.count:
+                manifest = {'version': VERSION, 'shards': self.count, 'segments': {}}
+            for shard, shard_records in segments.items():
+                previous = manifest['segments'].get(str(shard), {})
+                manifest['segments'][str(shard)] = {'file': self.segment_file(shard),
+                                                    'generation': previous.get('generation', 0) + 1,
+                                                    'appointments': len(shard_records)}
+            manifest['segments'] = dict(sorted(manifest['segments'].items(), key=lambda item: int(item[0])))
+            _write_atomic(self.manifest_path, lambda f: json.dump(manifest, f, indent=2))
+            signature = _signature(self.manifest_path)
+            listed = {segment['file'] for segment in manifest['segments'].values()}
+            for filename in os.listdir(self.directory):
+                if SEGMENT_PATTERN.match(filename) and filename not in listed:
+                    os.unlink(os.path.join(self.directory, filename))
+        # Only skip the next manifest read if no other process wrote a segment this one has not loaded
+        up_to_date = all(self._generations.get(int(shard)) == segment['generation']
+                         for shard, segment in manifest['segments'].items() if int(shard) not in segments)
+        for shard in segments:
+            self._generations[shard] = manifest['segments'][str(shard)]['generation']
+        self._signature = signature if up_to_date else None
+
+    def _write_segment(self, filename, shard_records):
+        path = os.path.join(self.directory, filename)
+        if snapshot.is_snapshot(path):
+            snapshot.write_snapshot(path, self.kind, shard_records)
+        else:
+            _write_atomic(path, lambda f: json.dump(shard_records, f, indent=2, default=records.json_default))
+
+
+def cmd_split(args):
+    shards = ShardedFiles(args.source, args.shards)
+    kind = snapshot._kind_for(args.source, args.kind)
+    shards.kind = kind
+    if snapshot.is_snapshot(args.source):
+        loaded = snapshot.load_snapshot(args.source, kind, defer_blobs=False)
+    else:
+        loaded = snapshot.load_json(args.source, kind)
+    segments = {shard: [] for shard in range(args.shards)}
+    for record in loaded:
+        segments[shards.shard_of(record.get('provider_id'))].append(record)
+    shards.save(segments)
+    print(f'{args.source} -> {shards.directory}: {len(loaded)} {kind} in {args.shards} segments')
+
+
+def cmd_join(args):
+    manifest_path = os.path.join(args.source, MANIFEST)
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    data_file = os.path.splitext(args.source)[0] + '.json'
+    shards = ShardedFiles(data_file, manifest['shards'], kind=args.kind or 'appointments')
+    loaded, _ = shards.load()
+    loaded.sort(key=lambda record: record['id'])
+    output = args.output or data_file
+    snapshot.write_json(output, loaded)
+    print(f'{args.source} -> {output}: {len(loaded)} {shards.kind}')
+
+
+def cmd_stats(args):
+    with open(os.path.join(args.source, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    sizes = {}
+    for shard, segment in manifest['segments'].items():
+        try:
+            sizes[shard] = os.path.getsize(os.path.join(args.source, segment['file']))
+        except OSError:
+            sizes[shard] = 0
+    counts = [segment['appointments'] for segment in manifest['segments'].values()]
+    print(f"{args.source}: {manifest['shards']} shards, {sum(counts)} records, "
+          f"{sum(sizes.values())} bytes (largest segment {max(counts, default=0)} records)")
+    for shard, segment in manifest['segments'].items():
+        print(f"  {segment['file']:>22}  generation {segment['generation']:>6}  "
+              f"{segment['appointments']:>7} records  {sizes[shard]:>10} bytes")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split a store file into provider shards, or join them back')
+    commands = parser.add_subparsers(dest='command', required=True)
+    split = commands.add_parser('split', help='split a JSON or snapshot store file into segments')
+    split.add_argument('source')
+    split.add_argument('--shards', type=int, default=16)
+    split.add_argument('--kind', choices=('appointments',), help='store kind (default: from the file name)')
+    split.set_defaults(func=cmd_split)
+    join = commands.add_parser('join', help='join the segments back into a single JSON file')
+    join.add_argument('source')
+    join.add_argument('--kind', choices=('appointments',))
+    join.add_argument('-o', '--output')
+    join.set_defaults(func=cmd_join)
+    stats = commands.add_parser('stats', help='show the segments listed in a manifest')
+    stats.add_argument('source')
+    stats.set_defaults(func=cmd_stats)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
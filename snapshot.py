@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+"""
+Binary snapshot format for the users, appointments and reviews stores
+
+Layout (little-endian):
+
+    header      magic, format version, store kind, record count, column count,
+                section offsets and a CRC32 of everything except the blob region
+    columns     directory of (name, type, offset) followed by one fixed-width
+                array per field: int64 ids/durations, int64 microsecond
+                timestamps, uint32 string-table references, or 16-byte blob
+                references (offset, length, CRC32)
+    strings     interned UTF-8 string table; repeated values such as statuses
+                and appointment types are stored once
+    blobs       large values (profile pictures, galleries) as JSON, each with
+                its own CRC32
+
+Fields outside a store's schema, and values that do not fit their column's
+type, travel as a JSON object in the ``extras`` column.
+
+Snapshots are loaded through mmap: columns are decoded in bulk, while blob
+values stay on disk until a record's field is first read (see
+DeferredRecord).
+
+Load times: the large gain is for stores whose size is in blobs. Users with
+profile pictures load in a few milliseconds, against over a second of JSON
+parsing for a few hundred providers. Appointments and reviews are small
+records, and one Python object per record has to be built either way (the
+scheduler indexes every booking as soon as it loads), so there a snapshot
+loads only about 1.1-1.5x faster than JSON. What it gives those stores is a
+file a third to a quarter the size, checksums, and no datetime parsing.
+
+Usage:
+    python snapshot.py to-snapshot users.json        # writes users.snap
+    python snapshot.py to-json users.snap            # writes users.json
+    python snapshot.py bench appointments.json       # JSON vs snapshot load time
+"""
+
+import argparse
+import gc
+import json
+import mmap
+import operator
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from contextlib import contextmanager
+from functools import partial
+from datetime import datetime, timedelta
+from itertools import repeat
+
+import records
+
+MAGIC = b'SCHDSNAP'
+VERSION = 1
+EXTENSION = '.snap'
+
+KINDS = ('users', 'appointments', 'reviews')
+
+# (field, column type): q = int64, t = timestamp, s = string, b = deferred blob
+SCHEMAS = {
+    'users': [
+        ('id', 'q'), ('username', 's'), ('password', 's'), ('email', 's'), ('phone', 's'),
+        ('name', 's'), ('profile_picture', 'b'), ('role', 's'), ('created_at', 's'),
+        ('business_name', 's'), ('business_description', 's'), ('service_category', 's'),
+        ('services_offered', 's'), ('address', 's'), ('gallery', 'b'),
+    ],
+    'appointments': [
+        ('id', 'q'), ('type', 's'), ('datetime', 't'), ('duration', 'q'), ('notes', 's'),
+        ('created_at', 't'), ('user_id', 'q'), ('provider_id', 'q'), ('status', 's'),
+        ('completed_at', 's'), ('series_id', 'q'),
+    ],
+    'reviews': [
+        ('id', 'q'), ('appointment_id', 'q'), ('reviewer_id', 'q'), ('reviewed_id', 'q'),
+        ('rating', 'q'), ('comment', 's'), ('created_at', 't'),
+    ],
+}
+
+# Fields held as datetime objects in memory (parsed from ISO strings in the JSON files)
+DATETIME_FIELDS = {
+    'users': (),
+    'appointments': ('datetime', 'created_at'),
+    'reviews': ('created_at',),
+}
+
+EXTRAS = '__extras__'
+
+# Compact record classes the app keeps these stores in (see records.py)
+RECORD_CLASSES = {
+    'appointments': records.Appointment,
+    'reviews': records.Review,
+}
+
+HEADER = struct.Struct('<8sHHIHHQQQQI8x')
+COLUMN = struct.Struct('<IBBHQ')
+BLOB_REF = struct.Struct('<QII')
+
+INT_MISSING = -2 ** 63
+INT_NONE = INT_MISSING + 1
+REF_MISSING = 0xFFFFFFFF
+REF_NONE = 0xFFFFFFFE
+BLOB_MISSING = 0xFFFFFFFF
+
+WIDTHS = {'q': 8, 't': 8, 's': 4, 'x': 4, 'b': BLOB_REF.size}
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+_MISSING = object()
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+# Deprecated from Python 3.12 on; only used where it is still silent
+_utcfromtimestamp = datetime.utcfromtimestamp if sys.version_info < (3, 12) else None
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class _Pending:
+    """Placeholder for a blob value that has not been read yet"""
+
+    def __repr__(self):
+        return '<deferred>'
+
+
+PENDING = _Pending()
+
+
+def is_snapshot(path):
+    return path.endswith(EXTENSION)
+
+
+def snapshot_path(path):
+    """users.json -> users.snap"""
+    return os.path.splitext(path)[0] + EXTENSION
+
+
+def json_path(path):
+    """users.snap -> users.json (JSON paths are returned unchanged)"""
+    return os.path.splitext(path)[0] + '.json' if is_snapshot(path) else path
+
+
+@contextmanager
+def _gc_paused():
+    # Building many small containers otherwise triggers repeated full collections
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class DeferredRecord(dict):
+    """Record dict whose blob fields are read from the snapshot on first access
+
+    Behaves like the plain dict the JSON loader returns: item access, get(),
+    items(), dict(record) and JSON encoding all resolve pending fields.
+    """
+
+    __slots__ = ('_blobs', '_index')
+
+    def _resolve(self, key):
+        value = self._blobs.read(key, self._index)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _resolve_all(self):
+        for key, value in dict.items(self):
+            if value is PENDING:
+                self._resolve(key)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value is PENDING:
+            return self._resolve(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if dict.get(self, key) is PENDING:
+            self._resolve(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def __iter__(self):
+        # Overriding __iter__ makes dict(record) and {**record} go through keys()/__getitem__
+        return dict.__iter__(self)
+
+    def items(self):
+        self._resolve_all()
+        return dict.items(self)
+
+    def values(self):
+        self._resolve_all()
+        return dict.values(self)
+
+    def copy(self):
+        return dict(self)
+
+    def __eq__(self, other):
+        self._resolve_all()
+        return dict.__eq__(self, other)
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def raw_blob(self, key):
+        """(bytes, crc) of a still-pending blob field, or None once it has been read"""
+        if dict.get(self, key) is PENDING:
+            return self._blobs.raw(key, self._index)
+        return None
+
+
+class BlobRegion:
+    """Blob references of a loaded snapshot plus the mapping they point into"""
+
+    def __init__(self, buffer, base, refs, path):
+        self.buffer = buffer
+        self.base = base
+        self.refs = refs  # field -> list of (offset, length, crc)
+        self.path = path
+
+    def raw(self, key, index):
+        offset, length, crc = self.refs[key][index]
+        start = self.base + offset
+        return self.buffer[start:start + length], crc
+
+    def read(self, key, index):
+        data, crc = self.raw(key, index)
+        if zlib.crc32(data) != crc:
+            raise SnapshotError(f'{self.path}: checksum mismatch in {key} of record {index}')
+        return json.loads(data)
+
+
+class _StringTable:
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def ref(self, value):
+        ref = self.index.get(value)
+        if ref is None:
+            ref = self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return ref
+
+    def encode(self):
+        encoded = [s.encode('utf-8') for s in self.strings]
+        offsets = array('I', [0])
+        total = 0
+        for data in encoded:
+            total += len(data)
+            offsets.append(total)
+        if _BIG_ENDIAN:
+            offsets.byteswap()
+        return struct.pack('<I', len(encoded)) + offsets.tobytes() + b''.join(encoded)
+
+
+def _pad(length):
+    return -length % 8
+
+
+def write_snapshot(path, kind, records):
+    """Write records to path atomically in snapshot format"""
+    schema = SCHEMAS[kind]
+    columns = schema + [(EXTRAS, 'x')]
+    fields = {name for name, _ in schema}
+    strings = _StringTable()
+    name_refs = [strings.ref(name) for name, _ in columns]
+    data = {name: (array('q') if kind_ in 'qt' else array('I') if kind_ in 'sx' else bytearray())
+            for name, kind_ in columns}
+    directory = os.path.dirname(os.path.abspath(path))
+
+    with tempfile.TemporaryFile(dir=directory) as blobs:
+        blob_offset = 0
+        count = 0
+        for record in records:
+            count += 1
+            if isinstance(record, dict):
+                # dict.items() leaves pending blobs unread; blob fields are never extras
+                extras = {key: value for key, value in dict.items(record) if key not in fields}
+                get = record.get if type(record) is dict else partial(dict.get, record)
+            else:
+                # Any other mapping, e.g. the slotted records from records.py
+                extras = {key: record[key] for key in record if key not in fields}
+                get = record.get
+            for name, column_type in schema:
+                value = get(name, _MISSING)
+                column = data[name]
+                if column_type == 'b':
+                    raw = record.raw_blob(name) if isinstance(record, DeferredRecord) else None
+                    if raw is not None:
+                        payload, crc = bytes(raw[0]), raw[1]
+                    elif value is _MISSING:
+                        column += BLOB_REF.pack(0, BLOB_MISSING, 0)
+                        continue
+                    else:
+                        payload = json.dumps(value, default=str).encode('utf-8')
+                        crc = zlib.crc32(payload)
+                    blobs.write(payload)
+                    column += BLOB_REF.pack(blob_offset, len(payload), crc)
+                    blob_offset += len(payload)
+                    continue
+                if value is _MISSING:
+                    column.append(INT_MISSING if column_type in 'qt' else REF_MISSING)
+                elif value is None:
+                    column.append(INT_NONE if column_type in 'qt' else REF_NONE)
+                elif column_type == 'q' and type(value) is int and value > INT_NONE:
+                    column.append(value)
+                elif column_type == 't' and isinstance(value, datetime) and value.tzinfo is None:
+                    column.append((value - EPOCH) // MICROSECOND)
+                elif column_type == 's' and type(value) is str:
+                    column.append(strings.ref(value))
+                else:
+                    # Does not fit the column (e.g. an unexpected type): keep it with the extras
+                    column.append(INT_MISSING if column_type in 'qt' else REF_MISSING)
+                    extras[name] = value
+            data[EXTRAS].append(strings.ref(json.dumps(extras, default=str)) if extras else REF_MISSING)
+
+        # Sections after the header: column directory, column arrays, string table, blobs
+        offset = HEADER.size + COLUMN.size * len(columns)
+        offset += _pad(offset)
+        column_entries = []
+        column_bytes = []
+        for (name, column_type), name_ref in zip(columns, name_refs):
+            column = data[name]
+            if isinstance(column, array):
+                if _BIG_ENDIAN:
+                    column.byteswap()
+                raw = column.tobytes()
+            else:
+                raw = bytes(column)
+            column_entries.append(COLUMN.pack(name_ref, ord(column_type), WIDTHS[column_type], 0, offset))
+            column_bytes.append(raw + b'\0' * _pad(len(raw)))
+            offset += len(column_bytes[-1])
+        string_bytes = strings.encode()
+        strings_offset = offset
+        offset += len(string_bytes)
+        offset += _pad(offset)
+        blobs_offset = offset
+
+        core = b''.join(column_entries)
+        core += b'\0' * _pad(HEADER.size + len(core))
+        core += b''.join(column_bytes) + string_bytes
+        core += b'\0' * (blobs_offset - HEADER.size - len(core))
+        header_fields = (MAGIC, VERSION, KINDS.index(kind), count, len(columns), 0,
+                         strings_offset, len(string_bytes), blobs_offset, blob_offset)
+        crc = zlib.crc32(core, zlib.crc32(struct.pack('<8sHHIHHQQQQ', *header_fields)))
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(*header_fields, crc))
+                f.write(core)
+                blobs.seek(0)
+                shutil.copyfileobj(blobs, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    return count
+
+
+def _int_column(buffer, offset, count):
+    values = array('q')
+    values.frombytes(buffer[offset:offset + 8 * count])
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def _ref_column(buffer, offset, count):
+    values = array('I')
+    values.frombytes(buffer[offset:offset + 4 * count])
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def _decode_ints(values):
+    """(list, has missing entries) for an int64 column"""
+    values = values.tolist()
+    # The sentinels are the two smallest int64 values
+    if values and min(values) <= INT_NONE:
+        return [_MISSING if v == INT_MISSING else None if v == INT_NONE else v
+                for v in values], INT_MISSING in values
+    return values, False
+
+
+def _to_datetimes(micros):
+    if _utcfromtimestamp is not None and not any(map(operator.mod, micros, repeat(1000000))):
+        # Whole seconds (e.g. slot start times) convert exactly and about twice as fast
+        return list(map(_utcfromtimestamp, map(operator.floordiv, micros, repeat(1000000))))
+    return list(map(EPOCH.__add__, map(timedelta, repeat(0), repeat(0), micros)))
+
+
+def _decode_timestamps(values):
+    values = values.tolist()
+    if values and min(values) <= INT_NONE:
+        converted = iter(_to_datetimes([v for v in values if v > INT_NONE]))
+        return [_MISSING if v == INT_MISSING else None if v == INT_NONE else next(converted)
+                for v in values], INT_MISSING in values
+    return _to_datetimes(values), False
+
+
+def _decode_refs(values, strings):
+    values = values.tolist()
+    # The sentinels are the two largest uint32 values
+    if values and max(values) >= REF_NONE:
+        return [_MISSING if v == REF_MISSING else None if v == REF_NONE else strings[v]
+                for v in values], REF_MISSING in values
+    return list(map(strings.__getitem__, values)), False
+
+
+def _read_strings(buffer, offset, length):
+    count, = struct.unpack_from('<I', buffer, offset)
+    offsets = _ref_column(buffer, offset + 4, count + 1).tolist()
+    start = offset + 4 + 4 * (count + 1)
+    text = bytes(buffer[start:start + offsets[-1]])
+    if start + offsets[-1] > offset + length:
+        raise SnapshotError('string table overruns its section')
+    return [text[a:b].decode('utf-8') for a, b in zip(offsets, offsets[1:])]
+
+
+def load_snapshot(path, kind=None, defer_blobs=True, record_class=None):
+    """Records from a snapshot file; blob fields stay on disk until read when defer_blobs is set
+
+    With record_class, records are built by record_class.from_columns(count,
+    columns, extras, missing) from the decoded columns, with timestamps left
+    as epoch microseconds.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            raise SnapshotError(f'{path}: file too short for a snapshot')
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, kind_code, count, ncolumns, _flags,
+     strings_offset, strings_length, blobs_offset, blobs_length, crc) = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise SnapshotError(f'{path}: not a snapshot file')
+    if version != VERSION:
+        raise SnapshotError(f'{path}: unsupported snapshot version {version}')
+    if kind_code >= len(KINDS) or (kind is not None and KINDS[kind_code] != kind):
+        raise SnapshotError(f'{path}: snapshot does not hold {kind}')
+    if blobs_offset + blobs_length > size:
+        raise SnapshotError(f'{path}: truncated snapshot')
+    header_crc = zlib.crc32(buffer[:HEADER.size - 12])
+    with memoryview(buffer) as view:
+        if zlib.crc32(view[HEADER.size:blobs_offset], header_crc) != crc:
+            raise SnapshotError(f'{path}: checksum mismatch')
+
+    strings = _read_strings(buffer, strings_offset, strings_length)
+
+    dense_names, dense_values, sparse, blob_refs = [], [], [], {}
+    extras = None
+    with _gc_paused():
+        for i in range(ncolumns):
+            name_ref, type_code, _width, _, offset = COLUMN.unpack_from(buffer, HEADER.size + i * COLUMN.size)
+            name, column_type = strings[name_ref], chr(type_code)
+            if column_type == 'q':
+                values, missing = _decode_ints(_int_column(buffer, offset, count))
+            elif column_type == 't':
+                if record_class is not None:
+                    values, missing = _decode_ints(_int_column(buffer, offset, count))
+                else:
+                    values, missing = _decode_timestamps(_int_column(buffer, offset, count))
+            elif column_type in 'sx':
+                values, missing = _decode_refs(_ref_column(buffer, offset, count), strings)
+                if column_type == 'x':
+                    extras = values
+                    continue
+            elif column_type == 'b':
+                refs = list(BLOB_REF.iter_unpack(buffer[offset:offset + BLOB_REF.size * count]))
+                blob_refs[name] = refs
+                values = [_MISSING if length == BLOB_MISSING else PENDING for _, length, _ in refs]
+                missing = _MISSING in values
+            else:
+                raise SnapshotError(f'{path}: unknown column type {column_type!r}')
+            if missing:
+                if values.count(_MISSING) < count:
+                    sparse.append((name, values))
+            else:
+                dense_names.append(name)
+                dense_values.append(values)
+
+        if record_class is not None:
+            columns = dict(zip(dense_names, dense_values))
+            columns.update(sparse)
+            records = record_class.from_columns(count, columns, extras, _MISSING)
+            buffer.close()
+            return records
+
+        blobs = BlobRegion(buffer, blobs_offset, blob_refs, path) if blob_refs else None
+        record_type = DeferredRecord if blobs else dict
+        if dense_names:
+            records = list(map(record_type, map(zip, repeat(dense_names), zip(*dense_values))))
+        else:
+            records = [record_type() for _ in range(count)]
+        for name, values in sparse:
+            for record, value in zip(records, values):
+                if value is not _MISSING:
+                    dict.__setitem__(record, name, value)
+        if extras is not None:
+            for record, value in zip(records, extras):
+                if value is not _MISSING and value is not None:
+                    record.update(json.loads(value))
+        if blobs:
+            for index, record in enumerate(records):
+                record._blobs = blobs
+                record._index = index
+            if not defer_blobs:
+                for record in records:
+                    record._resolve_all()
+
+    if not blobs or not defer_blobs:
+        buffer.close()
+    return records
+
+
+def load_json(path, kind):
+    """Records from a JSON store file, with datetimes parsed the way the managers do"""
+    with open(path, 'r', encoding='utf-8') as f:
+        records = json.load(f)
+    datetime_fields = DATETIME_FIELDS[kind]
+    for record in records:
+        for field in datetime_fields:
+            if isinstance(record.get(field), str):
+                record[field] = datetime.fromisoformat(record[field])
+    return records
+
+
+def write_json(path, records):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(records, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def _kind_for(path, kind):
+    kind = kind or os.path.splitext(os.path.basename(path))[0]
+    if kind not in KINDS:
+        raise SystemExit(f"Cannot tell the store kind from '{path}'; pass --kind ({', '.join(KINDS)})")
+    return kind
+
+
+def cmd_to_snapshot(args):
+    kind = _kind_for(args.source, args.kind)
+    output = args.output or snapshot_path(args.source)
+    count = write_snapshot(output, kind, load_json(args.source, kind))
+    print(f'{args.source} -> {output}: {count} {kind}, '
+          f'{os.path.getsize(args.source)} -> {os.path.getsize(output)} bytes')
+
+
+def cmd_to_json(args):
+    kind = _kind_for(args.source, args.kind)
+    output = args.output or json_path(args.source)
+    records = load_snapshot(args.source, kind, defer_blobs=False)
+    write_json(output, records)
+    print(f'{args.source} -> {output}: {len(records)} {kind}')
+
+
+def cmd_bench(args):
+    kind = _kind_for(args.source, args.kind)
+    snap = os.path.join(tempfile.mkdtemp(), kind + EXTENSION)
+    write_snapshot(snap, kind, load_json(args.source, kind))
+
+    def best(load):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            load()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    json_time = best(lambda: load_json(args.source, kind))
+    snap_time = best(lambda: load_snapshot(snap, kind))
+    eager_time = best(lambda: load_snapshot(snap, kind, defer_blobs=False))
+    print(f'{kind}: json {json_time * 1000:.1f} ms ({os.path.getsize(args.source)} bytes), '
+          f'snapshot {snap_time * 1000:.1f} ms ({os.path.getsize(snap)} bytes, {json_time / snap_time:.1f}x), '
+          f'snapshot with blobs {eager_time * 1000:.1f} ms ({json_time / eager_time:.1f}x)')
+    record_class = RECORD_CLASSES.get(kind)
+    if record_class:
+        record_time = best(lambda: load_snapshot(snap, kind, record_class=record_class))
+        print(f'{kind}: snapshot into {record_class.__name__} records {record_time * 1000:.1f} ms '
+              f'({json_time / record_time:.1f}x)')
+    shutil.rmtree(os.path.dirname(snap))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert store files between JSON and snapshot format')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, func, help_text in (('to-snapshot', cmd_to_snapshot, 'convert a JSON store file to a snapshot'),
+                                  ('to-json', cmd_to_json, 'convert a snapshot back to JSON'),
+                                  ('bench', cmd_bench, 'compare JSON and snapshot load times')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('source')
+        command.add_argument('--kind', choices=KINDS, help='store kind (default: from the file name)')
+        if name == 'bench':
+            command.add_argument('--repeat', type=int, default=3)
+        else:
+            command.add_argument('-o', '--output')
+        command.set_defaults(func=func)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+"""
+Server-sent events for live dashboards
+
+``EventBroker`` is a pub/sub. Each topic (here, a provider id) has a
+bounded ring buffer of recent events, and event ids increase across all
+topics, so a client that reconnects with ``Last-Event-ID`` gets exactly
+what it missed. It gets a ``resync`` event instead when the buffer no
+longer reaches back that far, or when the id came from another process.
+
+On its own a broker lives in one process. With several worker processes,
+``share()`` hands it a log file they all append to (a ``changes.ChangeLog``):
+every process follows the log and fills its own buffers from it, and the
+log's sequence numbers are the event ids, so a subscriber hears about
+bookings made through any worker and can resume on any of them.
+
+``EventHub`` keeps idle subscriber connections on a single selector
+thread. A connection costs a socket and a small slotted object, not a
+request thread. The server has to be able to hand a finished request's
+socket over (serve.py does, through ``environ['serve.detach']``);
+elsewhere, ``stream()`` serves the feed from the request thread instead.
+"""
+
+import collections
+import json
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+import uuid
+
+from changes import ChangesExpired
+
+HEARTBEAT = b': ping\n\n'
+SHARED_TOKEN = 'log'
+
+logger = logging.getLogger(__name__)
+
+
+def encode(event_id, name, data):
+    return f'id: {event_id}\nevent: {name}\ndata: {json.dumps(data, default=str)}\n\n'.encode()
+
+
+class EventBroker:
+    """Recent events per topic, plus wake-ups for whoever streams them"""
+
+    def __init__(self, buffer_size=256):
+        self.buffer_size = buffer_size
+        self.hooks = []  # hook(topic) after every publish; topic None means every topic
+        self._changed = threading.Condition()
+        self._open_log = None
+        self.log = None
+        self._pid = None
+        self._reset()
+
+    @property
+    def shared(self):
+        """Whether this process's events go through a shared log"""
+        self._check_process()
+        return self.log is not None
+
+    def share(self, open_log):
+        """Carry events between processes through the log open_log() returns (None: stay in-process)
+
+        Called again in each process on first use, so every worker opens the
+        log and starts its own follower thread.
+        """
+        with self._changed:
+            self._open_log = open_log
+            self._pid = None
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._seq = 0
+        self._floor = 0  # resuming from before this is not possible
+        self._buffers = {}  # topic -> deque of (seq, encoded event)
+        self._dropped = {}  # topic -> seq of the newest event pushed out of its buffer
+        self.log = self._open_log() if self._open_log is not None else None
+        if self.log is None:
+            # Ids are only meaningful within one process; forked workers start over with their own token
+            self.token = uuid.uuid4().hex[:8]
+            return
+        self.token = SHARED_TOKEN
+        self._seq = self._floor = self.log.last_seq
+        threading.Thread(target=self._follow, args=(self.log, self._seq), name='sse-follow', daemon=True).start()
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def publish(self, topic, name, data):
+        """Append an event for topic and wake its subscribers; returns the event id"""
+        with self._changed:
+            self._check_process()
+            log = self.log
+            if log is None:
+                self._seq += 1
+                self._append(topic, self._seq, name, data)
+                seq = self._seq
+        if log is not None:
+            # Every process's follower (this one's included) picks it up from the log
+            seq = log.append('live', topic, name, data)
+        else:
+            for hook in self.hooks:
+                hook(topic)
+        return f'{self.token}-{seq}'
+
+    def _append(self, topic, seq, name, data):
+        buffer = self._buffers.get(topic)
+        if buffer is None:
+            buffer = self._buffers[topic] = collections.deque()
+        buffer.append((seq, encode(f'{self.token}-{seq}', name, data)))
+        if len(buffer) > self.buffer_size:
+            self._dropped[topic] = buffer.popleft()[0]
+        self._changed.notify_all()
+
+    def resync_all(self):
+        """Tell every subscriber to reload (after a store was replaced wholesale)"""
+        with self._changed:
+            self._check_process()
+            log = self.log
+            if log is None:
+                self._seq += 1
+                self._clear(self._seq)
+        if log is not None:
+            log.append('live', None, 'resync', {})
+        else:
+            for hook in self.hooks:
+                hook(None)
+
+    def _clear(self, seq):
+        for topic in list(self._buffers):
+            self._dropped[topic] = seq
+            self._buffers[topic].clear()
+        self._floor = seq
+        self._changed.notify_all()
+
+    def _follow(self, log, since):
+        """Follower thread: feed events other processes (and this one) append to the shared log"""
+        while self._pid == os.getpid() and self.log is log:
+            try:
+                for event in log.follow(since):
+                    if self.log is not log:
+                        return  # share() or a fork replaced the log
+                    topic, name, seq = event['id'], event['op'], event['seq']
+                    with self._changed:
+                        if name == 'resync':
+                            self._clear(seq)
+                        else:
+                            self._append(topic, seq, name, event['fields'])
+                        self._seq = seq
+                    since = seq
+                    for hook in self.hooks:
+                        hook(None if name == 'resync' else topic)
+            except ChangesExpired:
+                # Fell behind the log's retention: whoever was listening has to reload
+                since = log.last_seq
+                with self._changed:
+                    self._seq = since
+                    self._clear(since)
+                for hook in self.hooks:
+                    hook(None)
+            except Exception:
+                logger.exception('Could not follow the shared event log')
+                time.sleep(1)
+
+    def position(self, last_event_id=None):
+        """Sequence number to resume after: now without an id, -1 if the id cannot be resumed"""
+        self._check_process()
+        if not last_event_id:
+            return self._seq
+        token, _, seq = last_event_id.partition('-')
+        if token != self.token or not seq.isdigit():
+            return -1
+        return int(seq)
+
+    def since(self, topic, seq):
+        """(encoded events for topic after seq, new position); events is None if some were lost"""
+        with self._changed:
+            if seq < 0 or seq < self._dropped.get(topic, self._floor):
+                return None, self._seq
+            buffer = self._buffers.get(topic, ())
+            # A client that resumed on a worker whose follower lags keeps its (later) position
+            return [data for event_seq, data in buffer if event_seq > seq], max(seq, self._seq)
+
+    def last_event_id(self):
+        """Id of the newest event, for a page to resume its feed from where it was rendered"""
+        self._check_process()
+        return f'{self.token}-{self._seq}'
+
+    def resync_event(self):
+        """Tells a client it missed events and should reload"""
+        return encode(f'{self.token}-{self._seq}', 'resync', {})
+
+    def wait(self, seq, timeout):
+        """Block until anything newer than seq is published (or timeout)"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._seq > seq, timeout)
+
+
+def stream(broker, topic, last_event_id=None, heartbeat=15.0):
+    """Event stream generator for servers that cannot hand sockets over (holds the request thread)"""
+    seq = broker.position(last_event_id)
+    while True:
+        events, position = broker.since(topic, seq)
+        if events is None:
+            yield broker.resync_event()
+        else:
+            yield b''.join(events) or HEARTBEAT
+        seq = position
+        broker.wait(seq, heartbeat)
+
+
+class _Connection:
+    __slots__ = ('sock', 'topic', 'seq', 'pending')
+
+    def __init__(self, sock, topic, seq):
+        self.sock = sock
+        self.topic = topic
+        self.seq = seq
+        self.pending = b''
+
+
+class EventHub:
+    """One thread that pushes events and heartbeats to every idle subscriber socket"""
+
+    def __init__(self, broker, heartbeat=15.0, max_connections=1000, max_pending=64 * 1024):
+        self.broker = broker
+        self.heartbeat = heartbeat
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self._topics = {}  # topic -> set of connections
+        self._count = 0
+        self._incoming = collections.deque()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        broker.hooks.append(self._published)
+
+    def __len__(self):
+        return self._count
+
+    def start(self):
+        """Start the hub thread in this process (idempotent, fork-aware)"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._topics = {}
+            self._count = 0
+            self._selector = selectors.DefaultSelector()
+            self._wake_r, self._wake_w = socket.socketpair()
+            self._wake_r.setblocking(False)
+            self._wake_w.setblocking(False)
+            self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+            self._thread = threading.Thread(target=self._run, name='sse-hub', daemon=True)
+            self._thread.start()
+
+    def has_room(self):
+        return self._count + len(self._incoming) < self.max_connections
+
+    def attach(self, sock, topic, last_event_id=None):
+        """Take over a socket whose response headers were already sent"""
+        self.start()
+        self._incoming.append(_Connection(sock, topic, self.broker.position(last_event_id)))
+        self._wake()
+
+    def _published(self, topic):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._dirty.add(topic)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # already has a wake-up pending
+
+    def _run(self):
+        next_heartbeat = time.monotonic() + self.heartbeat
+        while True:
+            timeout = max(0.0, next_heartbeat - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                connection = key.data
+                if mask & selectors.EVENT_READ:
+                    # Subscribers never send anything; readable means closed (or misbehaving)
+                    self._close(connection)
+                elif mask & selectors.EVENT_WRITE:
+                    self._flush(connection)
+
+            while self._incoming:
+                connection = self._incoming.popleft()
+                self._add(connection)
+                self._deliver(connection)
+
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            if None in dirty:
+                dirty = set(self._topics)
+            for topic in dirty:
+                for connection in list(self._topics.get(topic, ())):
+                    self._deliver(connection)
+
+            if time.monotonic() >= next_heartbeat:
+                next_heartbeat = time.monotonic() + self.heartbeat
+                for connections in list(self._topics.values()):
+                    for connection in list(connections):
+                        if not connection.pending:
+                            self._send(connection, HEARTBEAT)
+
+    def _add(self, connection):
+        try:
+            connection.sock.setblocking(False)
+            self._selector.register(connection.sock, selectors.EVENT_READ, connection)
+        except (OSError, ValueError):
+            connection.sock.close()
+            return
+        self._topics.setdefault(connection.topic, set()).add(connection)
+        self._count += 1
+
+    def _deliver(self, connection):
+        if connection.sock.fileno() < 0:
+            return
+        events, connection.seq = self.broker.since(connection.topic, connection.seq)
+        if events is None:
+            self._send(connection, self.broker.resync_event())
+        elif events:
+            self._send(connection, b''.join(events))
+
+    def _send(self, connection, data):
+        connection.pending += data
+        if len(connection.pending) > self.max_pending:
+            # A reader this slow would hold memory without bound; it can reconnect and resume
+            self._close(connection)
+            return
+        self._flush(connection)
+
+    def _flush(self, connection):
+        try:
+            sent = connection.sock.send(connection.pending)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._close(connection)
+            return
+        connection.pending = connection.pending[sent:]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.pending else 0)
+        try:
+            self._selector.modify(connection.sock, events, connection)
+        except (KeyError, ValueError):
+            pass
+
+    def _close(self, connection):
+        topic_connections = self._topics.get(connection.topic)
+        if topic_connections is not None and connection in topic_connections:
+            topic_connections.discard(connection)
+            if not topic_connections:
+                del self._topics[connection.topic]
+            self._count -= 1
+        try:
+            self._selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            connection.sock.close()
+        except OSError:
+            pass
@@ -0,0 +1,209 @@
+// Live updates for the provider appointments page
+// Listens to /provider/appointments/events (server-sent events) and moves appointment
+// cards and rows between the pending, confirmed and completed sections without reloading.
+
+const providerFeed = {
+    connected: false,
+    script: document.currentScript,
+};
+
+// After an action on this page: the feed will show its result, so only reload without it
+function refreshUnlessLive() {
+    if (!providerFeed.connected) {
+        location.reload();
+    }
+}
+
+function feedElement(tag, className, text) {
+    const element = document.createElement(tag);
+    if (className) {
+        element.className = className;
+    }
+    if (text !== undefined) {
+        element.textContent = text;
+    }
+    return element;
+}
+
+function feedIcon(name) {
+    return feedElement('i', `fas fa-${name} me-1`);
+}
+
+function feedButton(className, icon, label, onClick) {
+    const button = feedElement('button', `btn ${className} btn-sm`);
+    button.appendChild(feedIcon(icon));
+    button.appendChild(document.createTextNode(label));
+    button.addEventListener('click', onClick);
+    return button;
+}
+
+function feedContactLinks(apt, container, separator) {
+    if (apt.customer_phone) {
+        const phone = feedElement('a', '', apt.customer_phone);
+        phone.href = `tel:${apt.customer_phone}`;
+        container.appendChild(phone);
+        if (separator) {
+            container.appendChild(document.createElement('br'));
+        }
+    }
+    if (apt.customer_email) {
+        const email = feedElement('a', '', apt.customer_email);
+        email.href = `mailto:${apt.customer_email}`;
+        container.appendChild(email);
+    }
+}
+
+function pendingCard(apt) {
+    const column = feedElement('div', 'col-md-6 col-lg-4');
+    column.dataset.appointmentId = apt.id;
+    column.dataset.start = apt.start;
+    const card = feedElement('div', 'card border-warning');
+    const body = feedElement('div', 'card-body');
+
+    const heading = feedElement('div', 'd-flex justify-content-between align-items-start mb-2');
+    heading.appendChild(feedElement('h6', 'card-title mb-0', apt.customer_name));
+    heading.appendChild(feedElement('span', 'badge bg-warning text-dark', 'Pending'));
+    body.appendChild(heading);
+
+    const type = feedElement('div', 'mb-2');
+    type.appendChild(feedElement('strong', '', apt.type));
+    body.appendChild(type);
+
+    const date = feedElement('div', 'mb-2');
+    date.appendChild(feedIcon('calendar'));
+    date.appendChild(document.createTextNode(apt.date_label));
+    body.appendChild(date);
+
+    const time = feedElement('div', 'mb-2');
+    time.appendChild(feedIcon('clock'));
+    time.appendChild(document.createTextNode(`${apt.time_label} (${apt.duration} min)`));
+    body.appendChild(time);
+
+    if (apt.notes) {
+        const notes = feedElement('div', 'mb-3');
+        const small = feedElement('small', 'text-muted');
+        small.appendChild(feedElement('strong', '', 'Notes:'));
+        small.appendChild(document.createTextNode(` ${apt.notes}`));
+        notes.appendChild(small);
+        body.appendChild(notes);
+    }
+
+    const contact = feedElement('div', 'mb-3');
+    feedContactLinks(apt, contact, true);
+    body.appendChild(contact);
+
+    const actions = feedElement('div', 'd-grid gap-2');
+    actions.appendChild(feedButton('btn-success', 'check', 'Confirm', () => confirmAppointment(apt.id)));
+    actions.appendChild(feedButton('btn-danger', 'times', 'Decline', () => declineAppointment(apt.id)));
+    body.appendChild(actions);
+
+    card.appendChild(body);
+    column.appendChild(card);
+    return column;
+}
+
+function appointmentRow(apt, withContact) {
+    const row = document.createElement('tr');
+    row.dataset.appointmentId = apt.id;
+    row.dataset.start = apt.start;
+    row.appendChild(feedElement('td', '', apt.customer_name));
+    row.appendChild(feedElement('td', '', apt.type));
+    const when = feedElement('td', '', apt.date_label);
+    when.appendChild(document.createElement('br'));
+    when.appendChild(feedElement('small', 'text-muted', apt.time_label));
+    row.appendChild(when);
+    row.appendChild(feedElement('td', '', `${apt.duration} min`));
+    if (withContact) {
+        const contact = document.createElement('td');
+        feedContactLinks(apt, contact, true);
+        row.appendChild(contact);
+    }
+    return row;
+}
+
+function confirmedRow(apt) {
+    const row = appointmentRow(apt, true);
+    const actions = document.createElement('td');
+    if (new Date(apt.start) <= new Date()) {
+        actions.appendChild(feedButton('btn-primary', 'check', 'Complete', () => completeAppointment(apt.id)));
+    } else {
+        actions.appendChild(feedElement('small', 'text-muted', 'Upcoming'));
+    }
+    row.appendChild(actions);
+    return row;
+}
+
+function completedRow(apt) {
+    const row = appointmentRow(apt, false);
+    const actions = document.createElement('td');
+    const review = feedElement('a', 'btn btn-outline-warning btn-sm');
+    review.href = `/appointment/${apt.id}/review`;
+    review.title = 'Review Customer';
+    review.appendChild(feedElement('i', 'fas fa-star'));
+    actions.appendChild(review);
+    row.appendChild(actions);
+    return row;
+}
+
+const feedSections = {
+    pending: {id: 'pendingSection', build: pendingCard},
+    confirmed: {id: 'confirmedSection', build: confirmedRow},
+    completed: {id: 'completedSection', build: completedRow},
+};
+
+function updateSectionCounts() {
+    let total = 0;
+    Object.values(feedSections).forEach(section => {
+        const element = document.getElementById(section.id);
+        const count = element.querySelector('.section-items').children.length;
+        element.querySelector('.section-count').textContent = count;
+        element.style.display = count ? '' : 'none';
+        total += count;
+    });
+    document.getElementById('noAppointments').style.display = total ? 'none' : '';
+}
+
+function removeAppointment(id) {
+    document.querySelectorAll(`[data-appointment-id="${id}"]`).forEach(element => element.remove());
+}
+
+function placeAppointment(apt) {
+    removeAppointment(apt.id);
+    const section = feedSections[apt.status];
+    if (section) {
+        // Keep rows ordered by start time, like the rendered page
+        const items = document.getElementById(section.id).querySelector('.section-items');
+        const element = section.build(apt);
+        const next = Array.from(items.children).find(child => child.dataset.start && child.dataset.start > apt.start);
+        items.insertBefore(element, next || null);
+    }
+    updateSectionCounts();
+}
+
+function connectProviderFeed() {
+    const script = providerFeed.script;
+    if (!script || !window.EventSource) {
+        return;
+    }
+    // Resume from where the page was rendered, so nothing in between is missed
+    let url = script.dataset.eventsUrl;
+    if (script.dataset.lastEventId) {
+        url += `?last_event_id=${encodeURIComponent(script.dataset.lastEventId)}`;
+    }
+    const source = new EventSource(url);
+    source.addEventListener('open', () => { providerFeed.connected = true; });
+    source.addEventListener('error', () => { providerFeed.connected = false; });
+    ['created', 'status_changed'].forEach(name => {
+        source.addEventListener(name, event => placeAppointment(JSON.parse(event.data)));
+    });
+    source.addEventListener('cancelled', event => {
+        removeAppointment(JSON.parse(event.data).id);
+        updateSectionCounts();
+    });
+    // Recurring bookings span several sections; a fresh page shows them where they now belong
+    source.addEventListener('series_changed', () => location.reload());
+    // Events were missed (long disconnect, server restart): start over from a fresh page
+    source.addEventListener('resync', () => location.reload());
+}
+
+document.addEventListener('DOMContentLoaded', connectProviderFeed);
@@ -1,28 +1,25 @@
 // Provider filtering functionality for provider listing pages
+// Searches on the server (/api/search: ranked, diacritic-insensitive, completes the last word)
+// and falls back to matching the cards' text if the request fails.
 
-function filterProviders() {
-    const searchQuery = document.getElementById('searchProvider').value.toLowerCase();
+let searchTimer = null;
+let searchRequest = 0;
+
+function showCards(isVisible) {
     const providerCards = document.querySelectorAll('.provider-card');
     const noResults = document.getElementById('noResults');
-    
-    if (!providerCards || !noResults) {
-        return; // Guard clause if elements don't exist
-    }
-    
+    const searchQuery = document.getElementById('searchProvider').value.trim();
+
     let visibleCount = 0;
-    
     providerCards.forEach(card => {
-        const name = card.dataset.name || '';
-        const services = card.dataset.services || '';
-        
-        if (searchQuery === '' || name.includes(searchQuery) || services.includes(searchQuery)) {
+        if (isVisible(card)) {
             card.style.display = '';
             visibleCount++;
         } else {
             card.style.display = 'none';
         }
     });
-    
+
     // Show/hide no results message
     if (visibleCount === 0 && searchQuery !== '') {
         noResults.style.display = 'block';
@@ -31,6 +28,110 @@ function filterProviders() {
     }
 }
 
+// Matches that are not among the cards on this page (listings are paged)
+function showOtherMatches(results) {
+    const noResults = document.getElementById('noResults');
+    let list = document.getElementById('otherMatches');
+    if (!list) {
+        list = document.createElement('div');
+        list.id = 'otherMatches';
+        list.className = 'list-group mb-4';
+        noResults.parentNode.insertBefore(list, noResults.nextSibling);
+    }
+    list.innerHTML = '';
+    results.forEach(result => {
+        const link = document.createElement('a');
+        link.className = 'list-group-item list-group-item-action';
+        link.href = result.url;
+        link.textContent = result.business_name || result.name;
+        if (result.address) {
+            const address = document.createElement('small');
+            address.className = 'text-muted ms-2';
+            address.textContent = result.address;
+            link.appendChild(address);
+        }
+        list.appendChild(link);
+    });
+    if (results.length) {
+        noResults.style.display = 'none';
+    }
+}
+
+function filterLocally(searchQuery) {
+    showCards(card => {
+        const name = card.dataset.name || '';
+        const services = card.dataset.services || '';
+        return searchQuery === '' || name.includes(searchQuery) || services.includes(searchQuery);
+    });
+}
+
+function updateSuggestions(suggestions) {
+    const searchInput = document.getElementById('searchProvider');
+    let list = document.getElementById('searchSuggestions');
+    if (!list) {
+        list = document.createElement('datalist');
+        list.id = 'searchSuggestions';
+        document.body.appendChild(list);
+        searchInput.setAttribute('list', list.id);
+    }
+    // Offer the query with its last word completed
+    const words = searchInput.value.split(/\s+/);
+    const head = words.slice(0, -1).join(' ');
+    list.innerHTML = '';
+    (suggestions || []).forEach(term => {
+        const option = document.createElement('option');
+        option.value = head ? `${head} ${term}` : term;
+        list.appendChild(option);
+    });
+}
+
+function filterProviders() {
+    const searchInput = document.getElementById('searchProvider');
+    const providerCards = document.querySelectorAll('.provider-card');
+    const noResults = document.getElementById('noResults');
+
+    if (!searchInput || !providerCards.length || !noResults) {
+        return; // Guard clause if elements don't exist
+    }
+
+    const rawQuery = searchInput.value;
+    if (rawQuery.trim() === '') {
+        filterLocally('');
+        updateSuggestions([]);
+        showOtherMatches([]);
+        return;
+    }
+
+    // Wait for a pause in typing before asking the server
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => {
+        const request = ++searchRequest;
+        const params = new URLSearchParams({q: rawQuery, limit: '50', suggest: '1'});
+        const category = providerCards[0].dataset.category;
+        if (category) {
+            params.set('category', category);
+        }
+        fetch(`/api/search?${params}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Search failed: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (request !== searchRequest) {
+                    return; // A newer query is already on its way
+                }
+                const matches = new Set(data.results.map(result => String(result.id)));
+                showCards(card => matches.has(card.dataset.id));
+                const shown = new Set(Array.from(document.querySelectorAll('.provider-card'), card => card.dataset.id));
+                showOtherMatches(data.results.filter(result => !shown.has(String(result.id))));
+                updateSuggestions(data.suggestions);
+            })
+            .catch(() => filterLocally(rawQuery.trim().toLowerCase()));
+    }, 150);
+}
+
 function clearSearch() {
     const searchInput = document.getElementById('searchProvider');
     if (searchInput) {
@@ -39,11 +140,10 @@ function clearSearch() {
     }
 }
 
-// Add event listener when DOM is ready
+// Add event listener when DOM is ready (unless the page already wires oninput)
 document.addEventListener('DOMContentLoaded', function() {
     const searchInput = document.getElementById('searchProvider');
-    if (searchInput) {
+    if (searchInput && !searchInput.hasAttribute('oninput')) {
         searchInput.addEventListener('input', filterProviders);
     }
 });
-
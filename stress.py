@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for the data stores
+
+Runs many threads that book, bulk-import, cancel and review appointments
+against a small number of providers (so most requests fight over the same
+slots), then checks that:
+
+- no provider has two active bookings that overlap;
+- every appointment, review and user id is unique and no id is handed out twice,
+  even after the record holding it was cancelled;
+- racing sign-ups with one username create exactly one account;
+- the files on disk reload to exactly what is in memory.
+
+Uses a throwaway directory, never the real data files:
+
+    python stress.py --threads 16 --operations 200
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Hammer the stores from many threads and check invariants')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--operations', type=int, default=200, help='operations per thread')
+    parser.add_argument('--providers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='stress-')
+    os.chdir(workdir)
+    sys.path.insert(0, HERE)
+    # Switch threads far more often than usual to shake out races
+    sys.setswitchinterval(1e-5)
+
+    import app as appmodule
+    import bulk
+
+    scheduler = appmodule.scheduler
+    user_manager = appmodule.user_manager
+    review_manager = appmodule.review_manager
+    seed = args.seed if args.seed is not None else random.randrange(1 << 30)
+    print(f'Working in {workdir} (seed {seed})')
+
+    failures = []
+    handed_out = {'appointments': []}
+    handed_out_lock = threading.Lock()
+    last_created = threading.local()  # listeners run on the booking thread
+
+    def record_created(event, appointment, previous_status=None):
+        if event == 'created':
+            last_created.id = appointment['id']
+            with handed_out_lock:
+                handed_out['appointments'].append(appointment['id'])
+
+    scheduler.add_listener(record_created)
+
+    # Accounts: one sign-up race per provider name, plus customers
+    def sign_up(name, role):
+        user_manager.create_user(name, 'password', f'{name}@example.com', role,
+                                 business_name=name, service_category='hair')
+
+    racers = [threading.Thread(target=sign_up, args=(f'provider{n}', 'provider'))
+              for n in range(args.providers) for _ in range(4)]
+    racers += [threading.Thread(target=sign_up, args=(f'customer{n}', 'consumer'))
+               for n in range(args.threads) for _ in range(2)]
+    for thread in racers:
+        thread.start()
+    for thread in racers:
+        thread.join()
+    names = Counter(user['username'] for user in user_manager.users)
+    if any(count > 1 for count in names.values()) or len(names) != args.providers + args.threads:
+        failures.append(f'sign-up race: {dict(names)}')
+    providers = [user for user in user_manager.users if user['role'] == 'provider']
+    customers = [user for user in user_manager.users if user['role'] == 'consumer']
+
+    # A narrow window (2 days x 8 hours) so bookings collide constantly
+    first_day = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+    counts = Counter()
+    counts_lock = threading.Lock()
+
+    def count(name):
+        with counts_lock:
+            counts[name] += 1
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        customer = customers[index % len(customers)]
+        mine = []
+        for _ in range(args.operations):
+            provider = rng.choice(providers)
+            start = first_day + timedelta(days=rng.randrange(2), hours=9 + rng.randrange(8),
+                                          minutes=rng.choice((0, 30)))
+            duration = rng.choice((30, 60, 90))
+            action = rng.random()
+            if action < 0.6:
+                ok = scheduler.add_appointment('Hair Salon', start.strftime('%Y-%m-%d'), start.strftime('%H:%M'),
+                                               duration, user_id=customer['id'], provider_id=provider['id'])
+                count('booked' if ok else 'rejected')
+                if ok:
+                    mine.append(last_created.id)
+            elif action < 0.75:
+                # A two-provider batch, planned and applied the way the bulk route does it
+                operations = [{'op': 'create', 'provider_id': p['id'], 'type': 'hair',
+                               'date': start.strftime('%Y-%m-%d'), 'time': start.strftime('%H:%M'),
+                               'duration': duration} for p in rng.sample(providers, 2)]
+                with scheduler.locked_providers(bulk.provider_ids(scheduler, operations, customer,
+                                                                  user_manager.get_user_by_id)):
+                    plan = bulk.plan_operations(scheduler, operations, customer, user_manager.get_user_by_id)
+                    if plan.ok:
+                        scheduler.apply_bulk([apt for _, apt in plan.creates], plan.changes, plan.cancellations)
+                        mine.extend(apt['id'] for _, apt in plan.creates)
+                count('bulk applied' if plan.ok else 'bulk rejected')
+            elif action < 0.9 and mine:
+                if scheduler.cancel_appointment(mine.pop(rng.randrange(len(mine)))):
+                    count('cancelled')
+            else:
+                appointment = rng.choice(scheduler.appointments) if scheduler.appointments else None
+                if appointment is not None:
+                    # Reviews race too: several threads may review the same appointment
+                    reviewer = customers[rng.randrange(len(customers))]
+                    ok = review_manager.add_review(appointment['id'], reviewer['id'],
+                                                   appointment['provider_id'], rng.randint(1, 5))
+                    count('reviewed' if ok else 'duplicate review')
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    # No overlapping active bookings
+    for provider in providers:
+        active = sorted((apt['datetime'], apt['datetime'] + timedelta(minutes=apt['duration']), apt['id'])
+                        for apt in scheduler.appointments
+                        if apt['provider_id'] == provider['id']
+                        and apt.get('status') not in scheduler.INACTIVE_STATUSES)
+        for (_, end, first), (start, _, second) in zip(active, active[1:]):
+            if start < end:
+                failures.append(f"provider {provider['id']}: appointments {first} and {second} overlap")
+
+    # Unique ids, never reused after a cancellation
+    for name, ids in (('appointment', handed_out['appointments']),
+                      ('appointment (stored)', [apt['id'] for apt in scheduler.appointments]),
+                      ('review', [review['id'] for review in review_manager.reviews]),
+                      ('user', [user['id'] for user in user_manager.users])):
+        duplicates = [value for value, count in Counter(ids).items() if count > 1]
+        if duplicates:
+            failures.append(f'duplicate {name} ids: {duplicates[:10]}')
+    pairs = Counter((review['appointment_id'], review['reviewer_id']) for review in review_manager.reviews)
+    if any(count > 1 for count in pairs.values()):
+        failures.append('an appointment was reviewed twice by the same user')
+
+    # What is on disk is what is in memory
+    on_disk = {
+        'appointments': sorted(apt['id'] for apt in scheduler.load_appointments()),
+        'reviews': sorted(review['id'] for review in review_manager.load_reviews()),
+        'users': sorted(user['id'] for user in user_manager.load_users()),
+    }
+    in_memory = {
+        'appointments': sorted(apt['id'] for apt in scheduler.appointments),
+        'reviews': sorted(review['id'] for review in review_manager.reviews),
+        'users': sorted(user['id'] for user in user_manager.users),
+    }
+    for store in on_disk:
+        if on_disk[store] != in_memory[store]:
+            failures.append(f'{store}: file and memory differ')
+
+    total = sum(counts.values())
+    print(f'{total} operations from {args.threads} threads in {elapsed:.2f}s ({total / elapsed:.0f} ops/s)')
+    for name, number in sorted(counts.items()):
+        print(f'  {name:>16}: {number}')
+    print(f'  {"stored":>16}: {len(scheduler.appointments)} appointments, {len(review_manager.reviews)} reviews')
+    if failures:
+        print('FAILED')
+        for failure in failures:
+            print(f'  {failure}')
+        return 1
+    print('OK: no overlaps, no duplicate or reused ids, stores match their files')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
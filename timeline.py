@@ -0,0 +1,103 @@
+"""
+Sorted interval index for windowed schedule queries
+"""
+
+import bisect
+import math
+from datetime import timedelta
+
+
+def sort_key(appointment):
+    """Sort key of an appointment in a timeline, and the cursor that resumes after it"""
+    return appointment['datetime'], appointment['id']
+
+
+class Timeline:
+    """Appointments of one schedule, ordered by start time (then id)
+
+    Overlap queries bisect on start times and only look back as far as the
+    longest appointment ever added, so they cost O(log n + k) for k hits.
+    Pages resume from a (datetime, id) cursor the same way: a bisect, then
+    only the page itself.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._items = []
+        self._max_duration = timedelta(0)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, appointment):
+        key = sort_key(appointment)
+        index = bisect.bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._items.insert(index, appointment)
+        duration = timedelta(minutes=appointment['duration'])
+        if duration > self._max_duration:
+            self._max_duration = duration
+
+    def remove(self, appointment):
+        key = sort_key(appointment)
+        index = bisect.bisect_left(self._keys, key)
+        while index < len(self._keys) and self._keys[index] == key:
+            if self._items[index] is appointment:
+                del self._keys[index]
+                del self._items[index]
+                return True
+            index += 1
+        return False
+
+    def get(self, key):
+        """The appointment with a (datetime, id) sort key, or None"""
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            return self._items[index]
+        return None
+
+    def _first_at(self, start):
+        """Index of the first appointment starting at or after start"""
+        return bisect.bisect_left(self._keys, (start,))
+
+    def overlapping(self, start, end):
+        """Appointments whose [datetime, datetime + duration) overlaps [start, end), by start time"""
+        lo = bisect.bisect_right(self._keys, (start - self._max_duration, math.inf))
+        hi = self._first_at(end)
+        for appointment in self._items[lo:hi]:
+            if appointment['datetime'] + timedelta(minutes=appointment['duration']) > start:
+                yield appointment
+
+    def first_start(self, at_or_after):
+        """Start time of the first appointment starting at or after a time, or None"""
+        index = self._first_at(at_or_after)
+        return self._keys[index][0] if index < len(self._keys) else None
+
+    def starting_between(self, start, end):
+        """Appointments starting in [start, end), by start time"""
+        return self._items[self._first_at(start):self._first_at(end)]
+
+    def count_after(self, moment):
+        """How many appointments start after moment"""
+        return len(self._keys) - bisect.bisect_right(self._keys, (moment, math.inf))
+
+    def iter_after(self, cursor=None):
+        """Appointments after a (datetime, id) cursor, oldest first (from the start without one)"""
+        index = 0 if cursor is None else bisect.bisect_right(self._keys, cursor)
+        while index < len(self._items):
+            yield self._items[index]
+            index += 1
+
+    def iter_from(self, start):
+        """Appointments starting at or after start, oldest first"""
+        return self.iter_after((start,))
+
+    def iter_before(self, cursor=None):
+        """Appointments before a (datetime, id) cursor, newest first (from the end without one)"""
+        index = len(self._keys) if cursor is None else bisect.bisect_left(self._keys, cursor)
+        while index > 0:
+            index -= 1
+            yield self._items[index]
@@ -0,0 +1,235 @@
+"""
+Account deletion: tombstones now, physical removal in the background
+
+Deleting an account appends one record to a small JSON-lines log and
+returns. From then on the stores treat the user as gone: lookups, listings
+and searches skip them, and their bookings and reviews are filtered out of
+every read. ``Compactor`` then removes their appointments, reviews, images
+and finally the user record in batches, one process at a time (the same
+leader election as the outbox and transitions), logging progress as it goes.
+
+    {"op": "delete", "user_id": 7, "at": "2026-01-02T10:00:00"}
+    {"op": "progress", "user_id": 7, "removed": {"appointments": 200}}
+    {"op": "done", "user_id": 7, "removed": {"appointments": 312, "reviews": 4, ...}}
+
+Every process tails the log, so a deletion made in one worker is hidden by
+all of them on their next request. A deletion interrupted by a restart is
+picked up again by the next leader; each step is safe to repeat.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from locks import exclusive_file_lock, try_acquire_leadership
+
+logger = logging.getLogger(__name__)
+
+
+class Tombstones:
+    """Deleted users whose data has not been removed yet, shared through an append-only log"""
+
+    def __init__(self, path='tombstones.jsonl', fsync=True, compact_after=1000):
+        self.path = path
+        self.fsync = fsync
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._append_lock = threading.Lock()
+        self._pending = {}  # user_id -> {'at': ..., 'removed': {kind: count}}
+        self._user_ids = frozenset()
+        self._offset = 0
+        self._inode = None
+        self._records = 0
+        self.refresh()
+
+    def __contains__(self, user_id):
+        return user_id in self._user_ids
+
+    def __len__(self):
+        return len(self._user_ids)
+
+    def user_ids(self):
+        """The ids to hide, as a frozenset (replaced, never changed, so callers can keep it)"""
+        return self._user_ids
+
+    def pending(self):
+        """{user_id: {kind: removed so far}} for deletions still in progress"""
+        with self._lock:
+            return {user_id: dict(state['removed']) for user_id, state in self._pending.items()}
+
+    def status(self):
+        """{user_id: {'at': ..., 'removed': {...}}} for deletions still in progress"""
+        with self._lock:
+            return {user_id: {'at': state['at'], 'removed': dict(state['removed'])}
+                    for user_id, state in self._pending.items()}
+
+    # Writers
+
+    def add(self, user_id):
+        """Tombstone a user; returns False if they already were"""
+        if user_id in self._user_ids:
+            return False
+        self._append({'op': 'delete', 'user_id': user_id, 'at': datetime.now().isoformat()})
+        self.refresh()
+        return True
+
+    def record(self, user_id, removed, done=False):
+        """Log how much of a user's data is gone (cumulative counts); done ends the tombstone"""
+        self._append({'op': 'done' if done else 'progress', 'user_id': user_id, 'removed': removed})
+        self.refresh()
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._append_lock, exclusive_file_lock(self.path + '.lock'):
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+    # Readers
+
+    def refresh(self):
+        """Apply records appended (by any process) since the last read; returns newly deleted user ids"""
+        with self._lock:
+            try:
+                with open(self.path, 'rb') as f:
+                    inode = os.fstat(f.fileno()).st_ino
+                    if inode != self._inode:
+                        # Compacted (or first read): start over from the rewritten log
+                        self._inode = inode
+                        self._offset = 0
+                        self._records = 0
+                        previous, self._pending = self._pending, {}
+                    else:
+                        previous = self._pending
+                    f.seek(self._offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return []
+            end = data.rfind(b'\n') + 1
+            self._offset += end
+            before = set(previous)
+            for line in data[:end].splitlines():
+                if line.strip():
+                    self._apply(json.loads(line))
+            if self._pending.keys() != self._user_ids:
+                self._user_ids = frozenset(self._pending)
+            return [user_id for user_id in self._pending if user_id not in before]
+
+    def _apply(self, record):
+        self._records += 1
+        user_id = record['user_id']
+        if record['op'] == 'delete':
+            self._pending.setdefault(user_id, {'at': record.get('at'), 'removed': {}})
+        elif record['op'] == 'progress' and user_id in self._pending:
+            self._pending[user_id]['removed'] = dict(record['removed'])
+        elif record['op'] == 'done':
+            self._pending.pop(user_id, None)
+
+    def maybe_compact(self):
+        """Rewrite the log with only the deletions still in progress, once enough history has piled up"""
+        if self._records < self.compact_after:
+            return False
+        with self._append_lock, exclusive_file_lock(self.path + '.lock'):
+            # Nothing can be appended while we hold the lock; catch up first
+            self.refresh()
+            with self._lock:
+                lines = []
+                for user_id, state in self._pending.items():
+                    lines.append({'op': 'delete', 'user_id': user_id, 'at': state['at']})
+                    if state['removed']:
+                        lines.append({'op': 'progress', 'user_id': user_id, 'removed': state['removed']})
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    for record in lines:
+                        f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                st = os.stat(self.path)
+                self._inode = st.st_ino
+                self._offset = st.st_size
+                self._records = len(lines)
+        return True
+
+
+class Compactor:
+    """Background loop that physically removes tombstoned users' data in batches
+
+    steps is a list of (kind, purge) run in order for each deleted user, where
+    purge(user_id, limit) removes at most limit records and returns how many
+    it removed; a step repeats until a batch comes back short. refresh, if
+    given, runs before each batch so the stores see other processes' writes.
+    """
+
+    def __init__(self, tombstones, steps, batch_size=200, refresh=None, poll_interval=30.0, pause=0.05):
+        self.tombstones = tombstones
+        self.steps = steps
+        self.batch_size = batch_size
+        self.refresh = refresh
+        self.poll_interval = poll_interval
+        self.pause = pause  # between batches, so requests get the store locks in between
+        self.completed = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._started_pid = None
+        self._leader_file = None
+
+    def wake(self):
+        self._wake.set()
+
+    def run_once(self):
+        """Finish every pending deletion; returns how many users were completed"""
+        self.tombstones.refresh()
+        finished = 0
+        for user_id, removed in self.tombstones.pending().items():
+            started = time.perf_counter()
+            for kind, purge in self.steps:
+                while True:
+                    if self._stop.is_set():
+                        return finished
+                    if self.refresh is not None:
+                        self.refresh()
+                    count = purge(user_id, self.batch_size)
+                    if count:
+                        removed[kind] = removed.get(kind, 0) + count
+                        self.tombstones.record(user_id, removed)
+                    if count < self.batch_size:
+                        break
+                    time.sleep(self.pause)
+            self.tombstones.record(user_id, removed, done=True)
+            finished += 1
+            self.completed += 1
+            summary = ', '.join(f'{count} {kind}' for kind, count in removed.items()) or 'nothing left'
+            logger.info('Deleted account %s removed: %s (%.2fs)', user_id, summary, time.perf_counter() - started)
+        self.tombstones.maybe_compact()
+        return finished
+
+    def start(self):
+        """Start the compactor thread once per process; only one process removes data"""
+        if self._started_pid == os.getpid():
+            return
+        self._started_pid = os.getpid()
+        self._leader_file = None
+        self._stop.clear()
+        threading.Thread(target=self._run, name='deletion-compactor', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._leader_file is None:
+                    self._leader_file = try_acquire_leadership(self.tombstones.path + '.leader')
+                if self._leader_file is not None:
+                    self.run_once()
+            except Exception:
+                logger.exception('Deletion compactor failed (pid %d)', os.getpid())
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
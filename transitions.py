@@ -0,0 +1,269 @@
+"""
+Automatic appointment status transitions
+
+Pending requests that reach their start time without a provider decision
+become ``expired``; optionally, confirmed appointments become ``completed``
+once ``datetime + duration`` has passed. Pending recurring series expire
+the same way when their first session starts undecided. Deadlines live in a min-heap that is
+fed by the scheduler's change events, so the engine never rescans the
+appointment list - it sleeps until the earliest deadline, pops every entry
+that is due and applies the whole batch with a single save. When another
+worker's writes are reloaded, only the records it changed (read from the
+change log, see changes.py) are pushed; the heap is rebuilt from scratch
+only when it starts leading, or when the log cannot say what changed.
+
+Heap entries are validated when popped (status unchanged, appointment not
+cancelled, a series' first session not skipped meanwhile), so status
+changes, cancellations and skips need no heap surgery.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import recurrence
+from changes import ChangesExpired
+from locks import try_acquire_leadership
+
+logger = logging.getLogger(__name__)
+
+
+class StatusTransitionEngine:
+    def __init__(self, scheduler, auto_complete=False, expiry_grace=timedelta(0),
+                 max_sleep=60.0, lock_path=None, get_change_log=None):
+        self.scheduler = scheduler
+        self.get_change_log = get_change_log  # () -> the scheduler's ChangeLog, or None
+        self.auto_complete = auto_complete
+        self.expiry_grace = expiry_grace
+        self.max_sleep = max_sleep
+        self._lock_path = lock_path
+        self._heap = []
+        self._sequence = itertools.count()
+        self._refs = {}  # id(appointment) -> heap entries referencing it
+        self._removed = set()  # id() of cancelled appointments still referenced by the heap
+        self._tracked = {}  # (is a series, record id) -> the record last pushed
+        self._seen_seq = None  # change log position the heap is up to date with; None: rebuild
+        self._lock = threading.RLock()
+        self._catch_up_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._started_pid = None
+        self._leader_file = None
+        self.applied = 0
+
+    @property
+    def lock_path(self):
+        # Resolved on use: the scheduler's data file is only known once it has loaded
+        return self._lock_path or self.scheduler.data_file + '.transitions'
+
+    def _deadline(self, appointment):
+        """(deadline, expected status, new status) for an appointment, or None"""
+        status = appointment.get('status')
+        if status == 'pending':
+            return appointment['datetime'] + self.expiry_grace, 'pending', 'expired'
+        if status == 'confirmed' and self.auto_complete:
+            end = appointment['datetime'] + timedelta(minutes=appointment['duration'])
+            return end, 'confirmed', 'completed'
+        return None
+
+    def _series_deadline(self, series):
+        """(deadline, expected status, new status) for a series, or None"""
+        if series.get('status') != 'pending':
+            return None
+        sessions = recurrence.iter_occurrence_starts(series, series['start'], recurrence.series_end(series))
+        first = next(sessions, None)
+        if first is None:
+            return None
+        return first + self.expiry_grace, 'pending', 'expired'
+
+    def _push(self, appointment, series=False):
+        deadline = self._series_deadline(appointment) if series else self._deadline(appointment)
+        if deadline is None:
+            return
+        when, expected, target = deadline
+        with self._lock:
+            entry = (when.timestamp(), next(self._sequence), appointment, expected, target, series)
+            heapq.heappush(self._heap, entry)
+            self._refs[id(appointment)] = self._refs.get(id(appointment), 0) + 1
+            self._tracked[series, appointment['id']] = appointment
+            is_earliest = self._heap[0] is entry
+        if is_earliest:
+            self._wake.set()
+
+    def rebuild(self):
+        """Seed the heap from the current appointments (on taking the lead, or when changes cannot be followed)"""
+        change_log = self.get_change_log() if self.get_change_log is not None else None
+        with self._lock:
+            # Read first: changes made during the scan are caught up on afterwards
+            self._seen_seq = change_log.last_seq if change_log is not None else None
+            entries = []
+            for appointment in self.scheduler.appointments:
+                deadline = self._deadline(appointment)
+                if deadline is not None:
+                    when, expected, target = deadline
+                    entries.append((when.timestamp(), next(self._sequence), appointment, expected, target, False))
+            for series in self.scheduler.series:
+                deadline = self._series_deadline(series)
+                if deadline is not None:
+                    when, expected, target = deadline
+                    entries.append((when.timestamp(), next(self._sequence), series, expected, target, True))
+            heapq.heapify(entries)
+            self._heap = entries
+            self._refs = {id(entry[2]): 1 for entry in entries}
+            self._tracked = {(entry[5], entry[2]['id']): entry[2] for entry in entries}
+            self._removed.clear()
+        self._wake.set()
+
+    def reset(self):
+        """Drop the heap; the next reload rebuilds it (when the scheduler is replaced)"""
+        with self._lock:
+            self._seen_seq = None
+
+    def catch_up(self):
+        """Push the appointments and series changed since the heap was last brought up to date
+        
+        Reads the change log from where the heap left off. Records still
+        tracked as pushed by this process's own events are skipped. Without
+        a change log, or once it has dropped events the heap has not seen,
+        the heap is rebuilt instead.
+        """
+        change_log = self.get_change_log() if self.get_change_log is not None else None
+        with self._catch_up_lock:
+            if change_log is None or self._seen_seq is None:
+                return self.rebuild()
+            try:
+                while True:
+                    events = change_log.read(self._seen_seq, 1000)
+                    if not events:
+                        return
+                    for event in events:
+                        if event['entity'] in ('appointment', 'series') and event['op'] != 'deleted':
+                            self._follow(event)
+                    self._seen_seq = events[-1]['seq']
+            except ChangesExpired:
+                self.rebuild()
+
+    def _follow(self, event):
+        series = event['entity'] == 'series'
+        tracked = self._tracked.get((series, event['id']))
+        if series:
+            record = self.scheduler.get_series(event['id'])
+        elif event['op'] == 'created':
+            fields = event['fields']
+            record = self.scheduler.find_appointment(
+                fields.get('provider_id'), datetime.fromisoformat(fields['datetime']), event['id'])
+        elif tracked is not None:
+            record = self.scheduler.find_appointment(tracked.get('provider_id'), tracked['datetime'], event['id'])
+        else:
+            # Updated, but it had no deadline: nothing to do unless it gained one (statuses only move on)
+            return
+        if record is not None and record is not tracked:
+            # A record pushed already (by this process's own event) is skipped
+            self._push(record, series=series)
+
+    def __call__(self, event, appointment, previous_status=None):
+        """Scheduler listener keeping the heap in step with appointment changes"""
+        if self._leader_file is None:
+            # Only the leader keeps a heap; it picks up other processes' writes on reload
+            return
+        if event == 'created' or event == 'status_changed':
+            self._push(appointment)
+        elif event == 'series_created' or event == 'series_status_changed':
+            self._push(appointment, series=True)
+        elif event == 'series_skipped':
+            # Skipping the first session moves the series' deadline to the next one
+            series = self.scheduler.get_series(appointment['series_id'])
+            if series is not None:
+                self._push(series, series=True)
+        elif event == 'cancelled' or event == 'purged':
+            with self._lock:
+                if id(appointment) in self._refs:
+                    self._removed.add(id(appointment))
+        elif event == 'reloaded':
+            self.catch_up()
+
+    def pop_due(self, now=None):
+        """Pop (record, expected status, target status, is a series) for every due entry still in the expected state"""
+        now = time.time() if now is None else now
+        changes = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, appointment, expected, target, series = heapq.heappop(self._heap)
+                key = id(appointment)
+                self._refs[key] -= 1
+                if not self._refs[key]:
+                    del self._refs[key]
+                    if self._tracked.get((series, appointment['id'])) is appointment:
+                        del self._tracked[series, appointment['id']]
+                if key in self._removed:
+                    if key not in self._refs:
+                        self._removed.discard(key)
+                    continue
+                if appointment.get('status') != expected:
+                    continue
+                if series:
+                    deadline = self._series_deadline(appointment)
+                    if deadline is None or deadline[0].timestamp() > now:
+                        # Its first session was skipped; the entry pushed then is the one that counts
+                        continue
+                changes.append((appointment, expected, target, series))
+        return changes
+
+    def run_once(self, now=None):
+        """Apply all due transitions with one save; returns how many were applied"""
+        # Another worker may have rewritten the file; a reload triggers rebuild()
+        self.scheduler.refresh()
+        due = self.pop_due(now)
+        if not due:
+            return 0
+        # Skipped if a request changed the status after it was popped (checked under the store lock)
+        appointments = [entry for entry in due if not entry[3]]
+        applied = 0
+        if appointments:
+            applied += len(self.scheduler.set_statuses(
+                [(appointment, target, {}) for appointment, _, target, _ in appointments],
+                expected=[expected for _, expected, _, _ in appointments]))
+        for record, expected, target, series in due:
+            if series:
+                applied += self.scheduler.set_series_status(record, target, expected=expected)
+        self.applied += applied
+        return applied
+
+    def seconds_until_next(self):
+        with self._lock:
+            if not self._heap:
+                return self.max_sleep
+            return max(0.0, min(self.max_sleep, self._heap[0][0] - time.time()))
+
+    def start(self):
+        """Start the engine thread once per process; only one process applies transitions"""
+        if self._started_pid is not None and self._started_pid == os.getpid():
+            return
+        self._started_pid = os.getpid()
+        self._leader_file = None
+        self._stop.clear()
+        threading.Thread(target=self._run, name='status-transitions', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            timeout = self.max_sleep
+            try:
+                if self._leader_file is None:
+                    self._leader_file = try_acquire_leadership(self.lock_path)
+                    if self._leader_file is not None:
+                        self.rebuild()
+                if self._leader_file is not None:
+                    self.run_once()
+                    timeout = self.seconds_until_next()
+            except Exception:
+                logger.exception('Status transition thread failed (pid %d)', os.getpid())
+            self._wake.wait(timeout)
+            self._wake.clear()
@@ -0,0 +1,69 @@
+"""
+Change counters for conditional GET
+
+Every store has a counter, and so does every entity in it that pages
+depend on (a user, a provider's appointments, the reviews a user
+received). Store listeners bump them on each change; a reload bumps the
+store's epoch, which changes every entity version at once. ETags are
+digests of the versions a response depends on, so an unchanged page can be
+answered with 304 before anything is rendered.
+
+Counters only mean something inside one process, so ETags also carry a
+token that is new in every process (including forked workers).
+"""
+
+import hashlib
+import os
+import threading
+import uuid
+
+
+class StoreVersions:
+    def __init__(self):
+        self._counters = {}  # (store, entity or None) -> count
+        self._epochs = {}  # store -> reload count
+        self._lock = threading.Lock()
+        self._pid = None
+        self._token = None
+
+    def bump(self, store, *entities):
+        """Record a change to a store and to the given entities in it"""
+        with self._lock:
+            for key in [(store, None)] + [(store, entity) for entity in entities if entity is not None]:
+                self._counters[key] = self._counters.get(key, 0) + 1
+
+    def reset(self, store):
+        """The whole store was reloaded: every entity in it may have changed"""
+        with self._lock:
+            self._epochs[store] = self._epochs.get(store, 0) + 1
+            self._counters[(store, None)] = self._counters.get((store, None), 0) + 1
+
+    def version(self, store, entity=None):
+        return self._epochs.get(store, 0), self._counters.get((store, entity), 0)
+
+    def etag(self, *parts):
+        """Strong (unquoted) ETag over a process token and parts: versions and anything else the response varies by"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._token = uuid.uuid4().hex
+        return hashlib.sha1(repr((self._token,) + parts).encode()).hexdigest()
+
+    # Store listeners
+
+    def user_changed(self, event, user):
+        if event == 'reloaded':
+            self.reset('users')
+        else:
+            self.bump('users', user['id'])
+
+    def appointment_changed(self, event, appointment, previous_status=None):
+        if event == 'reloaded':
+            self.reset('appointments')
+        else:
+            self.bump('appointments', appointment.get('provider_id'), appointment.get('user_id'))
+
+    def review_changed(self, event, review):
+        if event == 'reloaded':
+            self.reset('reviews')
+        else:
+            self.bump('reviews', review['reviewed_id'], review['reviewer_id'])